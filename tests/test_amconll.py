@@ -0,0 +1,125 @@
+import io
+import os
+
+import numpy as np
+import torch
+from allennlp.data import Instance
+from allennlp.data.dataset import Batch
+from allennlp.data.fields import ListField, ArrayField
+
+from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
+from topdown_parser.dataset_readers.amconll_columns import read_amconll_columns, StringTable
+from topdown_parser.dataset_readers.amconll_tools import parse_amconll, AMSentence
+from topdown_parser.dataset_readers.context_field import ContextField, DenseContextField
+from topdown_parser.dataset_readers.instance_cache import InstanceCache, PreprocessedTree, DECISION_COLUMNS
+from topdown_parser.transition_systems.dfs import DFS
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "example_DM")
+LEXICON = {"edge_labels": os.path.join(DATA, "lexicon", "edges.txt"),
+           "constants": os.path.join(DATA, "lexicon", "constants.txt"),
+           "term_types": os.path.join(DATA, "lexicon", "types.txt"),
+           "lex_labels": os.path.join(DATA, "lexicon", "lex_labels.txt")}
+FILES = [os.path.join(DATA, name) for name in ["train/train.amconll", "gold-dev/gold-dev.amconll", "dev/dev.amconll",
+                                                "test.id/test.id.amconll", "test.ood/test.ood.amconll"]]
+
+
+def read_sentences(path):
+    with open(path) as f:
+        return list(parse_amconll(f))
+
+
+def test_columns_agree_with_parse_amconll():
+    strings = StringTable()
+    for path in FILES:
+        expected = read_sentences(path)
+        with open(path) as f:
+            columns = read_amconll_columns(f, strings=strings)
+        assert len(columns) == len(expected)
+        assert list(columns) == expected
+        assert columns.sentences(1, len(columns)) == expected[1:]
+        assert columns.sentence_lengths().tolist() == [len(s) for s in expected]
+        for i, sentence in enumerate(expected):
+            assert columns[i] == sentence
+            assert columns.get_heads(i).tolist() == sentence.get_heads()
+            assert strings.lookup(columns.column("label", i)) == sentence.column("label")
+
+
+def test_str_round_trip():
+    for path in FILES:
+        for sentence in read_sentences(path):
+            assert list(parse_amconll(io.StringIO(str(sentence) + "\n\n"))) == [sentence]
+            # the old implementation printed the words one by one
+            assert str(sentence).split("\n")[len(sentence.attributes):] == \
+                   ["\t".join(str(x) for x in [i] + [f for f in w][:-1] + ([w.range] if w.range is not None else []))
+                    for i, w in enumerate(sentence.words, 1)]
+
+
+def test_with_annotation_round_trip():
+    for path in FILES[:2]:
+        for sentence in read_sentences(path):
+            stripped = sentence.strip_annotation()
+            supertags = [AMSentence.split_supertag(s) for s in sentence.get_supertags()]
+            annotated = stripped.with_annotation(sentence.get_heads(), sentence.get_edge_labels(), supertags,
+                                                 sentence.get_lexlabels())
+            assert annotated == sentence
+            assert annotated.words == sentence.words
+            # the stripped sentence is unchanged
+            assert stripped == sentence.strip_annotation()
+            assert stripped.with_annotation() == stripped
+            assert stripped.set_heads(sentence.get_heads()).get_heads() == sentence.get_heads()
+
+
+def random_tree(rng, steps, present):
+    if not present:
+        return None
+    return PreprocessedTree(rng.integers(0, 100, size=(steps+1, len(DECISION_COLUMNS))),
+                            rng.integers(0, 10, size=steps),
+                            {"parents": rng.integers(0, 10, size=(steps, 1)),
+                             "children": rng.integers(0, 10, size=(steps, 1 + steps % 3)),
+                             "children_mask": rng.integers(0, 2, size=(steps, 1 + steps % 3)).astype(bool)})
+
+
+def test_instance_cache_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    path = FILES[0]
+    lexicon = AdditionalLexicon(LEXICON)
+    trees = [random_tree(rng, steps, present) for steps, present in [(3, True), (0, False), (5, True), (1, True), (4, False)]]
+
+    cache = InstanceCache(str(tmp_path), path, DFS("IO", True, lexicon), lexicon, {"max_sentences": None})
+    assert not cache.exists()
+    cache.write(trees)
+    assert cache.exists()
+
+    loaded = cache.load()
+    assert len(loaded) == len(trees)
+    for tree, loaded_tree in zip(trees, loaded):
+        if tree is None:
+            assert loaded_tree is None
+            continue
+        assert np.array_equal(loaded_tree.decisions, tree.decisions)
+        assert np.array_equal(loaded_tree.active_nodes, tree.active_nodes)
+        assert loaded_tree.contexts.keys() == tree.contexts.keys()
+        for name, array in tree.contexts.items():
+            assert loaded_tree.contexts[name].dtype == array.dtype
+            assert np.array_equal(loaded_tree.contexts[name], array)
+
+    # other options and other transition systems have different entries
+    assert not InstanceCache(str(tmp_path), path, DFS("IO", True, lexicon), lexicon, {"max_sentences": 10}).exists()
+    assert not InstanceCache(str(tmp_path), path, DFS("LR", True, lexicon), lexicon, {"max_sentences": None}).exists()
+    assert InstanceCache(str(tmp_path), path, DFS("IO", True, lexicon), lexicon, {"max_sentences": None}).exists()
+
+
+def test_dense_context_field_batches_like_context_field():
+    lexicon = AdditionalLexicon(LEXICON)
+    dfs = DFS("IO", True, lexicon)
+    contexts = [dfs.gold_context(sentence, list(dfs.get_order(sentence))) for sentence in read_sentences(FILES[0])[:5]]
+
+    dense = Batch([Instance({"context": DenseContextField(c)}) for c in contexts]).as_tensor_dict()["context"]
+    lists = Batch([Instance({"context": ContextField({name: ListField([ArrayField(row, dtype=array.dtype) for row in array])
+                                                      for name, array in c.items()})})
+                   for c in contexts]).as_tensor_dict()["context"]
+
+    assert dense.keys() == lists.keys() == contexts[0].keys()
+    for name in dense:
+        assert dense[name].dtype == lists[name].dtype
+        assert torch.equal(dense[name], lists[name])
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+
+from topdown_parser.am_algebra.new_amtypes import CandidateLexType, CandidateLexTypeIndex
+from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
+from topdown_parser.transition_systems.ltf import SupertagIndex, typ2supertag
+from topdown_parser.transition_systems.utils import get_best_constant
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "example_DM")
+LEXICON = {"edge_labels": os.path.join(DATA, "lexicon", "edges.txt"),
+           "constants": os.path.join(DATA, "lexicon", "constants.txt"),
+           "term_types": os.path.join(DATA, "lexicon", "types.txt"),
+           "lex_labels": os.path.join(DATA, "lexicon", "lex_labels.txt")}
+
+
+def test_best_constants_agree_with_get_best_constant():
+    lexicon = AdditionalLexicon(LEXICON)
+    _typ2supertag = typ2supertag(lexicon)
+    index = SupertagIndex(_typ2supertag)
+    rng = np.random.default_rng(0)
+
+    # integer scores have ties, get_best_constant takes the first of them in the order of iteration.
+    for constant_scores in [rng.random(lexicon.vocab_size("constants")), rng.integers(0, 3, lexicon.vocab_size("constants"))]:
+        constants, scores = index.best_constants(constant_scores)
+        for i, typ in enumerate(index.i2typ):
+            assert (constants[i], scores[i]) == get_best_constant(sorted(_typ2supertag[typ]), constant_scores)
+
+    batch = rng.random((4, lexicon.vocab_size("constants")))
+    constants, scores = index.best_constants(batch)
+    for b in range(len(batch)):
+        assert np.array_equal(constants[b], index.best_constants(batch[b])[0])
+        assert np.array_equal(scores[b], index.best_constants(batch[b])[1])
+
+    # a subset of the lexical types in a different order
+    lex_types = list(reversed(index.i2typ))[::2]
+    constants, _ = SupertagIndex(_typ2supertag, lex_types).best_constants(batch[0])
+    assert constants.tolist() == [get_best_constant(sorted(_typ2supertag[typ]), batch[0])[0] for typ in lex_types]
+
+
+def test_candidate_index_agrees_with_candidate_lex_type():
+    omega = list(typ2supertag(AdditionalLexicon(LEXICON)).keys())
+    candidates = CandidateLexType(set(omega))
+    index = CandidateLexTypeIndex(omega)
+
+    for term_type in omega:
+        for n in range(4):
+            expected = set(candidates.get_candidates(term_type, n))
+            assert set(index.get_candidates(term_type, n)) == expected
+            assert {index.i2typ[i] for i in index.candidate_ids(term_type, n)} == expected
+            # sorted by the size of the apply set
+            sizes = [len(lex_type.get_apply_set(term_type)) for lex_type in index.get_candidates(term_type, n)]
+            assert sizes == sorted(sizes)
+
+            with_apply_sets = set(candidates.get_candidates_with_apply_set(term_type, set(), n))
+            assert set(index.get_candidates_with_apply_set(term_type, set(), n)) == with_apply_sets
+            for _, apply_set in with_apply_sets:
+                for source in apply_set:
+                    assert set(index.get_candidates_with_apply_set(term_type, {source}, n)) == \
+                           set(candidates.get_candidates_with_apply_set(term_type, {source}, n))
+                mask = int(index.mask(apply_set))
+                assert {index.i2typ[i] for i in index.with_apply_set(term_type, mask)} == \
+                       {lex_type for lex_type, a in with_apply_sets if a == apply_set}
+
+            if with_apply_sets:
+                assert index.smallest_rest_of_apply_set(term_type, 0, n) == min(len(a) for _, a in with_apply_sets)
+                assert index.sources_of_mask(index.possible_sources(term_type, 0, n)) == \
+                       set().union(*[a for _, a in with_apply_sets])
+            else:
+                assert index.smallest_rest_of_apply_set(term_type, 0, n) is None
+                assert index.possible_sources(term_type, 0, n) == 0
+
+        assert list(index.get_candidates_with_apply_set(term_type, {"not_a_source"}, 3)) == []
@@ -0,0 +1,32 @@
+import os
+
+from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
+from topdown_parser.dataset_readers.amconll_tools import parse_amconll
+from topdown_parser.transition_systems.decision import Decision
+from topdown_parser.transition_systems.ltl import LTL
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "example_DM")
+LEXICON = {"edge_labels": os.path.join(DATA, "lexicon", "edges.txt"),
+           "constants": os.path.join(DATA, "lexicon", "constants.txt"),
+           "term_types": os.path.join(DATA, "lexicon", "types.txt"),
+           "lex_labels": os.path.join(DATA, "lexicon", "lex_labels.txt")}
+
+
+def test_signature_depends_on_labels_of_substack():
+    ltl = LTL("IO", True, AdditionalLexicon(LEXICON))
+    with open(os.path.join(DATA, "train", "train.amconll")) as f:
+        sentence = next(iter(parse_amconll(f))).strip_annotation()
+    assert len(sentence) >= 2
+
+    state = ltl.initial_state(sentence, None)
+    state = ltl.step(state, Decision(1, False, "ROOT", ("", ""), ""))
+    state = ltl.step(state, Decision(0, True, "", ("", ""), "")) # the artificial root is popped, 1 becomes the top of the stack
+
+    # the hypotheses differ only in the label of the edge to the child of the top of the stack
+    with_mod_s = ltl.step(state, Decision(2, False, "MOD_s", ("", ""), ""))
+    with_mod_poss = ltl.step(state, Decision(2, False, "MOD_poss", ("", ""), ""))
+    assert with_mod_s.substack == with_mod_poss.substack == [2]
+
+    for with_context in [False, True]:
+        assert ltl.state_signature(with_mod_s, with_context) != ltl.state_signature(with_mod_poss, with_context)
+        assert ltl.state_signature(with_mod_s, with_context) == ltl.state_signature(ltl.step(state, Decision(2, False, "MOD_s", ("", ""), "")), with_context)
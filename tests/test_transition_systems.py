@@ -0,0 +1,112 @@
+import dataclasses
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from topdown_parser.am_algebra.tools import is_welltyped
+from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
+from topdown_parser.dataset_readers.amconll_tools import parse_amconll
+from topdown_parser.transition_systems.dfs import DFS
+from topdown_parser.transition_systems.dfs_children_first import DFSChildrenFirst
+from topdown_parser.transition_systems.ltf import LTF
+from topdown_parser.transition_systems.ltl import LTL
+from topdown_parser.transition_systems.transition_system import TransitionSystem
+from topdown_parser.transition_systems.utils import top_k_indices, get_top_k_choices
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "example_DM")
+LEXICON = {"edge_labels": os.path.join(DATA, "lexicon", "edges.txt"),
+           "constants": os.path.join(DATA, "lexicon", "constants.txt"),
+           "term_types": os.path.join(DATA, "lexicon", "types.txt"),
+           "lex_labels": os.path.join(DATA, "lexicon", "lex_labels.txt")}
+
+
+def transition_systems():
+    lexicon = AdditionalLexicon(LEXICON)
+    systems = []
+    for pop_with_0 in [True, False]:
+        for children_order in ["IO", "LR"]:
+            systems += [DFS(children_order, pop_with_0, lexicon), LTF(children_order, pop_with_0, lexicon)]
+            for reverse_push_actions in [False, True]:
+                systems += [DFSChildrenFirst(children_order, pop_with_0, lexicon, reverse_push_actions=reverse_push_actions),
+                            LTL(children_order, pop_with_0, lexicon, reverse_push_actions=reverse_push_actions)]
+    return systems
+
+
+def gold_sentences():
+    with open(os.path.join(DATA, "train", "train.amconll")) as f:
+        return [sentence.normalize_types() for sentence in parse_amconll(f) if is_welltyped(sentence)]
+
+
+@pytest.mark.parametrize("transition_system", transition_systems(), ids=lambda t: type(t).__name__)
+def test_gold_context_agrees_with_replay(transition_system):
+    for sentence in gold_sentences():
+        decisions = list(transition_system.get_order(sentence))
+        expected = TransitionSystem.gold_context(transition_system, sentence, decisions)
+        context = transition_system.gold_context(sentence, decisions)
+        assert context.keys() == expected.keys()
+        for name, array in expected.items():
+            assert context[name].dtype == array.dtype
+            assert np.array_equal(context[name], array), name
+
+
+def gold_states(transition_system, sentences):
+    """
+    The parsing states before the decisions on the way to the gold trees.
+    """
+    states = []
+    for sentence in sentences:
+        decisions = list(transition_system.get_order(sentence))
+        state = transition_system.initial_state(sentence.strip_annotation(), None)
+        # the last decision pops the artificial root, which fails in LTF without pop_with_0.
+        for decision in decisions[1:-1]:
+            states.append(state)
+            state = transition_system.step(state, decision)
+        states.append(state)
+    return states
+
+
+@pytest.mark.parametrize("transition_system", transition_systems(), ids=lambda t: type(t).__name__)
+def test_make_decisions_agrees_with_make_decision(transition_system):
+    lexicon = transition_system.additional_lexicon
+    sentences = gold_sentences()
+    states = gold_states(transition_system, sentences)
+    n = max(len(s) for s in sentences) + 1
+    batch_size = len(states)
+
+    torch.manual_seed(0)
+    for _ in range(3):
+        scores = {"children_scores": torch.rand(batch_size, n),
+                  "constants_scores": torch.rand(batch_size, lexicon.vocab_size("constants")),
+                  "term_types_scores": torch.rand(batch_size, lexicon.vocab_size("term_types")),
+                  "lex_labels": torch.randint(0, lexicon.vocab_size("lex_labels"), (batch_size,)),
+                  "all_labels_scores": torch.rand(batch_size, n, lexicon.vocab_size("edge_labels"))}
+        for i, state in enumerate(states):
+            scores["children_scores"][i, len(state.sentence)+1:] = -10e10
+
+        expected = TransitionSystem.make_decisions(transition_system, scores, states)
+        decisions = transition_system.make_decisions(scores, states)
+        assert len(decisions) == len(expected)
+        for decision, expected_decision in zip(decisions, expected):
+            assert dataclasses.replace(decision, score=0.0) == dataclasses.replace(expected_decision, score=0.0)
+            assert float(decision.score) == pytest.approx(float(expected_decision.score))
+
+
+def test_top_k_indices():
+    rng = np.random.default_rng(0)
+    # integer scores have ties, which are broken by index
+    for scores in [rng.random(20), rng.integers(0, 4, 20).astype(np.float64), np.zeros(0)]:
+        expected = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+        for k in [0, 1, 3, 19, 20, 25]:
+            assert top_k_indices(scores, k).tolist() == expected[:k]
+
+
+def test_get_top_k_choices():
+    rng = np.random.default_rng(1)
+    scores = rng.integers(0, 4, 30).astype(np.float64)
+    for choices in [{3, 1, 29, 7, 8, 12}, set(range(30)), {5}]:
+        # ties are broken by the order of the choices
+        expected = sorted(choices, key=lambda i: -scores[i])
+        for k in [0, 1, 2, 6, 40]:
+            assert get_top_k_choices(choices, scores, k) == [(i, scores[i]) for i in expected[:k]]
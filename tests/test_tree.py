@@ -0,0 +1,55 @@
+import os
+import sys
+
+from topdown_parser.am_algebra.tree import Tree, ArrayTree
+from topdown_parser.dataset_readers.amconll_tools import parse_amconll
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "example_DM")
+
+
+def reference_tree(heads, nodes):
+    """
+    Tree with the children of every node in the order of their positions, built without ArrayTree.
+    """
+    trees = [Tree((i, node), []) for i, node in enumerate(nodes)]
+    for i in range(1, len(heads)):
+        trees[heads[i]].add_child(trees[i])
+    return trees[0]
+
+
+def positions(node, children):
+    return node[0], children
+
+
+def test_array_tree_agrees_with_tree():
+    with open(os.path.join(DATA, "train", "train.amconll")) as f:
+        sentences = list(parse_amconll(f))
+
+    for sentence in sentences:
+        heads = [-1] + sentence.get_heads()
+        expected = reference_tree(heads, [None] + sentence.words)
+
+        tree = ArrayTree.from_am_sentence(sentence)
+        assert len(tree) == len(sentence) + 1
+        assert tree.fold(positions) == expected.fold(positions)
+        assert tree.size() == expected.size()
+        assert tree.max_arity() == expected.max_arity()
+        assert tree.postorder.tolist() == [t.node[0] for t in expected.postorder()]
+        assert [tree.node(i)[1] for i in range(1, len(tree))] == sentence.words
+        for i in range(len(tree)):
+            assert tree.arity(i) == len(tree.children_of(i))
+
+        for converted in [tree.to_tree(), Tree.from_am_sentence(sentence)]:
+            assert converted.fold(positions) == expected.fold(positions)
+            assert converted.size() == expected.size()
+            assert converted.max_arity() == expected.max_arity()
+
+
+def test_deep_tree():
+    n = 3 * sys.getrecursionlimit()
+    heads = [-1] + list(range(n))  # a chain
+    tree = ArrayTree.from_heads(heads, list(range(n+1)))
+    assert tree.fold(lambda node, children: 1 + sum(children)) == n + 1
+    assert tree.max_arity() == 1
+    assert list(tree.preorder()) == list(range(n+1))
+    assert tree.to_tree().size() == n + 1
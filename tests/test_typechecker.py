@@ -0,0 +1,40 @@
+import os
+
+from topdown_parser.am_algebra.tools import get_term_types, is_welltyped
+from topdown_parser.am_algebra.typechecker import BatchedTypeChecker
+from topdown_parser.dataset_readers.amconll_tools import parse_amconll
+
+DATA = os.path.join(os.path.dirname(__file__), "..", "data", "example_DM")
+
+
+def read_sentences():
+    sentences = []
+    for name in ["train/train.amconll", "gold-dev/gold-dev.amconll"]:
+        with open(os.path.join(DATA, name)) as f:
+            sentences.extend(parse_amconll(f))
+    return sentences
+
+
+def test_term_types_agree_with_tools():
+    sentences = read_sentences()
+    expected = [get_term_types(sent) for sent in sentences]
+    # a small max_size makes the checker evict entries of its id tables
+    for checker in [BatchedTypeChecker(), BatchedTypeChecker(max_size=5)]:
+        assert checker.get_term_types_batch(sentences) == expected
+        assert [checker.get_term_types(sent) for sent in sentences] == expected
+
+
+def test_welltypedness_agrees_with_tools():
+    sentences = read_sentences()
+    expected = [is_welltyped(sent) for sent in sentences]
+    assert any(expected)
+
+    checker = BatchedTypeChecker()
+    assert [checker.is_welltyped(sent) for sent in sentences] == expected
+    assert checker.are_welltyped(sentences) == expected
+
+
+def test_workers():
+    sentences = read_sentences()[:20]
+    checker = BatchedTypeChecker()
+    assert checker.get_term_types_batch(sentences, workers=2) == checker.get_term_types_batch(sentences)
@@ -2,6 +2,6 @@ import pyximport
 
 pyximport.install()
 
-from .new_amtypes import AMType, CombinationCache, ReadCache, NonAMTypeException
+from .new_amtypes import AMType, CombinationCache, ReadCache, TypeOperationCache, LRUCache, NonAMTypeException
 #from .tree import Tree
 from .dag import DiGraph
@@ -10,9 +10,12 @@ Created on Tue Dec  3 20:47:47 2019
 import pyximport; pyximport.install()
 from .dag import DiGraph
 
-from typing import Set, Dict, Tuple, List, Iterator, Optional, Iterable, FrozenSet
+from collections import OrderedDict
+from typing import Set, Dict, Tuple, List, Iterator, Optional, Iterable, FrozenSet, Any, Callable, Hashable
 import re
 
+import numpy as np
+
 
 
 def tokenize(type_str) -> List[str]:
@@ -395,31 +398,127 @@ def combinations(head : AMType, dependent : AMType) -> Iterator[Tuple[str,str]]:
         if head.can_be_modified_by(dependent, o):
             yield ("MOD_",o)
 
+class LRUCache:
+    """
+    A memo table that holds at most max_size entries and evicts the least recently used one.
+    max_size = None means unbounded. Counts hits and misses.
+    """
+
+    def __init__(self, max_size : Optional[int] = None):
+        if max_size is not None and max_size < 1:
+            raise ValueError("max_size must be positive or None")
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key : Hashable, compute : Callable[[], Any]) -> Any:
+        """
+        Look up key, calling compute() to fill the entry if it is not present.
+        """
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            self.cache[key] = value
+            if self.max_size is not None and len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+            return value
+
+        self.hits += 1
+        if self.max_size is not None:
+            self.cache.move_to_end(key)
+        return value
+
+    def clear(self) -> None:
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def __contains__(self, key) -> bool:
+        return key in self.cache
+
+
 class CombinationCache:
     
-    def __init__(self):
-        self.cache = dict()
+    def __init__(self, max_size : Optional[int] = None):
+        self.cache = LRUCache(max_size)
         
     def combinations(self,head : AMType, dependent : AMType) -> Set[Tuple[str,str]]:
-        try:
-            return self.cache[(head,dependent)]
-        except KeyError:
-            combis = set(combinations(head,dependent))
-            self.cache[(head,dependent)] = combis
-            return combis
+        return self.cache.get((head,dependent), lambda: set(combinations(head,dependent)))
 
 
 class ReadCache:
 
-    def __init__(self):
-        self.cache = dict()
+    def __init__(self, max_size : Optional[int] = None):
+        self.cache = LRUCache(max_size)
 
     def parse_str(self, s : str) -> AMType:
-        if s in self.cache:
-            return self.cache[s]
-        t = AMType.parse_str(s)
-        self.cache[s] = t
-        return t
+        return self.cache.get(s, lambda: AMType.parse_str(s))
+
+
+class TypeOperationCache:
+    """
+    Memoises the operations on AMTypes that are called over and over again during parsing.
+    Entries are keyed by the type(s) and the argument of the operation, each operation has its own LRU table
+    with at most max_size entries (None = unbounded).
+
+    Types returned by this cache are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_size : Optional[int] = 100_000):
+        self.max_size = max_size
+        self.apply_sets = LRUCache(max_size)
+        self.requests = LRUCache(max_size)
+        self.removed = LRUCache(max_size)
+        self.apply_checks = LRUCache(max_size)
+        self.mod_checks = LRUCache(max_size)
+
+    def get_apply_set(self, typ : AMType, target : AMType) -> Optional[Set[str]]:
+        apply_set = self.apply_sets.get((typ, target), lambda: _freeze(typ.get_apply_set(target)))
+        if apply_set is None:
+            return None
+        return set(apply_set) # callers are allowed to modify the apply set
+
+    def get_request(self, typ : AMType, source : str) -> Optional[AMType]:
+        return self.requests.get((typ, source), lambda: typ.get_request(source))
+
+    def copy_with_removed(self, typ : AMType, source : str) -> AMType:
+        return self.removed.get((typ, source), lambda: typ.copy_with_removed(source))
+
+    def perform_apply(self, typ : AMType, source : str) -> Optional[AMType]:
+        if not typ.can_apply_now(source):
+            return None
+        return self.copy_with_removed(typ, source)
+
+    def can_apply_to(self, typ : AMType, argument : AMType, source : str) -> bool:
+        return self.apply_checks.get((typ, argument, source), lambda: typ.can_apply_to(argument, source))
+
+    def can_be_modified_by(self, typ : AMType, modifier : AMType, source : str) -> bool:
+        return self.mod_checks.get((typ, modifier, source), lambda: typ.can_be_modified_by(modifier, source))
+
+    def statistics(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns (hits, misses) per operation.
+        """
+        return {name : (cache.hits, cache.misses) for name, cache in
+                [("get_apply_set", self.apply_sets), ("get_request", self.requests),
+                 ("copy_with_removed", self.removed), ("can_apply_to", self.apply_checks),
+                 ("can_be_modified_by", self.mod_checks)]}
+
+    def clear(self) -> None:
+        for cache in [self.apply_sets, self.requests, self.removed, self.apply_checks, self.mod_checks]:
+            cache.clear()
+
+
+def _freeze(s : Optional[Set[str]]) -> Optional[FrozenSet[str]]:
+    if s is None:
+        return None
+    return frozenset(s)
 
 
 class ModCache:
@@ -500,6 +599,148 @@ class CandidateLexType:
     #             yield c
             
 
+class CandidateLexTypeIndex:
+    """
+    Same information as CandidateLexType but precomputed as arrays, so it can be shared by transition systems that work on ids.
+
+    Lexical types are identified by their position in omega. For every term type, the lexical types that can reach it
+    are sorted by the size of their apply set (ties are broken by id), offsets[d] is the position of the first
+    candidate with an apply set of size >= d. All candidates with at most n APP operations are thus a prefix
+    of the sorted array. Apply sets are also stored as bitmasks over the sources of omega (source i2source[i] is bit 1 << i),
+    the methods that take or return apply sets as ints use these bitmasks.
+    """
+
+    def __init__(self, omega : Iterable[AMType], type_cache : Optional[TypeOperationCache] = None):
+        self.i2typ : List[AMType] = list(omega)
+        self.typ2i : Dict[AMType, int] = {typ : i for i, typ in enumerate(self.i2typ)}
+        self.type_cache = type_cache if type_cache is not None else TypeOperationCache()
+
+        self.i2source : List[str] = sorted({source for typ in self.i2typ for source in typ.nodes()})
+        self.source2bit : Dict[str, int] = {source : 1 << i for i, source in enumerate(self.i2source)}
+        # Python ints if there are too many sources for a 64 bit mask.
+        self.mask_dtype = np.uint64 if len(self.i2source) <= 64 else object
+
+        # term type -> (ids, apply set sizes, offsets, apply set masks, apply sets)
+        self.entries : Dict[AMType, Tuple[np.array, np.array, np.array, np.array, List[FrozenSet[str]]]] = dict()
+
+    def _entry(self, term_type : AMType) -> Tuple[np.array, np.array, np.array, np.array, List[FrozenSet[str]]]:
+        try:
+            return self.entries[term_type]
+        except KeyError:
+            pass
+        ids = []
+        apply_sets = []
+        for i, lex_type in enumerate(self.i2typ):
+            apply_set = self.type_cache.get_apply_set(lex_type, term_type)
+            if apply_set is not None:
+                ids.append(i)
+                apply_sets.append(frozenset(apply_set))
+
+        sizes = np.array([len(a) for a in apply_sets], dtype=np.int64)
+        order = np.argsort(sizes, kind="stable")
+        ids = np.array(ids, dtype=np.int64)[order]
+        sizes = sizes[order]
+        apply_sets = [apply_sets[j] for j in order]
+        masks = np.array([self.mask(a) for a in apply_sets], dtype=self.mask_dtype)
+        max_size = int(sizes[-1]) if len(sizes) > 0 else 0
+        offsets = np.searchsorted(sizes, np.arange(max_size+2), side="left")
+
+        entry = (ids, sizes, offsets, masks, apply_sets)
+        self.entries[term_type] = entry
+        return entry
+
+    def mask(self, sources : Iterable[str]) -> Optional[Any]:
+        """
+        Bitmask of a set of sources, None if a source doesn't occur in omega.
+        """
+        m = 0
+        for source in sources:
+            if source not in self.source2bit:
+                return None
+            m |= self.source2bit[source]
+        return self.mask_dtype(m) if self.mask_dtype is not object else m
+
+    def sources_of_mask(self, mask : Any) -> Set[str]:
+        mask = int(mask)
+        return {source for source in self.i2source if mask & self.source2bit[source]}
+
+    def _end(self, offsets : np.array, n : int) -> int:
+        if n < 0:
+            return 0
+        return int(offsets[min(n+1, len(offsets)-1)])
+
+    def select(self, term_type : AMType, n : int, apply_set_prefix : int = 0) -> np.array:
+        """
+        Positions (in the sorted candidate arrays of term_type) of the lexical types that reach term_type with
+        at most n APP operations and whose apply set contains apply_set_prefix (a bitmask, see mask).
+        """
+        ids, sizes, offsets, masks, _ = self._entry(term_type)
+        end = self._end(offsets, n)
+        if not apply_set_prefix:
+            return np.arange(end)
+        if apply_set_prefix >> len(self.i2source):
+            # a source that doesn't occur in omega
+            return np.arange(0)
+        prefix = self.mask_dtype(apply_set_prefix) if self.mask_dtype is not object else apply_set_prefix
+        return np.flatnonzero((masks[:end] & prefix) == prefix)
+
+    def candidate_ids(self, term_type : AMType, n : int) -> np.array:
+        """
+        Ids of all lexical types such that it takes at most n APP operations to reach the given term_type,
+        sorted by the size of their apply set.
+        """
+        ids, _, offsets, _, _ = self._entry(term_type)
+        return ids[:self._end(offsets, n)]
+
+    def with_apply_set(self, term_type : AMType, apply_set : int) -> np.array:
+        """
+        Ids of the lexical types whose apply set to reach term_type is exactly apply_set (a bitmask).
+        """
+        ids, sizes, offsets, masks, _ = self._entry(term_type)
+        size = bin(apply_set).count("1")
+        if size >= len(offsets) - 1 or apply_set >> len(self.i2source):
+            return np.arange(0)
+        start, end = offsets[size], offsets[size+1]
+        mask = self.mask_dtype(apply_set) if self.mask_dtype is not object else apply_set
+        return ids[start:end][masks[start:end] == mask]
+
+    def get_candidates(self, term_type : AMType, n : int) -> Iterable[AMType]:
+        for i in self.candidate_ids(term_type, n):
+            yield self.i2typ[i]
+
+    def get_candidates_with_apply_set(self, term_type : AMType, apply_set_prefix : Set[str], n : int) -> Iterable[Tuple[AMType, FrozenSet[str]]]:
+        ids, _, _, _, apply_sets = self._entry(term_type)
+        prefix = self.mask(apply_set_prefix)
+        if prefix is None:
+            return
+        for j in self.select(term_type, n, int(prefix)):
+            yield self.i2typ[ids[j]], apply_sets[j]
+
+    def smallest_rest_of_apply_set(self, term_type : AMType, apply_set_prefix : int, n : int) -> Optional[int]:
+        """
+        Smallest number of sources that still have to be filled for a candidate
+        (apply set contains the bitmask apply_set_prefix, at most n APP operations), None if there is no candidate.
+        """
+        _, sizes, _, _, _ = self._entry(term_type)
+        selected = self.select(term_type, n, apply_set_prefix)
+        if len(selected) == 0:
+            return None
+        # sizes are sorted
+        return int(sizes[selected[0]]) - bin(apply_set_prefix).count("1")
+
+    def possible_sources(self, term_type : AMType, apply_set_prefix : int, n : int) -> int:
+        """
+        Union of the apply sets of all candidates (apply set contains the bitmask apply_set_prefix,
+        at most n APP operations), without apply_set_prefix, as a bitmask.
+        """
+        _, _, _, masks, _ = self._entry(term_type)
+        selected = self.select(term_type, n, apply_set_prefix)
+        if len(selected) == 0:
+            return 0
+        union = int(np.bitwise_or.reduce(masks[selected]))
+        return union & ~apply_set_prefix
+
+
 class ByApplySet:
 
     def __init__(self, omega : Iterable[AMType]) -> None:
@@ -1,38 +1,46 @@
 from typing import Optional, Tuple, List, Dict, Set, Iterable
 
 from topdown_parser.dataset_readers.amconll_tools import AMSentence, Entry
-from .new_amtypes import AMType, ReadCache, NonAMTypeException
-from .tree import Tree
+from .new_amtypes import AMType, ReadCache, NonAMTypeException, TypeOperationCache
+from .tree import ArrayTree
 
+# shared by all calls, bounded because long-running processes see an open-ended set of types.
+_read_cache = ReadCache(max_size=100_000)
+_type_cache = TypeOperationCache(max_size=100_000)
 
-def is_welltyped(sent: AMSentence) -> bool:
-    return get_tree_type(sent) is not None
 
+def is_welltyped(sent: AMSentence, type_cache : Optional[TypeOperationCache] = None) -> bool:
+    return get_tree_type(sent, type_cache) is not None
 
-def get_tree_type(sent : AMSentence) -> Optional[AMType]:
+
+def get_tree_type(sent : AMSentence, type_cache : Optional[TypeOperationCache] = None) -> Optional[AMType]:
     """
     Get the term type at the root of sent, or None if not well-typed.
     :param sent:
+    :param type_cache: memoises type operations, defaults to a cache shared by all calls.
     :return:
     """
     root = sent.get_root()
     if root is None:
         return None
 
-    term_types = get_term_types(sent)
+    term_types = get_term_types(sent, type_cache)
     return term_types[root]
 
 
-def get_term_types(sent: AMSentence) -> List[Optional[AMType]]:
+def get_term_types(sent: AMSentence, type_cache : Optional[TypeOperationCache] = None) -> List[Optional[AMType]]:
     """
     Return a list of length len(sent), where each element is the term type
     of the subtree rooted in the respective token, or None if the subtree is not well-typed.
     :param sent:
+    :param type_cache: memoises type operations, defaults to a cache shared by all calls.
     :return:
     """
-    deptree = Tree.from_am_sentence(sent)
-    cache = ReadCache()
-    term_types = [None for _ in sent.words]
+    deptree = ArrayTree.from_am_sentence(sent)
+    cache = _read_cache
+    if type_cache is None:
+        type_cache = _type_cache
+    term_types = [None] * len(sent)
 
     def determine_tree_type(node: Tuple[int, Entry], children: List[Tuple[Optional[AMType],str]]) -> Tuple[Optional[AMType],str]:
         try:
@@ -48,7 +56,7 @@ def get_term_types(sent: AMSentence) -> List[Optional[AMType]]:
 
             if "_" in label:
                 source = label.split("_")[1]
-                if label.startswith("MOD") and not lextyp.can_be_modified_by(child_typ, source):
+                if label.startswith("MOD") and not type_cache.can_be_modified_by(lextyp, child_typ, source):
                     return None, node[1].label
                 elif label.startswith("APP"):
                     apply_children[source] = child_typ
@@ -71,8 +79,8 @@ def get_term_types(sent: AMSentence) -> List[Optional[AMType]]:
             changed = False
             remove = []
             for o in apply_children:
-                if typ.can_apply_to(apply_children[o], o):
-                    typ = typ.perform_apply(o)
+                if type_cache.can_apply_to(typ, apply_children[o], o):
+                    typ = type_cache.perform_apply(typ, o)
                     remove.append(o)
                     changed = True
 
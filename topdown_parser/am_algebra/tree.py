@@ -1,8 +1,15 @@
-from typing import List
+from typing import List, Iterator, Any, Callable, Optional
+
+import numpy as np
 
 from topdown_parser.dataset_readers.amconll_tools import parse_amconll, AMSentence, Entry
 
 
+def _root_entry() -> Entry:
+    root = "*root*"
+    return Entry(root,"_",root, root, root, "_", "_", "_", -1, root, True, None)
+
+
 class Tree:
     """
     A simple tree class
@@ -16,30 +23,21 @@ class Tree:
     
     @staticmethod
     def from_heads(heads, conll_sentence : List):
-        
-        def parse(i):
-            mother = Tree((i,conll_sentence[i]),[])
-            for j in range(len(heads)):
-                if heads[j] == i:
-                    mother.add_child(parse(j))
-            return mother
-        
-        return parse(0) #articial root is at position 0
+        return ArrayTree.from_heads(heads, conll_sentence).to_tree() #articial root is at position 0
 
     @staticmethod
     def from_am_sentence(s : AMSentence):
-        root = "*root*"
-        root_entry = Entry(root,"_",root, root, root, "_", "_", "_", -1, root, True, None)
-        return Tree.from_heads([-1] + s.get_heads(),[root_entry] + s.words)
+        return Tree.from_heads([-1] + s.get_heads(),[_root_entry()] + s.words)
     
     def fold(self, f):
         """
         Folding on trees: f takes a node a list of things that f produces
         Returns a single thing (for instance a Tree or a number)
         """
-        if len(self.children) == 0:
-            return f(self.node,[])
-        return f(self.node,[c.fold(f) for c in self.children])
+        results = dict()
+        for t in self.postorder():
+            results[id(t)] = f(t.node, [results.pop(id(c)) for c in t.children])
+        return results[id(self)]
 
     def fold_double(self, f):
         """
@@ -59,23 +57,20 @@ class Tree:
             c.map(f)
     
     def size(self):
-        if len(self.children) == 0:
-            return 1
-        return 1+sum(c.size() for c in self.children)
+        return sum(1 for _ in self.postorder())
 
     def max_arity(self):
-        if len(self.children) == 0:
-            return 0
-        return max(len(self.children), max(c.max_arity() for c in self.children))
+        return max(len(t.children) for t in self.postorder())
         
     def postorder(self):
-        if self.children == []:
-            yield self
-        else:
-            for c in self.children:
-                for x in c.postorder():
-                    yield x
-            yield self
+        agenda = [(self, False)]
+        while agenda:
+            t, expanded = agenda.pop()
+            if expanded or t.children == []:
+                yield t
+            else:
+                agenda.append((t, True))
+                agenda.extend((c, False) for c in reversed(t.children))
 
     def _to_str(self,depth=0):
         if len(self.children) == 0:
@@ -91,6 +86,98 @@ class Tree:
         return "({} {})".format(str(self.node)," ".join(c.__repr__() for c in self.children))
 
 
+class ArrayTree:
+    """
+    A tree over the positions 0, ..., n (0 being the artificial root) that is stored in arrays.
+    The children of node i are children[offsets[i]:offsets[i+1]], in the order of their positions.
+    Construction takes linear time and no operation recurses, so deep trees don't hit the recursion limit.
+    """
+    def __init__(self, heads : np.array, nodes : Optional[List[Any]] = None):
+        """
+        :param heads: shape (n+1,), heads[i] is the parent of i, heads[0] = -1
+        :param nodes: labels of the nodes, e.g. conll entries
+        """
+        self.heads = heads
+        self.nodes = nodes
+        n = len(heads)
+
+        counts = np.zeros(n+1, dtype=np.int64)
+        for h in heads[1:]:
+            counts[h+1] += 1
+        self.offsets = np.cumsum(counts)
+
+        children = np.zeros(max(0, n-1), dtype=np.int64)
+        fill = self.offsets[:-1].copy()
+        for i in range(1, n):
+            h = heads[i]
+            children[fill[h]] = i
+            fill[h] += 1
+        self.children = children
+
+        # postorder of the nodes reachable from the root.
+        postorder = []
+        agenda = [(0, False)]
+        while agenda:
+            i, expanded = agenda.pop()
+            if expanded or self.offsets[i] == self.offsets[i+1]:
+                postorder.append(i)
+            else:
+                agenda.append((i, True))
+                agenda.extend((c, False) for c in reversed(self.children_of(i)))
+        self.postorder = np.array(postorder, dtype=np.int64)
+
+    @staticmethod
+    def from_heads(heads, conll_sentence : Optional[List] = None) -> "ArrayTree":
+        return ArrayTree(np.array(heads, dtype=np.int64), conll_sentence)
+
+    @staticmethod
+    def from_am_sentence(s : AMSentence) -> "ArrayTree":
+        return ArrayTree.from_heads([-1] + s.get_heads(),[_root_entry()] + s.words)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def node(self, i : int):
+        """
+        The node in the format of Tree: (position, entry)
+        """
+        return i, self.nodes[i]
+
+    def children_of(self, i : int) -> List[int]:
+        return self.children[self.offsets[i]:self.offsets[i+1]].tolist()
+
+    def arity(self, i : int) -> int:
+        return int(self.offsets[i+1] - self.offsets[i])
+
+    def fold(self, f : Callable[[Any, List[Any]], Any]) -> Any:
+        """
+        Same as Tree.fold: f takes a node and the list of results for its children.
+        """
+        results = [None for _ in range(len(self))]
+        for i in self.postorder.tolist():
+            results[i] = f(self.node(i), [results[c] for c in self.children_of(i)])
+        return results[0]
+
+    def preorder(self) -> Iterator[int]:
+        agenda = [0]
+        while agenda:
+            i = agenda.pop()
+            yield i
+            agenda.extend(reversed(self.children_of(i)))
+
+    def size(self) -> int:
+        return len(self.postorder)
+
+    def max_arity(self) -> int:
+        return int(np.max(np.diff(self.offsets))) if len(self) > 0 else 0
+
+    def to_tree(self) -> Tree:
+        trees = [Tree(self.node(i), []) for i in range(len(self))]
+        for i in self.postorder.tolist():
+            trees[i].children = [trees[c] for c in self.children_of(i)]
+        return trees[0]
+
+
 if __name__ == "__main__":
 
     with open("data/tratz/gold-dev/gold-dev.amconll") as f:
@@ -0,0 +1,254 @@
+import multiprocessing as mp
+from typing import Optional, List, Dict, Tuple, FrozenSet
+
+import numpy as np
+
+from topdown_parser.dataset_readers.amconll_tools import AMSentence
+from .new_amtypes import AMType, ReadCache, NonAMTypeException, TypeOperationCache, LRUCache
+from .tree import ArrayTree
+
+# kinds of edge labels
+APP = 0
+MOD = 1
+IGNORE = 2
+ROOT = 3
+OTHER = 4 # label with a source that is neither APP nor MOD, doesn't constrain the types.
+INVALID = 5
+
+NO_TYPE = -1 # type id of subtrees that are not well-typed (or lexical types that can't be parsed)
+
+
+class BatchedTypeChecker:
+    """
+    Computes term types of AM dependency trees (same semantics as am_algebra.tools.get_term_types) for many
+    sentences at once.
+
+    Types and edge labels are interned to integer ids that are shared between all sentences, a tree is
+    represented by three integer arrays (heads, label ids, lexical type ids) and evaluated bottom-up in topological order.
+    The combination of a lexical type with the term types of its APP children is memoised on integer ids.
+    When one of the id tables grows beyond max_size, all ids and the caches on ids are dropped before the next sentence.
+    """
+
+    def __init__(self, type_cache : Optional[TypeOperationCache] = None, max_size : Optional[int] = 100_000):
+        """
+        :param type_cache: memoises operations on AMTypes, a new one is created if None.
+        :param max_size: size bound for the id tables and the caches on type ids (None = unbounded).
+        """
+        self.max_size = max_size
+        self.type_cache = type_cache if type_cache is not None else TypeOperationCache(max_size)
+        self.read_cache = ReadCache(max_size)
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forgets all type and label ids, and the caches on them.
+        """
+        self.i2typ : List[AMType] = []
+        self.typ2i : Dict[AMType, int] = dict()
+        self.str2i : Dict[str, int] = dict()
+
+        self.i2label : List[str] = []
+        self.label2i : Dict[str, int] = dict()
+        self.label_kinds : List[int] = []
+        self.label_sources : List[str] = []
+
+        self.apply_memo = LRUCache(self.max_size)
+        self.mod_memo = LRUCache(self.max_size)
+
+    def type_id(self, typ : AMType) -> int:
+        try:
+            return self.typ2i[typ]
+        except KeyError:
+            i = len(self.i2typ)
+            self.i2typ.append(typ)
+            self.typ2i[typ] = i
+            return i
+
+    def type_str_id(self, typ : str) -> int:
+        """
+        Id of a type given as string, NO_TYPE if the string is not a valid AM type.
+        """
+        try:
+            return self.str2i[typ]
+        except KeyError:
+            try:
+                i = self.type_id(self.read_cache.parse_str(typ))
+            except NonAMTypeException:
+                i = NO_TYPE
+            self.str2i[typ] = i
+            return i
+
+    def label_id(self, label : str) -> int:
+        try:
+            return self.label2i[label]
+        except KeyError:
+            pass
+        i = len(self.i2label)
+        self.i2label.append(label)
+        self.label2i[label] = i
+        source = ""
+        if "_" in label:
+            source = label.split("_")[1]
+            if label.startswith("MOD"):
+                kind = MOD
+            elif label.startswith("APP"):
+                kind = APP
+            else:
+                kind = OTHER
+        elif label == "IGNORE":
+            kind = IGNORE
+        elif label == "ROOT":
+            kind = ROOT
+        else:
+            kind = INVALID
+        self.label_kinds.append(kind)
+        self.label_sources.append(source)
+        return i
+
+    def is_full(self) -> bool:
+        return self.max_size is not None and max(len(self.i2typ), len(self.str2i), len(self.i2label)) > self.max_size
+
+    def encode(self, sent : AMSentence) -> Tuple[np.array, np.array, np.array]:
+        """
+        Returns arrays of heads (0 = artificial root), label ids and lexical type ids of the sentence.
+        Ids are only valid until the next call of encode.
+        """
+        if self.is_full():
+            self.reset()
+        heads = np.array(sent.get_heads(), dtype=np.int64)
+        labels = np.array([self.label_id(label) for label in sent.column("label")], dtype=np.int64)
+        types = np.array([self.type_str_id(typ) for typ in sent.column("typ")], dtype=np.int64)
+        return heads, labels, types
+
+    def _can_be_modified_by(self, lex_type : int, modifier : int, source : str) -> bool:
+        return self.mod_memo.get((lex_type, modifier, source),
+                                 lambda: self.type_cache.can_be_modified_by(self.i2typ[lex_type], self.i2typ[modifier], source))
+
+    def _apply_all(self, lex_type : int, apply_children : FrozenSet[Tuple[str, int]]) -> int:
+        """
+        Term type id obtained by filling the sources of the lexical type with the given children, NO_TYPE if that is not possible.
+        """
+        return self.apply_memo.get((lex_type, apply_children), lambda: self._compute_apply_all(lex_type, apply_children))
+
+    def _compute_apply_all(self, lex_type : int, apply_children : FrozenSet[Tuple[str, int]]) -> int:
+        typ = self.i2typ[lex_type]
+        todo = {source : self.i2typ[child] for source, child in apply_children}
+        changed = True
+        while changed:
+            changed = False
+            remove = []
+            for o in todo:
+                if self.type_cache.can_apply_to(typ, todo[o], o):
+                    typ = self.type_cache.perform_apply(typ, o)
+                    remove.append(o)
+                    changed = True
+
+            for source in remove:
+                del todo[source]
+
+        if todo:
+            return NO_TYPE
+        return self.type_id(typ)
+
+    def term_type_ids(self, heads : np.array, labels : np.array, types : np.array) -> np.array:
+        """
+        Computes the term type ids of all subtrees of a tree.
+        :param heads: shape (sent length,), 1-based heads, 0 is the artificial root
+        :param labels: shape (sent length,), label ids as returned by label_id
+        :param types: shape (sent length,), lexical type ids as returned by type_str_id
+        :return: shape (sent length,), term type id of the subtree rooted at each token (NO_TYPE if not well-typed)
+        """
+        term_types = np.full(len(heads), NO_TYPE, dtype=np.int64)
+        tree = ArrayTree(np.concatenate([[-1], heads]))
+
+        label_kinds = self.label_kinds
+        label_sources = self.label_sources
+
+        for node in tree.postorder.tolist():
+            if node == 0: # artificial root
+                continue
+            lex_type = types[node-1]
+            if lex_type == NO_TYPE:
+                continue
+            apply_children = dict()
+            ok = True
+            for child in tree.children_of(node):
+                child -= 1
+                child_type = term_types[child]
+                if child_type == NO_TYPE:
+                    ok = False
+                    break
+                label = labels[child]
+                kind = label_kinds[label]
+                if kind == MOD:
+                    if not self._can_be_modified_by(lex_type, child_type, label_sources[label]):
+                        ok = False
+                        break
+                elif kind == APP:
+                    apply_children[label_sources[label]] = child_type
+                elif kind == IGNORE:
+                    if not self.i2typ[child_type].is_bot:
+                        ok = False
+                        break
+                elif kind == ROOT: # only allowed at the artificial root
+                    ok = False
+                    break
+                elif kind == INVALID:
+                    raise ValueError("Nonsensical edge label: "+self.i2label[label])
+            if ok:
+                term_types[node-1] = self._apply_all(lex_type, frozenset(apply_children.items()))
+
+        return term_types
+
+    def get_term_types(self, sent : AMSentence) -> List[Optional[AMType]]:
+        """
+        Same as am_algebra.tools.get_term_types.
+        """
+        return [self.i2typ[i] if i != NO_TYPE else None for i in self.term_type_ids(*self.encode(sent))]
+
+    def get_term_types_batch(self, sentences : List[AMSentence], workers : int = 1) -> List[List[Optional[AMType]]]:
+        """
+        Computes the term types of all tokens of all sentences.
+        :param sentences:
+        :param workers: number of processes to use, each process keeps its own caches.
+        :return:
+        """
+        if workers < 2:
+            return [self.get_term_types(sent) for sent in sentences]
+
+        chunk_size = max(1, len(sentences) // (4*workers))
+        chunks = [sentences[i:i+chunk_size] for i in range(0, len(sentences), chunk_size)]
+        with mp.Pool(workers, initializer=_init_worker, initargs=(self.max_size,)) as pool:
+            results = pool.map(_term_type_strs, chunks)
+
+        return [[self.read_cache.parse_str(t) if t is not None else None for t in term_types]
+                for chunk in results for term_types in chunk]
+
+    def get_tree_types_batch(self, sentences : List[AMSentence], workers : int = 1) -> List[Optional[AMType]]:
+        """
+        Term type at the root of each sentence, or None if the sentence is not well-typed.
+        """
+        tree_types = []
+        for sent, term_types in zip(sentences, self.get_term_types_batch(sentences, workers)):
+            root = sent.get_root()
+            tree_types.append(term_types[root] if root is not None else None)
+        return tree_types
+
+    def is_welltyped(self, sent : AMSentence) -> bool:
+        root = sent.get_root()
+        if root is None:
+            return False
+        return self.term_type_ids(*self.encode(sent))[root] != NO_TYPE
+
+    def are_welltyped(self, sentences : List[AMSentence], workers : int = 1) -> List[bool]:
+        return [t is not None for t in self.get_tree_types_batch(sentences, workers)]
+
+
+_worker_checker : Optional[BatchedTypeChecker] = None
+
+def _init_worker(max_size : Optional[int]) -> None:
+    global _worker_checker
+    _worker_checker = BatchedTypeChecker(max_size=max_size)
+
+def _term_type_strs(sentences : List[AMSentence]) -> List[List[Optional[str]]]:
+    return [[str(t) if t is not None else None for t in _worker_checker.get_term_types(sent)] for sent in sentences]
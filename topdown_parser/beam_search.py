@@ -15,6 +15,7 @@ import allennlp.nn.util as util
 if __name__ == "__main__":
     import_submodules("topdown_parser")
     from topdown_parser.dataset_readers.same_formalism_iterator import SameFormalismIterator
+    from topdown_parser.dataset_readers.memory_budget_iterator import MemoryBudgetIterator
     from topdown_parser.dataset_readers.amconll_tools import parse_amconll
 
     optparser = argparse.ArgumentParser(add_help=True,
@@ -25,8 +26,14 @@ if __name__ == "__main__":
     optparser.add_argument('output_file', type=str, help='path to output file')
     optparser.add_argument('--cuda-device', type=int, default=0, help='id of GPU to use. Use -1 to compute on CPU.')
     optparser.add_argument('--beam', type=int, default=2, help='beam size. Default: 2')
-    optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size.")
+    optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size. With --memory_budget, this is the maximum batch size.")
+    optparser.add_argument("--memory_budget", type=float, default=None, help="Choose batch sizes such that decoding needs at most roughly this many megabytes.")
     optparser.add_argument("--parse_on_cpu", action="store_true", default=False, help="Enforce parsing on the CPU.")
+    optparser.add_argument("--recombine", action="store_true", default=False, help="Merge beam search hypotheses whose parsing states allow for the same future decisions.")
+    optparser.add_argument("--beam_threshold", type=float, default=None, help="Drop beam search hypotheses whose score is more than this below the best hypothesis of the sentence.")
+    optparser.add_argument("--beam_margin_threshold", type=float, default=None, help="Parse greedily and use beam search only for sentences where a selected node was less than this above the best other node (in log probability).")
+    optparser.add_argument("--beam_score_threshold", type=float, default=None, help="Parse greedily and use beam search only for sentences where the log probability of the selected nodes is below this.")
+    optparser.add_argument("--cascade", action="store_true", default=False, help="Parse with the unconstrained transition system first and only parse sentences that are not well-typed with the transition system.")
 
     args = optparser.parse_args()
 
@@ -41,10 +48,20 @@ if __name__ == "__main__":
     model.eval()
     model.k_best = args.beam
     model.parse_on_gpu = not args.parse_on_cpu
+    model.recombine_hypotheses = args.recombine
+    model.beam_threshold = args.beam_threshold
+    model.beam_margin_threshold = args.beam_margin_threshold
+    model.beam_score_threshold = args.beam_score_threshold
+    model.cascade = args.cascade
 
     pipelinepieces = PipelineTrainerPieces.from_params(config)
 
-    if args.batch_size is not None and args.batch_size > 0:
+    if args.memory_budget is not None:
+        iterator = pipelinepieces.annotator.data_iterator
+        max_batch_size = args.batch_size if args.batch_size is not None and args.batch_size > 0 else iterator._batch_size
+        pipelinepieces.annotator.data_iterator = MemoryBudgetIterator(iterator.formalisms, args.memory_budget, max_batch_size)
+        pipelinepieces.annotator.data_iterator.set_model(model)
+    elif args.batch_size is not None and args.batch_size > 0:
         assert isinstance(pipelinepieces.annotator.data_iterator, SameFormalismIterator)
         iterator : SameFormalismIterator = pipelinepieces.annotator.data_iterator
         pipelinepieces.annotator.data_iterator = SameFormalismIterator(iterator.formalisms, args.batch_size)
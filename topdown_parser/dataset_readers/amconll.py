@@ -1,23 +1,27 @@
 import time
-from typing import Dict, Iterable, List, Optional
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
 import logging
 
+import numpy as np
 import torch
 from allenpipeline import OrderedDatasetReader
 from overrides import overrides
 
-import multiprocessing as mp
-
+from allennlp.common.checks import ConfigurationError
 from allennlp.common.file_utils import cached_path
 from allennlp.data.dataset_readers.dataset_reader import DatasetReader
-from allennlp.data.fields import Field, TextField, SequenceLabelField, MetadataField, ArrayField, ListField, LabelField
+from allennlp.data.fields import Field, TextField, SequenceLabelField, MetadataField, ListField, LabelField
 from allennlp.data.instance import Instance
 from allennlp.data.token_indexers import SingleIdTokenIndexer, TokenIndexer
 from allennlp.data.tokenizers import Token
 
-from .context_field import ContextField
-from .amconll_tools import parse_amconll, AMSentence
-from ..am_algebra.tools import is_welltyped
+from .context_field import DenseContextField
+from .instance_cache import InstanceCache, CachedTrees, PreprocessedTree, DECISION_COLUMNS
+from .amconll_tools import AMSentence
+from .amconll_columns import read_amconll_columns, AMConllColumns
+from .parallel import bounded_imap, worker_pool, call_on_worker_object
+from ..am_algebra.typechecker import BatchedTypeChecker
 
 from tqdm import tqdm
 
@@ -36,6 +40,15 @@ class AMConllDatasetReader(OrderedDatasetReader):
     ----------
     token_indexers : ``Dict[str, TokenIndexer]``, optional (default=``{"tokens": SingleIdTokenIndexer()}``)
         The token indexers to be applied to the words TextField.
+    cache_directory : ``str``, optional (default=``None``)
+        If given, the decision sequences and contexts computed from the gold trees are stored there
+        and reused when the same file is read again with the same transition system and lexicon.
+    chunk_size : ``int``, optional (default=``64``)
+        Number of sentences a worker processes at a time. Instances are produced chunk by chunk, so with ``lazy``
+        training can start as soon as the first chunk is ready.
+    max_chunks_in_flight : ``int``, optional (default=``2*workers``)
+        How many chunks may be processed or waiting to be consumed at the same time, bounds the memory
+        used by the workers.
     """
 
     def __init__(self,
@@ -50,8 +63,16 @@ class AMConllDatasetReader(OrderedDatasetReader):
                  fuzz_beam_search : bool = False,
                  use_tqdm : bool = False,
                  only_read_fraction_if_train_in_filename: bool = False,
-                 read_tokens_only: bool = False) -> None:
+                 read_tokens_only: bool = False,
+                 cache_directory : Optional[str] = None,
+                 chunk_size : int = 64,
+                 max_chunks_in_flight : Optional[int] = None) -> None:
         super().__init__(lazy)
+        if chunk_size < 1:
+            raise ConfigurationError("chunk_size must be positive")
+        self.chunk_size = chunk_size
+        self.max_chunks_in_flight = max_chunks_in_flight if max_chunks_in_flight is not None else 2*max(1, workers)
+        self.cache_directory = cache_directory
         self.read_tokens_only = read_tokens_only
         self.use_tqdm = use_tqdm
         self.fuzz_beam_search = fuzz_beam_search
@@ -67,42 +88,130 @@ class AMConllDatasetReader(OrderedDatasetReader):
         if device is not None and device < 0:
             device = None
         self.device = device
+        self.type_checker = BatchedTypeChecker()
 
-    def collect_sentences(self, file_path : str) -> List[AMSentence]:
+    def read_corpus(self, file_path : str) -> Tuple[AMConllColumns, int]:
+        """
+        Reads the file into columns, returns them together with the number of sentences that should be used.
+        """
         file_path = cached_path(file_path)
         if self.fraction < 0.9999 and (not self.only_read_fraction_if_train_in_filename or (
                 self.only_read_fraction_if_train_in_filename and "train" in file_path)):
             with open(file_path, 'r') as amconll_file:
                 logger.info("Reading a fraction of " + str(
                     self.fraction) + " of the AM dependency trees from amconll dataset at: %s", file_path)
-                sents = list(parse_amconll(amconll_file))
-                return sents[:int(len(sents)*self.fraction)]
+                corpus = read_amconll_columns(amconll_file)
+                return corpus, int(len(corpus)*self.fraction)
         else:
             with open(file_path, 'r') as amconll_file:
                 logger.info("Reading AM dependency trees from amconll dataset at: %s", file_path)
-                return list(parse_amconll(amconll_file))
+                corpus = read_amconll_columns(amconll_file)
+                return corpus, len(corpus)
+
+    def collect_sentences(self, file_path : str) -> List[AMSentence]:
+        corpus, number_of_sentences = self.read_corpus(file_path)
+        return corpus.sentences(0, number_of_sentences)
 
     def read_file(self, file_path: str) -> Iterable[Instance]:
         # if `file_path` is a URL, redirect to the cache
-        sents : List[AMSentence] = self.collect_sentences(file_path)
+        corpus, number_of_sentences = self.read_corpus(file_path)
         t1 = time.time()
-        if self.workers < 2: #or self.workers >= len(sents):
-            #import cProfile
-            #with cProfile.Profile() as pr:
-            if self.use_tqdm:
-                sents = tqdm(sents)
-            r = [self.text_to_instance(s) for s in sents]
-            #pr.print_stats()
+        chunks = (corpus.sentences(start, min(number_of_sentences, start+self.chunk_size))
+                  for start in range(0, number_of_sentences, self.chunk_size))
+        progress = tqdm(total=number_of_sentences) if self.use_tqdm else None
+
+        cache = self.get_instance_cache(file_path, number_of_sentences)
+        pool = None
+        if cache is not None and cache.exists():
+            # Cache hits are always read in this process, even with several workers: the expensive preprocessing
+            # is skipped and only text_to_instance is left to do on the memory-mapped trees.
+            cached_trees = cache.load()
+            results = (self.process_cached_chunk(chunk, cached_trees, start)
+                       for start, chunk in zip(range(0, number_of_sentences, self.chunk_size), chunks))
+            cache = None
         else:
-            with mp.Pool(self.workers) as pool:
-                r = pool.map(self.text_to_instance, sents)
+            if self.workers < 2: #or self.workers >= len(sents):
+                results = map(partial(self.process_chunk, keep_trees=cache is not None), chunks)
+            else:
+                # the workers get the reader (with the transition system and lexicon) once, only sentences are sent per chunk.
+                pool = worker_pool(self.workers, self)
+                process = partial(call_on_worker_object, "process_chunk", keep_trees=cache is not None)
+                results = bounded_imap(pool, process, chunks, self.max_chunks_in_flight)
+
+        trees = []
+        exhausted = False
+        try:
+            for result in results:
+                for instance, tree in result:
+                    if cache is not None:
+                        trees.append(tree)
+                    if instance is not None:
+                        yield instance
+                if progress is not None:
+                    progress.update(len(result))
+            exhausted = True
+        finally:
+            if pool is not None:
+                results.close() # has to happen before the pool is terminated
+                pool.terminate()
+            if progress is not None:
+                progress.close()
+            if cache is not None:
+                if exhausted:
+                    cache.write(trees)
+                else:
+                    logger.info("Not writing the instance cache for %s because the file was not read completely", file_path)
+
         delta = time.time() - t1
         logger.info(f"Reading took {round(delta,3)} seconds")
-        return [x for x in r if x is not None]
+
+    def process_chunk(self, sentences : List[AMSentence], keep_trees : bool = False) -> List[Tuple[Optional[Instance], Optional[PreprocessedTree]]]:
+        """
+        Creates the instances of some sentences, the instance is None for sentences that have to be skipped.
+        :param keep_trees: also return the result of preprocessing, otherwise None is returned in its place.
+        """
+        r = []
+        for am_sentence in sentences:
+            tree = self.preprocess_if_annotated(am_sentence)
+            instance = self.text_to_instance(am_sentence, tree) if self.keep_sentence(am_sentence, tree) else None
+            r.append((instance, tree if keep_trees else None))
+        return r
+
+    def process_cached_chunk(self, sentences : List[AMSentence], cached_trees : CachedTrees, start : int) -> List[Tuple[Optional[Instance], None]]:
+        """
+        Like process_chunk but takes the results of preprocessing from the instance cache.
+        :param start: index of the first sentence in the cache
+        """
+        r = []
+        for i, am_sentence in enumerate(sentences, start):
+            tree = cached_trees[i]
+            r.append((self.text_to_instance(am_sentence, tree) if self.keep_sentence(am_sentence, tree) else None, None))
+        return r
+
+    def keep_sentence(self, am_sentence : AMSentence, tree : Optional[PreprocessedTree]) -> bool:
+        """
+        Sentences that need preprocessing but couldn't be preprocessed (because they are not well-typed) are skipped.
+        """
+        return tree is not None or not self.needs_preprocessing(am_sentence)
+
+    def get_instance_cache(self, file_path : str, number_of_sentences : int) -> Optional[InstanceCache]:
+        if self.cache_directory is None or self.read_tokens_only:
+            return None
+        return InstanceCache(self.cache_directory, cached_path(file_path), self.transition_system, self.lexicon,
+                             {"sentences" : number_of_sentences, "run_oracle" : self.run_oracle,
+                              "fuzz" : self.fuzz, "fuzz_beam_search" : self.fuzz_beam_search})
+
+    def needs_preprocessing(self, am_sentence : AMSentence) -> bool:
+        return am_sentence.is_annotated() and not self.read_tokens_only
+
+    def preprocess_if_annotated(self, am_sentence : AMSentence) -> Optional[PreprocessedTree]:
+        if not self.needs_preprocessing(am_sentence):
+            return None
+        return self.preprocess(am_sentence.fix_dev_edge_labels())
 
     @overrides
     def text_to_instance(self,  # type: ignore
-                         am_sentence: AMSentence) -> Optional[Instance]:
+                         am_sentence: AMSentence, preprocessed : Optional[PreprocessedTree] = None) -> Optional[Instance]:
         # pylint: disable=arguments-differ
         """
         Parameters
@@ -111,6 +220,8 @@ class AMConllDatasetReader(OrderedDatasetReader):
             The index of this sentence in the corpus.
         am_sentence : ``AMSentence``, required.
             The words in the sentence to be encoded.
+        preprocessed : ``PreprocessedTree``, optional.
+            The result of preprocess for this sentence, computed if not given.
 
         Returns
         -------
@@ -138,8 +249,37 @@ class AMConllDatasetReader(OrderedDatasetReader):
             return Instance(fields)
 
         #We are dealing with training data, prepare it accordingly.
+        if preprocessed is None:
+            preprocessed = self.preprocess(am_sentence)
+            if preprocessed is None:
+                return None
+
+        # Create instance
+        seq = ListField([LabelField(position, skip_indexing=True) for position in preprocessed.column("seq").tolist()])
+        fields["seq"] = seq
+        fields["active_nodes"] = ListField(
+            [LabelField(active_node, skip_indexing=True) for active_node in preprocessed.active_nodes.tolist()])
+
+        for name in DECISION_COLUMNS[1:]:
+            fields[name] = SequenceLabelField(preprocessed.column(name).tolist(), seq)
+
+        fields["heads"] = SequenceLabelField(am_sentence.get_heads(), tokens)
+
+        fields["context"] = DenseContextField(preprocessed.contexts)
+
+        # fields["supertags"] = SequenceLabelField(am_sentence.get_supertags(), tokens, label_namespace=formalism+"_supertag_labels")
+        # fields["lexlabels"] = SequenceLabelField(am_sentence.get_lexlabels(), tokens, label_namespace=formalism+"_lex_labels")
+        # fields["head_tags"] = SequenceLabelField(am_sentence.get_edge_labels(),tokens, label_namespace=formalism+"_head_tags") #edge labels
+        # fields["head_indices"] = SequenceLabelField(am_sentence.get_heads(),tokens,label_namespace="head_index_tags")
 
-        if not is_welltyped(am_sentence):
+        return Instance(fields)
+
+    def preprocess(self, am_sentence : AMSentence) -> Optional[PreprocessedTree]:
+        """
+        Computes the decision sequence of an annotated sentence and the context before every decision,
+        validates it with the transition system. Returns None if the sentence is not well-typed.
+        """
+        if not self.type_checker.is_welltyped(am_sentence):
             print("Skipping non-well-typed AMDep tree.")
             print(am_sentence.get_tokens(shadow_art_root=False))
             return None
@@ -166,15 +306,7 @@ class AMConllDatasetReader(OrderedDatasetReader):
         state : ParsingState = self.transition_system.initial_state(stripped_sentence, None)
         active_nodes = [0]
 
-        contexts = dict()
         for i in range(1, len(decisions)):
-            #Gather context
-            context = state.gather_context(None) #device: cpu
-            for k, v in context.items():
-                if k not in contexts:
-                    contexts[k] = []
-                contexts[k].append(v.cpu().numpy())
-
             state = self.transition_system.step(state, decisions[i], in_place=True)
 
             if i == len(decisions) - 1:  # there are no further active nodes after this step
@@ -187,6 +319,8 @@ class AMConllDatasetReader(OrderedDatasetReader):
 
         assert self.transition_system.check_correct(am_sentence, reconstructed), f"Could not reconstruct this sentence\n: {am_sentence.get_tokens(False)}"
 
+        contexts = self.transition_system.gold_context(am_sentence, decisions)
+
         if self.run_oracle:
             ## Now with oracle scores:
             stripped_sentence = am_sentence.strip_annotation()
@@ -215,7 +349,7 @@ class AMConllDatasetReader(OrderedDatasetReader):
                 state = self.transition_system.step(state, decision, in_place=True)
 
             assert state.is_complete()
-            assert (not self.transition_system.guarantees_well_typedness()) or is_welltyped(state.extract_tree())
+            assert (not self.transition_system.guarantees_well_typedness()) or self.type_checker.is_welltyped(state.extract_tree())
             torch.random.set_rng_state(rng_state)
 
         if self.fuzz_beam_search:
@@ -230,40 +364,19 @@ class AMConllDatasetReader(OrderedDatasetReader):
                 state = self.transition_system.step(state, decision, in_place=True)
 
             assert state.is_complete()
-            assert (not self.transition_system.guarantees_well_typedness()) or is_welltyped(state.extract_tree())
+            assert (not self.transition_system.guarantees_well_typedness()) or self.type_checker.is_welltyped(state.extract_tree())
             torch.random.set_rng_state(rng_state)
 
         ##################################################################
 
-        # Create instance
-        seq = ListField([LabelField(decision.position, skip_indexing=True) for decision in decisions])
-        fields["seq"] = seq
-        fields["active_nodes"] = ListField(
-            [LabelField(active_node, skip_indexing=True) for active_node in active_nodes])
-
-        fields["labels"] = SequenceLabelField([self.lexicon.get_id("edge_labels",decision.label) for decision in decisions], seq)
-        fields["label_mask"] = SequenceLabelField([int(decision.label != "") for decision in decisions], seq)
-
-        fields["term_types"] = SequenceLabelField([self.lexicon.get_id("term_types", str(decision.termtyp)) if decision.termtyp is not None else 0 for decision in decisions], seq)
-
-        fields["term_type_mask"] = SequenceLabelField([int(decision.termtyp is not None) for decision in decisions], seq)
-
-        fields["lex_labels"] = SequenceLabelField([self.lexicon.get_id("lex_labels", decision.lexlabel) for decision in decisions], seq)
-        fields["lex_label_mask"] = SequenceLabelField([int(decision.lexlabel != "") for decision in decisions], seq)
-
-        fields["supertags"] = SequenceLabelField([self.lexicon.get_id("constants","--TYPE--".join(decision.supertag)) for decision in decisions], seq)
-
-        fields["supertag_mask"] = SequenceLabelField([int(decision.supertag[1] != "") for decision in decisions], seq)
-
-        fields["heads"] = SequenceLabelField(am_sentence.get_heads(), tokens)
-
-        fields["context"] = ContextField(
-            {name: ListField([ArrayField(array, dtype=array.dtype) for array in liste]) for name, liste in
-             contexts.items()})
-
-        # fields["supertags"] = SequenceLabelField(am_sentence.get_supertags(), tokens, label_namespace=formalism+"_supertag_labels")
-        # fields["lexlabels"] = SequenceLabelField(am_sentence.get_lexlabels(), tokens, label_namespace=formalism+"_lex_labels")
-        # fields["head_tags"] = SequenceLabelField(am_sentence.get_edge_labels(),tokens, label_namespace=formalism+"_head_tags") #edge labels
-        # fields["head_indices"] = SequenceLabelField(am_sentence.get_heads(),tokens,label_namespace="head_index_tags")
-
-        return Instance(fields)
+        decisions_array = np.array([[decision.position,
+                                     self.lexicon.get_id("edge_labels",decision.label),
+                                     int(decision.label != ""),
+                                     self.lexicon.get_id("term_types", str(decision.termtyp)) if decision.termtyp is not None else 0,
+                                     int(decision.termtyp is not None),
+                                     self.lexicon.get_id("lex_labels", decision.lexlabel),
+                                     int(decision.lexlabel != ""),
+                                     self.lexicon.get_id("constants","--TYPE--".join(decision.supertag)),
+                                     int(decision.supertag[1] != "")] for decision in decisions], dtype=np.int64)
+
+        return PreprocessedTree(decisions_array, np.array(active_nodes, dtype=np.int64), contexts)
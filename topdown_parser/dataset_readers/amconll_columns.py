@@ -0,0 +1,186 @@
+from typing import List, Dict, Optional, Iterable, Iterator
+
+import numpy as np
+
+# string columns of an amconll file (besides the id, head and aligned columns)
+COLUMNS = ["token", "replacement", "lemma", "pos_tag", "ner_tag", "fragment", "lexlabel", "typ", "label", "range"]
+
+NO_STRING = -1 # id used for missing token ranges
+
+
+class StringTable:
+    """
+    Interns strings to consecutive ids. Can be shared between corpora so that ids are comparable.
+    """
+
+    def __init__(self):
+        self.strings : List[str] = []
+        self.ids : Dict[str, int] = dict()
+
+    def intern(self, s : str) -> int:
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(s)
+            self.ids[s] = i
+        return i
+
+    def get_id(self, s : str) -> int:
+        """
+        Id of the string or NO_STRING if it was never interned.
+        """
+        return self.ids.get(s, NO_STRING)
+
+    def lookup(self, ids : np.array) -> List[Optional[str]]:
+        strings = self.strings
+        return [strings[i] if i != NO_STRING else None for i in ids.tolist()]
+
+    def __len__(self) -> int:
+        return len(self.strings)
+
+
+class AMConllColumns:
+    """
+    A whole amconll file in columnar form: one integer array of string ids per column, an array of heads,
+    sentence offsets (the tokens of sentence i are offsets[i]:offsets[i+1]) and the attributes of every sentence.
+    AMSentence objects are only created when a sentence is accessed.
+    """
+
+    def __init__(self, strings : StringTable, columns : Dict[str, np.array], heads : np.array, aligned : np.array,
+                 offsets : np.array, attributes : List[Dict[str, str]]):
+        self.strings = strings
+        self.columns = columns
+        self.heads = heads
+        self.aligned = aligned
+        self.offsets = offsets
+        self.attributes = attributes
+
+    def __len__(self) -> int:
+        return len(self.attributes)
+
+    def sentence_lengths(self) -> np.array:
+        return np.diff(self.offsets)
+
+    def column(self, name : str, i : Optional[int] = None) -> np.array:
+        """
+        String ids of the column, for sentence i or for the whole corpus if i is None.
+        """
+        if i is None:
+            return self.columns[name]
+        return self.columns[name][self.offsets[i]:self.offsets[i+1]]
+
+    def get_heads(self, i : int) -> np.array:
+        return self.heads[self.offsets[i]:self.offsets[i+1]]
+
+    def sentence(self, i : int) -> "AMSentence":
+        return self.sentences(i, i+1)[0]
+
+    def sentences(self, start : int = 0, end : Optional[int] = None) -> List["AMSentence"]:
+        """
+        Creates the AMSentences with indices start to end (exclusive).
+        """
+        from .amconll_tools import AMSentence
+
+        if end is None:
+            end = len(self)
+        first, last = self.offsets[start], self.offsets[end]
+        cols = [self.strings.lookup(self.columns[name][first:last]) for name in COLUMNS]
+        # same order as the fields of Entry
+        cols = cols[:8] + [self.heads[first:last].tolist(), cols[8], self.aligned[first:last].tolist(), cols[9]]
+        offsets = (self.offsets[start:end+1] - first).tolist()
+        return [AMSentence.from_columns([col[offsets[j]:offsets[j+1]] for col in cols], dict(self.attributes[start+j]))
+                for j in range(end-start)]
+
+    def __getitem__(self, i : int) -> "AMSentence":
+        return self.sentence(i)
+
+    def __iter__(self) -> Iterator["AMSentence"]:
+        chunk_size = 1024
+        for start in range(0, len(self), chunk_size):
+            yield from self.sentences(start, min(len(self), start+chunk_size))
+
+    def check_validity(self) -> None:
+        """
+        Same checks as AMSentence.check_validity for all sentences at once.
+        """
+        if len(self) == 0:
+            return
+        lengths = self.sentence_lengths()
+        starts = self.offsets[:-1]
+        heads_ok = (self.heads >= 0) & (self.heads <= np.repeat(lengths, lengths))
+        label = self.columns["label"]
+        on_root = self.heads == 0
+        is_root = on_root & (label == self.strings.get_id("ROOT"))
+        unannotated = on_root & ((label == self.strings.get_id("IGNORE")) | (label == self.strings.get_id("_")))
+
+        valid = np.logical_and.reduceat(heads_ok, starts) & (np.logical_or.reduceat(is_root, starts) |
+                                                            np.logical_and.reduceat(unannotated, starts))
+        for i in np.flatnonzero(~valid):
+            self.sentence(i).check_validity() # raises the error
+            raise AssertionError(f"Invalid sentence {i}") # pragma: no cover
+
+
+def read_amconll_columns(fil : Iterable[str], validate : bool = True, strings : Optional[StringTable] = None) -> AMConllColumns:
+    """
+    Reads a file in amconll format into columns.
+    :param fil: lines of the file
+    :param validate: perform the same checks as AMSentence.check_validity
+    :param strings: table to intern the strings in, a new one is created if None.
+    :return:
+    """
+    if strings is None:
+        strings = StringTable()
+    intern = strings.intern
+
+    columns : List[List[int]] = [[] for _ in COLUMNS]
+    token, replacement, lemma, pos_tag, ner_tag, fragment, lexlabel, typ, label, ranges = columns
+    heads : List[int] = []
+    aligned : List[bool] = []
+    offsets = [0]
+    all_attributes : List[Dict[str, str]] = []
+
+    expect_header = True
+    attributes = dict()
+    sentence_start = 0
+    for line in fil:
+        line = line.rstrip("\n")
+        if line.strip() == "":
+            # sentence finished
+            if len(heads) > sentence_start:
+                offsets.append(len(heads))
+                all_attributes.append(attributes)
+            sentence_start = len(heads)
+            expect_header = True
+            attributes = dict()
+            continue
+
+        if expect_header:
+            if line.startswith("#"):
+                key, val = line[1:].split(":", maxsplit=1)
+                attributes[key] = val
+                continue
+            expect_header = False
+
+        fields = line.split("\t")
+        assert len(fields) == 12 or len(fields) == 13
+        token.append(intern(fields[1]))
+        replacement.append(intern(fields[2]))
+        lemma.append(intern(fields[3]))
+        pos_tag.append(intern(fields[4]))
+        ner_tag.append(intern(fields[5]))
+        fragment.append(intern(fields[6]))
+        lexlabel.append(intern(fields[7]))
+        typ.append(intern(fields[8]))
+        heads.append(int(fields[9]))
+        label.append(intern(fields[10]))
+        aligned.append(bool(fields[11]))
+        ranges.append(intern(fields[12]) if len(fields) == 13 else NO_STRING)
+
+    # like parse_amconll, a sentence that is not followed by an empty line is ignored.
+    n = offsets[-1]
+    corpus = AMConllColumns(strings, {name : np.array(col[:n], dtype=np.int64) for name, col in zip(COLUMNS, columns)},
+                            np.array(heads[:n], dtype=np.int64), np.array(aligned[:n], dtype=np.bool_),
+                            np.array(offsets, dtype=np.int64), all_attributes)
+    if validate:
+        corpus.check_validity()
+    return corpus
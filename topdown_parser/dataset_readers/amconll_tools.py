@@ -1,5 +1,5 @@
 import subprocess
-from typing import List, Dict, Tuple, Iterable, Union, Optional, Set
+from typing import List, Dict, Tuple, Iterable, Union, Optional, Set, Any
 
 from dataclasses import dataclass
 import os
@@ -28,11 +28,67 @@ class Entry:
                      self.typ, self.head, self.label, self.aligned, self.range])
 
 
-@dataclass
+# positions of the columns of an AMSentence, same order as the fields of Entry.
+TOKEN, REPLACEMENT, LEMMA, POS_TAG, NER_TAG, FRAGMENT, LEXLABEL, TYP, HEAD, LABEL, ALIGNED, RANGE = range(12)
+COLUMN_NAMES = ["token", "replacement", "lemma", "pos_tag", "ner_tag", "fragment", "lexlabel", "typ", "head", "label", "aligned", "range"]
+
+
 class AMSentence:
-    """Represents a sentence"""
-    words: List[Entry]
-    attributes: Dict[str, str]
+    """
+    Represents a sentence.
+    The annotation is stored column-wise (one list per field of Entry). Columns are never modified in place,
+    methods that change the annotation return a new AMSentence that shares the unchanged columns.
+    """
+
+    def __init__(self, words: List[Entry], attributes: Dict[str, str]):
+        if words:
+            columns = [list(column) for column in zip(*words)]
+        else:
+            columns = [[] for _ in COLUMN_NAMES]
+        self.columns : List[List[Any]] = columns
+        self.attributes = attributes
+        self._words : Optional[List[Entry]] = None
+
+    @staticmethod
+    def from_columns(columns : List[List[Any]], attributes : Dict[str, str]) -> "AMSentence":
+        """
+        Creates a sentence from columns (in the order of COLUMN_NAMES) without copying them.
+        """
+        assert len(columns) == len(COLUMN_NAMES)
+        sent = AMSentence.__new__(AMSentence)
+        sent.columns = columns
+        sent.attributes = attributes
+        sent._words = None
+        return sent
+
+    def _replace_columns(self, changes : Dict[int, List[Any]]) -> "AMSentence":
+        columns = list(self.columns)
+        for i, column in changes.items():
+            columns[i] = column
+        return AMSentence.from_columns(columns, self.attributes)
+
+    @property
+    def words(self) -> List[Entry]:
+        if self._words is None:
+            self._words = [Entry(*fields) for fields in zip(*self.columns)]
+        return self._words
+
+    def column(self, name : str) -> List[Any]:
+        """
+        The values of a field of Entry for all words, must not be modified.
+        """
+        return self.columns[COLUMN_NAMES.index(name)]
+
+    def __getstate__(self):
+        return {"columns" : self.columns, "attributes" : self.attributes}
+
+    def __setstate__(self, state):
+        self.columns = state["columns"]
+        self.attributes = state["attributes"]
+        self._words = None
+
+    def __repr__(self):
+        return f"AMSentence(words={self.words!r}, attributes={self.attributes!r})"
 
     def __iter__(self):
         return iter(self.words)
@@ -44,97 +100,99 @@ class AMSentence:
     def __eq__(self, other):
         if not isinstance(other, AMSentence):
             return False
-        if len(self.words) != len(other.words):
+        if len(self) != len(other):
             return False
         if self.attributes != other.attributes:
             return False
 
-        return all( w==o for w,o in zip(self.words, other.words))
+        return self.columns == other.columns
 
     def normalize_types(self) -> "AMSentence":
         """
         Parse the types and convert them to strings again to normalize them.
         :return:
         """
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, word.fragment, word.lexlabel,
-                                 str(AMType.parse_str(word.typ)), word.head, word.label, word.aligned,word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        return self._replace_columns({TYP : [str(AMType.parse_str(typ)) for typ in self.columns[TYP]]})
 
     def get_tokens(self, shadow_art_root) -> List[str]:
-        r = [word.token for word in self.words]
+        r = list(self.columns[TOKEN])
         if shadow_art_root and r[-1] == "ART-ROOT":
             r[-1] = "."
         return r
 
     def get_replacements(self) -> List[str]:
-        return [word.replacement for word in self.words]
+        return list(self.columns[REPLACEMENT])
 
     def get_pos(self) -> List[str]:
-        return [word.pos_tag for word in self.words]
+        return list(self.columns[POS_TAG])
 
     def get_lemmas(self) -> List[str]:
-        return [word.lemma for word in self.words]
+        return list(self.columns[LEMMA])
 
     def get_ner(self) -> List[str]:
-        return [word.ner_tag for word in self.words]
+        return list(self.columns[NER_TAG])
 
     def get_supertags(self) -> List[str]:
-        return [word.fragment+"--TYPE--"+word.typ for word in self.words]
+        return [fragment+"--TYPE--"+typ for fragment, typ in zip(self.columns[FRAGMENT], self.columns[TYP])]
 
     def get_lexlabels(self) -> List[str]:
-        return [word.lexlabel for word in self.words]
+        return list(self.columns[LEXLABEL])
 
     def get_ranges(self) -> List[str]:
-        return [word.range for word in self.words]
+        return list(self.columns[RANGE])
 
     def get_heads(self)-> List[int]:
-        return [word.head for word in self.words]
+        return list(self.columns[HEAD])
 
     def get_edge_labels(self) -> List[str]:
-        return [word.label if word.label != "_" else "IGNORE" for word in self.words] #this is a hack :(, which we need because the dev data contains _
+        return [label if label != "_" else "IGNORE" for label in self.columns[LABEL]] #this is a hack :(, which we need because the dev data contains _
 
     def fix_dev_edge_labels(self) -> "AMSentence":
         """
         Fixes the above problem with edge labels for dev data
         :return:
         """
-        labels = self.get_edge_labels()
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, word.fragment, word.lexlabel,
-                                 word.typ, word.head, labels[i], word.aligned,word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        return self._replace_columns({LABEL : self.get_edge_labels()})
+
+    def with_annotation(self, heads : Optional[List[int]] = None, labels : Optional[List[str]] = None,
+                        supertags : Optional[List[Tuple[str,str]]] = None, lexlabels : Optional[List[str]] = None) -> "AMSentence":
+        """
+        Replaces the given parts of the annotation at once (None = keep), all other columns are shared with this sentence.
+        :param supertags: tuples of graph fragment and type
+        """
+        n = len(self)
+        changes = dict()
+        if heads is not None:
+            assert len(heads) == n, f"number of heads must agree with number of words but got {len(heads)} and {n}"
+            assert all( h >= 0 and h <= n for h in heads), f"heads must be in range 0 to {n} but got heads {heads}"
+            changes[HEAD] = list(heads)
+        if labels is not None:
+            assert len(labels) == n, f"number of lexical labels must agree with number of words but got {len(labels)} and {n}"
+            changes[LABEL] = list(labels)
+        if supertags is not None:
+            assert len(supertags) == n, f"number of supertags must agree with number of words but got {len(supertags)} and {n}"
+            changes[FRAGMENT] = [supertag[0] for supertag in supertags]
+            changes[TYP] = [supertag[1] for supertag in supertags]
+        if lexlabels is not None:
+            assert len(lexlabels) == n, f"number of lexical labels must agree with number of words but got {len(lexlabels)} and {n}"
+            changes[LEXLABEL] = list(lexlabels)
+        return self._replace_columns(changes)
 
     def set_lexlabels(self, labels : List[str]) -> "AMSentence":
-        assert len(labels) == len(self.words), f"number of lexical labels must agree with number of words but got {len(labels)} and {len(self.words)}"
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, word.fragment, labels[i],
-                                 word.typ, word.head, word.label, word.aligned,word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        return self.with_annotation(lexlabels=labels)
 
     def set_labels(self, labels : List[str]) -> "AMSentence":
-        assert len(labels) == len(self.words), f"number of lexical labels must agree with number of words but got {len(labels)} and {len(self.words)}"
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, word.fragment, word.lexlabel,
-                                 word.typ, word.head, labels[i], word.aligned,word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        return self.with_annotation(labels=labels)
 
     def set_supertags(self, supertags : List[str]):
-        assert len(supertags) == len(self.words), f"number of supertags must agree with number of words but got {len(supertags)} and {len(self.words)}"
-        split = [ tag.split("--TYPE--") for tag in supertags]
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, split[i][0], word.lexlabel,
-                                 split[i][1], word.head, word.label, word.aligned,word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        assert len(supertags) == len(self), f"number of supertags must agree with number of words but got {len(supertags)} and {len(self)}"
+        return self.with_annotation(supertags=[tag.split("--TYPE--") for tag in supertags])
 
     def set_supertag_tuples(self, supertags : List[Tuple[str,str]]):
-        assert len(supertags) == len(self.words), f"number of supertags must agree with number of words but got {len(supertags)} and {len(self.words)}"
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, supertags[i][0], word.lexlabel,
-                                 supertags[i][1], word.head, word.label, word.aligned,word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        return self.with_annotation(supertags=supertags)
 
     def set_heads(self, heads : List[int]) -> "AMSentence":
-        assert len(heads) == len(self.words), f"number of heads must agree with number of words but got {len(heads)} and {len(self.words)}"
-        assert all( h >= 0 and h <= len(self.words) for h in heads), f"heads must be in range 0 to {len(self.words)} but got heads {heads}"
-
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, word.fragment, word.lexlabel,
-                                 word.typ, heads[i], word.label, word.aligned, word.range)
-                           for i,word in enumerate(self.words)],self.attributes)
+        return self.with_annotation(heads=heads)
 
 
     @staticmethod
@@ -150,17 +208,19 @@ class AMSentence:
 
     def check_validity(self):
         """Checks if representation makes sense, doesn't do AM algebra type checking"""
-        assert len(self.words) > 0, "Sentence is empty"
-        for entry in self.words:
-            assert entry.head in range(len(self.words) + 1), f"head of {entry} is not in sentence range"
-        has_root = any(w.label == "ROOT" and w.head == 0 for w in self.words)
+        assert len(self) > 0, "Sentence is empty"
+        heads = self.columns[HEAD]
+        labels = self.columns[LABEL]
+        for i, head in enumerate(heads):
+            assert head in range(len(self) + 1), f"head of {self.words[i]} is not in sentence range"
+        has_root = any(label == "ROOT" and head == 0 for head, label in zip(heads, labels))
         if not has_root:
-            assert all((w.label == "IGNORE" or w.label=="_") and w.head == 0 for w in self.words), f"Sentence doesn't have a root but seems annotated with trees:\n {self}"
+            assert all((label == "IGNORE" or label=="_") and head == 0 for head, label in zip(heads, labels)), f"Sentence doesn't have a root but seems annotated with trees:\n {self}"
 
     def strip_annotation(self) -> "AMSentence":
-        return AMSentence([Entry(word.token, word.replacement, word.lemma, word.pos_tag, word.ner_tag, "_", "_",
-                                 "_", 0, "IGNORE", word.aligned, word.range)
-                           for word in self.words],self.attributes)
+        n = len(self)
+        return self._replace_columns({FRAGMENT : ["_"] * n, LEXLABEL : ["_"] * n, TYP : ["_"] * n,
+                                      HEAD : [0] * n, LABEL : ["IGNORE"] * n})
 
     def children_dict(self) -> Dict[int, List[int]]:
         """
@@ -168,9 +228,8 @@ class AMSentence:
         :return:
         """
         r = dict()
-        for i in range(len(self.words)):
-            head = self.words[i].head # head is 1-based
-            if self.words[i].label != "IGNORE":
+        for i, (head, label) in enumerate(zip(self.columns[HEAD], self.columns[LABEL])): # head is 1-based
+            if label != "IGNORE":
                 if head not in r:
                     r[head] = []
                 r[head].append(i+1) #make current position 1-based
@@ -181,26 +240,33 @@ class AMSentence:
         Returns the index of the root, 0-based.
         :return:
         """
-        for i,e in enumerate(self.words):
-            if e.head == 0 and e.label == "ROOT":
+        for i, (head, label) in enumerate(zip(self.columns[HEAD], self.columns[LABEL])):
+            if head == 0 and label == "ROOT":
                 return i
 
     def __str__(self):
         r = []
         if self.attributes:
             r.append("\n".join(f"#{attr}:{val}" for attr, val in self.attributes.items()))
-        for i, w in enumerate(self.words, 1):
-            fields = list(w)
-            if fields[-1] is None:
-                fields = fields[:-1] #when token range not present -> remove it
-            r.append("\t".join([str(x) for x in [i] + fields]))
+        ranges = self.columns[RANGE]
+        if all(x is None for x in ranges) or all(x is not None for x in ranges):
+            columns = [range(1, len(self)+1)] + self.columns[:RANGE]
+            if len(ranges) > 0 and ranges[0] is not None:
+                columns.append(ranges)
+            r.extend("\t".join(fields) for fields in zip(*[map(str, column) for column in columns]))
+        else:
+            for i, w in enumerate(self.words, 1):
+                fields = list(w)
+                if fields[-1] is None:
+                    fields = fields[:-1] #when token range not present -> remove it
+                r.append("\t".join([str(x) for x in [i] + fields]))
         return "\n".join(r)
 
     def is_annotated(self):
-        return not all((w.label == "_" or w.label == "IGNORE") and w.head == 0 for w in self.words)
+        return not all((label == "_" or label == "IGNORE") and head == 0 for head, label in zip(self.columns[HEAD], self.columns[LABEL]))
 
     def __len__(self):
-        return len(self.words)
+        return len(self.columns[TOKEN])
 
     def displacy_svg(self):
         from ..svg.dot_tools import penman_to_dot, parse_penman
@@ -247,14 +313,14 @@ def parse_amconll(fil, validate:bool = True) -> Iterable[AMSentence]:
     """
     expect_header = True
     new_sentence = True
-    entries = []
+    columns = [[] for _ in COLUMN_NAMES]
     attributes = dict()
     for line in fil:
         line = line.rstrip("\n")
         if line.strip() == "":
             # sentence finished
-            if len(entries) > 0:
-                sent = AMSentence(entries, attributes)
+            if len(columns[TOKEN]) > 0:
+                sent = AMSentence.from_columns(columns, attributes)
                 if validate:
                     sent.check_validity()
                 yield sent
@@ -263,7 +329,7 @@ def parse_amconll(fil, validate:bool = True) -> Iterable[AMSentence]:
         if new_sentence:
             expect_header = True
             attributes = dict()
-            entries = []
+            columns = [[] for _ in COLUMN_NAMES]
             new_sentence = False
             if line.strip() == "":
                 continue
@@ -278,17 +344,9 @@ def parse_amconll(fil, validate:bool = True) -> Iterable[AMSentence]:
         if not expect_header:
             fields = line.split("\t")
             assert len(fields) == 12 or len(fields) == 13
-            if len(fields) == 12 : #id + entry but no token ranges
-                entries.append(
-                    Entry(fields[1], fields[2], fields[3], fields[4], fields[5], fields[6], fields[7], fields[8],
-                          int(fields[9]), fields[10], bool(fields[11]),None))
-            elif len(fields) == 13:
-                entries.append(
-                    Entry(fields[1], fields[2], fields[3], fields[4], fields[5], fields[6], fields[7], fields[8],
-                          int(fields[9]), fields[10], bool(fields[11]),fields[12]))
-
-
-
-
-
-
+            for column, value in zip(columns[:HEAD], fields[1:9]):
+                column.append(value)
+            columns[HEAD].append(int(fields[9]))
+            columns[LABEL].append(fields[10])
+            columns[ALIGNED].append(bool(fields[11]))
+            columns[RANGE].append(fields[12] if len(fields) == 13 else None) # no token ranges if only 12 fields
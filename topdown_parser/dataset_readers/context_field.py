@@ -1,5 +1,6 @@
 from typing import Dict, List
 
+import numpy as np
 import torch
 from allennlp.data import Field, DataArray, Vocabulary
 from allennlp.data.fields import ListField
@@ -43,4 +44,41 @@ class ContextField(Field):
 
     def index(self, vocab: Vocabulary):
         for subf in self.data.values():
-            subf.index(vocab)
\ No newline at end of file
+            subf.index(vocab)
+
+
+class DenseContextField(Field):
+    """
+    Like a ContextField of ListFields of ArrayFields but every subfield is a single array
+    of shape (number of steps, ...), see TransitionSystem.gold_context.
+    Padding and batching happen on the whole arrays. The batched tensors have the same shape as those of the ContextField,
+    i.e. (batch_size, number of steps, ...).
+    """
+
+    def __init__(self, data : Dict[str, np.array]) -> None:
+        self.data = data
+
+    def get_padding_lengths(self) -> Dict[str, int]:
+        ret = {}
+        for name, array in self.data.items():
+            for dim, length in enumerate(array.shape):
+                ret[name+SEPARATOR+str(dim)] = length
+        return ret
+
+    def as_tensor(self, padding_lengths: Dict[str, int]) -> DataArray:
+        ret = dict()
+        for name, array in self.data.items():
+            shape = tuple(padding_lengths[name+SEPARATOR+str(dim)] for dim in range(array.ndim))
+            padded = np.zeros(shape, dtype=array.dtype)
+            padded[tuple(slice(0, length) for length in array.shape)] = array
+            ret[name] = torch.from_numpy(padded)
+        return ret
+
+    def empty_field(self) -> 'Field':
+        return DenseContextField({name: np.zeros((0,) + array.shape[1:], dtype=array.dtype) for name, array in self.data.items()})
+
+    def batch_tensors(self, tensor_list: List[DataArray]) -> DataArray:
+        return {name: torch.stack([elem[name] for elem in tensor_list]) for name in self.data.keys()}
+
+    def index(self, vocab: Vocabulary):
+        pass
@@ -0,0 +1,174 @@
+from typing import Iterable, List, Optional
+import logging
+import random
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.common.util import is_lazy
+from allennlp.data.instance import Instance
+from allennlp.data.iterators.data_iterator import DataIterator
+from allennlp.data.dataset import Batch
+
+import numpy as np
+
+from .same_formalism_iterator import split_by_formalism
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def number_of_decisions(instance : Instance) -> int:
+    """
+    Length of the decision sequence of a training instance, 2n+1 (the usual length) for instances without decisions.
+    """
+    if "seq" in instance.fields:
+        return len(instance.fields["seq"].field_list)
+    return 2 * instance.fields["words"].sequence_length() + 1
+
+
+class BudgetIterator(DataIterator):
+    """
+    Like SameFormalismIterator, batches contain only one formalism. Instead of a fixed batch size,
+    a batch contains as many instances as fit into a budget, where the cost of a batch depends on the number of instances
+    and the padded length (see batch_cost). Instances are sorted by length (with some noise) so that there is little padding.
+    """
+    def __init__(self, formalisms: List[str],
+                 max_batch_size : Optional[int] = None,
+                 cache_instances:bool = False,
+                 track_epoch:bool = False,
+                 padding_noise:float = 0.1,
+                 instances_per_epoch:int = None,
+                 max_instances_in_memory: int  = None,
+                 biggest_batch_first: bool = False):
+        """
+        :param max_batch_size: optional upper limit on the number of instances in a batch
+        """
+        # the batch size is only used for reading lazy datasets in chunks
+        super().__init__(cache_instances=cache_instances,
+                         track_epoch=track_epoch,
+                         batch_size=max_batch_size if max_batch_size is not None else 32,
+                         instances_per_epoch=instances_per_epoch,
+                         max_instances_in_memory=max_instances_in_memory)
+        self.formalisms = formalisms
+        self.max_batch_size = max_batch_size
+        self.padding_noise = padding_noise
+        self.biggest_batch_first = biggest_batch_first
+
+    def length(self, instance : Instance) -> int:
+        raise NotImplementedError()
+
+    def batch_cost(self, batch_size : int, padded_length : int) -> float:
+        raise NotImplementedError()
+
+    def budget(self) -> float:
+        raise NotImplementedError()
+
+    def _group(self, instances : List[Instance], noise : bool) -> List[List[Instance]]:
+        """
+        Sorts the instances of one formalism by length and splits them into batches that fit into the budget.
+        """
+        lengths = np.array([self.length(instance) for instance in instances])
+        keys = lengths.astype(float)
+        if noise and self.padding_noise > 0:
+            keys = keys * (1 + np.random.uniform(-self.padding_noise, self.padding_noise, len(keys)))
+        order = np.argsort(keys, kind="stable")
+
+        budget = self.budget()
+        batches = []
+        current = []
+        padded_length = 0
+        for i in order.tolist():
+            new_padded_length = max(padded_length, lengths[i])
+            fits = self.batch_cost(len(current) + 1, new_padded_length) <= budget and \
+                   (self.max_batch_size is None or len(current) < self.max_batch_size)
+            if current and not fits:
+                batches.append(current)
+                current = []
+                new_padded_length = lengths[i]
+            if not current and self.batch_cost(1, lengths[i]) > budget:
+                logger.warning(f"An instance of length {lengths[i]} exceeds the budget of {budget}, it gets a batch of its own.")
+            current.append(instances[i])
+            padded_length = new_padded_length
+        if current:
+            batches.append(current)
+        return batches
+
+    def get_num_batches(self, instances: Iterable[Instance]) -> int:
+        if is_lazy(instances) or self._instances_per_epoch is not None:
+            return super().get_num_batches(instances)
+        return sum(len(self._group(formalism_instances, noise=False))
+                   for formalism_instances in split_by_formalism(instances).values())
+
+    def _create_batches(self, instances: Iterable[Instance], shuffle: bool) -> Iterable[Batch]:
+        # First break the dataset into memory-sized lists:
+        for instance_list in self._memory_sized_lists(instances):
+            instances_by_formalism = split_by_formalism(instance_list)
+            for formalism in instances_by_formalism:
+                if formalism not in self.formalisms:
+                    raise ConfigurationError(f"Unexpected formalism {formalism}, expected one of {self.formalisms}")
+
+            batches_by_formalism = []
+            for formalism, formalism_instances in instances_by_formalism.items():
+                batches = self._group(formalism_instances, noise=shuffle)
+                # the last batch has the longest instances and uses most memory
+                longest = batches.pop() if self.biggest_batch_first else None
+                if shuffle:
+                    random.shuffle(batches)
+                if longest is not None:
+                    batches.insert(0, longest)
+                batches_by_formalism.append(batches)
+
+            positions = [0] * len(batches_by_formalism)
+            available_batches = np.array([len(batches) for batches in batches_by_formalism])
+            while any(x > 0 for x in available_batches):
+                #select formalism of batch with probability proportional to number of batches left of this formalism.
+                formalism = np.random.choice(range(len(batches_by_formalism)), p = available_batches/np.sum(available_batches))
+                batch = batches_by_formalism[formalism][positions[formalism]]
+                positions[formalism] += 1
+                available_batches[formalism] -= 1
+                yield Batch(batch)
+
+
+@DataIterator.register("decision_budget")
+class DecisionBudgetIterator(BudgetIterator):
+    """
+    Batches for training under a budget of batch size * padded number of decisions * decision cost <= max_decisions.
+
+    The decision cost is 1, or, if vocab_namespaces are given, the sum of the vocabulary sizes of these namespaces
+    (e.g. when the scores over large label vocabularies dominate the cost of a decision). In that case, max_decisions
+    has to be chosen accordingly.
+    """
+    def __init__(self, formalisms: List[str],
+                 max_decisions : int,
+                 max_batch_size : Optional[int] = None,
+                 vocab_namespaces : Optional[List[str]] = None,
+                 cache_instances:bool = False,
+                 track_epoch:bool = False,
+                 padding_noise:float = 0.1,
+                 instances_per_epoch:int = None,
+                 max_instances_in_memory: int  = None,
+                 biggest_batch_first: bool = False):
+        """
+        :param max_decisions: budget of a batch
+        :param max_batch_size: optional upper limit on the number of instances in a batch
+        :param vocab_namespaces: namespaces whose vocabulary sizes make up the cost of a decision
+        """
+        if max_decisions < 1:
+            raise ConfigurationError("max_decisions must be positive")
+        super().__init__(formalisms, max_batch_size, cache_instances=cache_instances, track_epoch=track_epoch,
+                         padding_noise=padding_noise, instances_per_epoch=instances_per_epoch,
+                         max_instances_in_memory=max_instances_in_memory, biggest_batch_first=biggest_batch_first)
+        self.max_decisions = max_decisions
+        self.vocab_namespaces = vocab_namespaces
+
+    def decision_cost(self) -> int:
+        if not self.vocab_namespaces:
+            return 1
+        return sum(self.vocab.get_vocab_size(namespace) for namespace in self.vocab_namespaces)
+
+    def length(self, instance : Instance) -> int:
+        return number_of_decisions(instance)
+
+    def batch_cost(self, batch_size : int, padded_length : int) -> float:
+        return batch_size * padded_length * self.decision_cost()
+
+    def budget(self) -> float:
+        return self.max_decisions
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+
+from .additional_lexicon import AdditionalLexicon
+from ..transition_systems.transition_system import TransitionSystem
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+FORMAT_VERSION = 2
+
+# columns of PreprocessedTree.decisions
+DECISION_COLUMNS = ["seq", "labels", "label_mask", "term_types", "term_type_mask",
+                    "lex_labels", "lex_label_mask", "supertags", "supertag_mask"]
+
+
+@dataclass
+class PreprocessedTree:
+    """
+    What the dataset reader computes from a gold AM dependency tree: the decision sequence as ids,
+    the active nodes and the context gathered before each decision (except the first).
+    """
+    decisions : np.array # shape (number of decisions, len(DECISION_COLUMNS))
+    active_nodes : np.array # shape (number of decisions - 1,)
+    contexts : Dict[str, np.array] # shape (number of decisions - 1, ...), see TransitionSystem.gold_context
+
+    def column(self, name : str) -> np.array:
+        return self.decisions[:, DECISION_COLUMNS.index(name)]
+
+
+def file_hash(file_path : str) -> str:
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def transition_system_config(transition_system : TransitionSystem) -> Dict[str, Any]:
+    """
+    Class and the simple attributes (e.g. children_order, pop_with_0) of the transition system.
+    """
+    config = {k : v for k, v in vars(transition_system).items() if isinstance(v, (str, int, float, bool, type(None)))}
+    config["type"] = type(transition_system).__module__ + "." + type(transition_system).__qualname__
+    return config
+
+
+def lexicon_hash(lexicon : AdditionalLexicon) -> str:
+    h = hashlib.sha256()
+    for name in sorted(lexicon.sublexica.keys()):
+        h.update(json.dumps([name, lexicon.sublexica[name].i2s]).encode("utf-8"))
+    return h.hexdigest()
+
+
+class InstanceCache:
+    """
+    On-disk cache of the PreprocessedTrees of a corpus, stored as flat .npy files that are memory-mapped when loading.
+    An entry is identified by a hash of the file content, the configuration of the transition system,
+    the additional lexicon and the given options.
+
+    The code of the transition system is not part of the key: delete the cache directory after changing it.
+    """
+
+    def __init__(self, directory : str, file_path : str, transition_system : TransitionSystem, lexicon : AdditionalLexicon,
+                 options : Dict[str, Any]):
+        """
+        :param directory: where the cache entries are stored
+        :param file_path: corpus
+        :param options: additional settings that influence the result (e.g. number of sentences read)
+        """
+        key = {"version" : FORMAT_VERSION,
+               "file" : file_hash(file_path),
+               "transition_system" : transition_system_config(transition_system),
+               "lexicon" : lexicon_hash(lexicon),
+               "options" : options}
+        self.key = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        self.directory = directory
+        self.path = os.path.join(directory, self.key)
+
+    def exists(self) -> bool:
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+    def load(self) -> "CachedTrees":
+        logger.info("Loading preprocessed trees from %s", self.path)
+        return CachedTrees(self.path)
+
+    def write(self, trees : List[Optional[PreprocessedTree]]) -> None:
+        """
+        Stores the trees, None marks sentences that were not preprocessed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        try:
+            present = [t is not None for t in trees]
+            decision_lengths = [len(t.decisions) if t is not None else 0 for t in trees]
+            step_lengths = [len(t.active_nodes) if t is not None else 0 for t in trees]
+            existing = [t for t in trees if t is not None]
+
+            np.save(os.path.join(tmp, "present.npy"), np.array(present, dtype=np.bool_))
+            np.save(os.path.join(tmp, "decision_offsets.npy"), np.cumsum([0] + decision_lengths))
+            np.save(os.path.join(tmp, "step_offsets.npy"), np.cumsum([0] + step_lengths))
+            np.save(os.path.join(tmp, "decisions.npy"),
+                    np.concatenate([t.decisions for t in existing]) if existing else np.zeros((0, len(DECISION_COLUMNS)), dtype=np.int64))
+            np.save(os.path.join(tmp, "active_nodes.npy"),
+                    np.concatenate([t.active_nodes for t in existing]) if existing else np.zeros(0, dtype=np.int64))
+
+            context_names = sorted({name for t in existing for name in t.contexts})
+            for name in context_names:
+                arrays = [t.contexts[name] for t in existing]
+                assert all(len(a) == len(t.active_nodes) for a, t in zip(arrays, existing)), f"Context {name} must have an entry for every step"
+                np.save(os.path.join(tmp, name+".values.npy"), np.concatenate([a.reshape(-1) for a in arrays]))
+                np.save(os.path.join(tmp, name+".shapes.npy"), np.array([a.shape for a in arrays], dtype=np.int64))
+                np.save(os.path.join(tmp, name+".offsets.npy"), np.cumsum([0] + [a.size for a in arrays]))
+
+            with open(os.path.join(tmp, "meta.json"), "w") as f:
+                json.dump({"version" : FORMAT_VERSION, "sentences" : len(trees), "contexts" : context_names}, f)
+
+            try:
+                os.rename(tmp, self.path)
+            except OSError: # another process was faster
+                shutil.rmtree(tmp, ignore_errors=True)
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        logger.info("Wrote preprocessed trees to %s", self.path)
+
+
+class CachedTrees:
+    """
+    Random access to the PreprocessedTrees of a cache entry, the arrays are views into memory-mapped files.
+    """
+
+    def __init__(self, path : str):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Cache entry {path} has version {meta['version']}, expected {FORMAT_VERSION}")
+
+        def load(name):
+            return np.load(os.path.join(path, name+".npy"), mmap_mode="r")
+
+        self.sentences = meta["sentences"]
+        self.present = load("present")
+        self.decision_offsets = load("decision_offsets")
+        self.step_offsets = load("step_offsets")
+        self.decisions = load("decisions")
+        self.active_nodes = load("active_nodes")
+        self.contexts = {name : (load(name+".values"), load(name+".shapes"), load(name+".offsets")) for name in meta["contexts"]}
+        self.tree_index = np.cumsum(self.present) - 1 # index among the trees that are present
+
+    def __len__(self) -> int:
+        return self.sentences
+
+    def __getitem__(self, i : int) -> Optional[PreprocessedTree]:
+        if not self.present[i]:
+            return None
+        step_start, step_end = self.step_offsets[i], self.step_offsets[i+1]
+        j = self.tree_index[i]
+        contexts = {name : values[offsets[j]:offsets[j+1]].reshape(shapes[j]) for name, (values, shapes, offsets) in self.contexts.items()}
+        return PreprocessedTree(self.decisions[self.decision_offsets[i]:self.decision_offsets[i+1]],
+                                self.active_nodes[step_start:step_end], contexts)
@@ -0,0 +1,114 @@
+from typing import Iterable, List, Optional
+import logging
+
+from allennlp.common.checks import ConfigurationError
+from allennlp.data.instance import Instance
+from allennlp.data.iterators.data_iterator import DataIterator
+from allennlp.data.dataset import Batch
+
+from .decision_budget_iterator import BudgetIterator
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MEGABYTE = 1024 * 1024
+
+
+class DecodeMemoryEstimate:
+    """
+    Rough estimate of the peak memory that decoding a batch needs, in bytes. Counts the tensors that grow with the
+    batch: the encoded input, the scores of every decoding step (the edge label scores for all tokens dominate)
+    and, for transition systems on the GPU, the batched parsing state. The batch is multiplied by the beam size.
+    """
+
+    def __init__(self, encoder_dim : int, edge_label_vocab_size : int, tagger_vocab_size : int,
+                 beam_size : int = 1, gpu_state : bool = False, overhead : float = 2.0):
+        """
+        :param tagger_vocab_size: sum of the vocabulary sizes of the supertagger, lexical label tagger and term type tagger
+        :param gpu_state: is the parsing state kept on the GPU?
+        :param overhead: factor for temporary copies of the scores (softmax etc.)
+        """
+        self.encoder_dim = encoder_dim
+        self.edge_label_vocab_size = edge_label_vocab_size
+        self.tagger_vocab_size = tagger_vocab_size
+        self.beam_size = beam_size
+        self.gpu_state = gpu_state
+        self.overhead = overhead
+
+    @staticmethod
+    def from_model(model : "TopDownDependencyParser") -> "DecodeMemoryEstimate":
+        tagger_vocab_size = sum(tagger.vocab_size for tagger in [model.supertagger, model.lex_label_tagger, model.term_type_tagger]
+                                if tagger is not None)
+        return DecodeMemoryEstimate(model.encoder_output_dim, model.edge_label_model.vocab_size, tagger_vocab_size,
+                                    beam_size=model.k_best,
+                                    gpu_state=model.parse_on_gpu and model.transition_system.is_on_gpu())
+
+    def bytes(self, batch_size : int, input_seq_len : int) -> float:
+        """
+        :param input_seq_len: padded number of tokens, including the artificial root
+        """
+        batch_size = batch_size * self.beam_size
+        encoded = 2 * batch_size * input_seq_len * self.encoder_dim * 4 # for parsing and for tagging
+        step_scores = batch_size * (input_seq_len * (self.edge_label_vocab_size + 1) + self.tagger_vocab_size) * 4
+        state = 0
+        if self.gpu_state:
+            # children of shape (batch_size, input_seq_len, input_seq_len) and a few tensors of shape (batch_size, input_seq_len)
+            state = batch_size * input_seq_len * (input_seq_len + 8) * 8
+        return encoded + self.overhead * step_scores + state
+
+
+@DataIterator.register("memory_budget")
+class MemoryBudgetIterator(BudgetIterator):
+    """
+    Batches for parsing: a batch contains as many sentences as fit into memory_budget according to DecodeMemoryEstimate,
+    but at most max_batch_size. The estimate depends on the model, which has to be given with set_model,
+    otherwise the batch size is always max_batch_size. The beam size is taken from the model whenever batches are created.
+    """
+    def __init__(self, formalisms: List[str],
+                 memory_budget : float,
+                 max_batch_size : Optional[int] = None,
+                 cache_instances:bool = False,
+                 track_epoch:bool = False,
+                 padding_noise:float = 0.0,
+                 instances_per_epoch:int = None,
+                 max_instances_in_memory: int  = None,
+                 biggest_batch_first: bool = False):
+        """
+        :param memory_budget: in megabytes
+        :param max_batch_size: ceiling for the batch size
+        """
+        if memory_budget <= 0:
+            raise ConfigurationError("memory_budget must be positive")
+        super().__init__(formalisms, max_batch_size, cache_instances=cache_instances, track_epoch=track_epoch,
+                         padding_noise=padding_noise, instances_per_epoch=instances_per_epoch,
+                         max_instances_in_memory=max_instances_in_memory, biggest_batch_first=biggest_batch_first)
+        self.memory_budget = memory_budget
+        self.model = None
+        self.estimate : Optional[DecodeMemoryEstimate] = None
+
+    def set_model(self, model : "TopDownDependencyParser") -> None:
+        self.model = model
+
+    def _update_estimate(self) -> None:
+        if self.model is not None:
+            self.estimate = DecodeMemoryEstimate.from_model(self.model)
+        elif self.max_batch_size is None:
+            raise ConfigurationError("MemoryBudgetIterator needs either a model or a max_batch_size")
+
+    def get_num_batches(self, instances: Iterable[Instance]) -> int:
+        self._update_estimate()
+        return super().get_num_batches(instances)
+
+    def _create_batches(self, instances: Iterable[Instance], shuffle: bool) -> Iterable[Batch]:
+        self._update_estimate()
+        return super()._create_batches(instances, shuffle)
+
+    def length(self, instance : Instance) -> int:
+        return instance.fields["words"].sequence_length()
+
+    def batch_cost(self, batch_size : int, padded_length : int) -> float:
+        if self.estimate is None:
+            return 0.0
+        return self.estimate.bytes(batch_size, padded_length)
+
+    def budget(self) -> float:
+        return self.memory_budget * MEGABYTE
@@ -0,0 +1,112 @@
+import queue
+import threading
+from typing import Iterable, Callable, TypeVar, Iterator, Any
+
+import multiprocessing as mp
+from multiprocessing.pool import Pool
+
+A = TypeVar("A")
+B = TypeVar("B")
+
+# object that the functions of a worker_pool are called on, one per worker process.
+_worker_object : Any = None
+
+
+def _initialize_worker(obj : Any) -> None:
+    global _worker_object
+    _worker_object = obj
+
+
+def call_on_worker_object(method_name : str, x : Any, **kwargs) -> Any:
+    """
+    Calls a method of the object that the current worker process was initialized with.
+    Use with functools.partial to make a function for Pool.map etc. that is cheap to pickle.
+    """
+    return getattr(_worker_object, method_name)(x, **kwargs)
+
+
+def worker_pool(processes : int, obj : Any) -> Pool:
+    """
+    Creates a pool where every worker process holds obj, see call_on_worker_object.
+    When processes are forked, obj is shared with the workers at fork time and never pickled,
+    otherwise it is pickled once per worker instead of once per task.
+    """
+    if "fork" in mp.get_all_start_methods():
+        context = mp.get_context("fork")
+    else:
+        context = mp.get_context()
+    return context.Pool(processes, initializer=_initialize_worker, initargs=(obj,))
+
+
+def bounded_imap(pool : Pool, function : Callable[[A], B], inputs : Iterable[A], max_in_flight : int) -> Iterator[B]:
+    """
+    Like pool.imap (results in the order of the inputs) but at most max_in_flight inputs are submitted
+    whose results have not been consumed yet. Pool.imap would submit all inputs at once, so that the results pile up
+    in memory if they are consumed more slowly than they are produced.
+    """
+    assert max_in_flight > 0
+    slots = threading.Semaphore(max_in_flight)
+    stopped = threading.Event()
+
+    def submit() -> Iterator[A]:
+        # consumed by the task handler thread of the pool.
+        for x in inputs:
+            slots.acquire()
+            if stopped.is_set():
+                return
+            yield x
+
+    try:
+        for result in pool.imap(function, submit()):
+            slots.release()
+            yield result
+    finally:
+        # unblock the task handler if we stop early, otherwise the pool can't be terminated.
+        stopped.set()
+        slots.release()
+
+
+_END = object()
+
+
+def prefetch(inputs : Iterable[A], size : int, function : Callable[[A], B] = lambda x: x) -> Iterator[B]:
+    """
+    Iterates over inputs and applies function in a background thread, at most size results are computed ahead
+    of the consumer. Exceptions of the background thread are raised in the consumer.
+    """
+    assert size > 0
+    results = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for x in inputs:
+                if not put((function(x), None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put((_END, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result, exception = results.get()
+            if exception is not None:
+                raise exception
+            if result is _END:
+                return
+            yield result
+    finally:
+        # stops the background thread if we stop early
+        stopped.set()
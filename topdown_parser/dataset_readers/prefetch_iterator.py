@@ -0,0 +1,60 @@
+from typing import Iterable, Iterator, Any
+import logging
+
+import torch
+from allennlp.data import Vocabulary
+from allennlp.data.instance import Instance
+from allennlp.data.iterators.data_iterator import DataIterator, TensorDict
+
+from .parallel import prefetch
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def pin_memory(data : Any) -> Any:
+    """
+    Copies all tensors in a (nested) tensor dict to pinned memory, which makes copying them to the GPU faster.
+    """
+    if isinstance(data, torch.Tensor):
+        return data.pin_memory()
+    if isinstance(data, dict):
+        return {k: pin_memory(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(pin_memory(v) for v in data)
+    return data
+
+
+@DataIterator.register("prefetch")
+class PrefetchIterator(DataIterator):
+    """
+    Wraps another iterator and creates its batches (indexing, padding, conversion to tensors) in a background thread
+    while the model works on the current batch. Can be used wherever an iterator is configured, e.g. for training
+    and for the annotator.
+    """
+
+    def __init__(self, iterator : DataIterator, prefetch : int = 4, pin_memory : bool = True):
+        """
+        :param iterator: the iterator that creates the batches
+        :param prefetch: how many batches are prepared ahead of time
+        :param pin_memory: put the batches into pinned memory, only has an effect when a GPU is available
+        """
+        super().__init__(batch_size=iterator._batch_size)
+        self.iterator = iterator
+        self.prefetch = prefetch
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+    def __getattr__(self, item):
+        # settings like formalisms are those of the underlying iterator.
+        if item == "iterator":
+            raise AttributeError(item)
+        return getattr(self.iterator, item)
+
+    def __call__(self, instances: Iterable[Instance], num_epochs: int = None, shuffle: bool = True) -> Iterator[TensorDict]:
+        return prefetch(self.iterator(instances, num_epochs, shuffle), self.prefetch, pin_memory if self.pin_memory else lambda x: x)
+
+    def index_with(self, vocab: Vocabulary):
+        self.vocab = vocab
+        self.iterator.index_with(vocab)
+
+    def get_num_batches(self, instances: Iterable[Instance]) -> int:
+        return self.iterator.get_num_batches(instances)
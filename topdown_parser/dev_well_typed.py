@@ -20,7 +20,7 @@ if __name__ == "__main__":
     from topdown_parser.nn.parser import TopDownDependencyParser
     from topdown_parser.callbacks.parse_dev import ParseDev
     from topdown_parser.dataset_readers.amconll_tools import parse_amconll
-    from topdown_parser.am_algebra.tools import is_welltyped
+    from topdown_parser.am_algebra.typechecker import BatchedTypeChecker
     from topdown_parser.transition_systems.ltl import LTL
     from topdown_parser.transition_systems.ltf import LTF
     from topdown_parser.transition_systems.dfs import DFS
@@ -33,6 +33,7 @@ if __name__ == "__main__":
     optparser.add_argument('--cuda-device', type=int, default=0, help='id of GPU to use. Use -1 to compute on CPU.')
     optparser.add_argument('--beams', nargs="*", help='beam sizes to use.')
     optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size.")
+    optparser.add_argument("--workers", type=int, default=1, help="Number of processes for checking well-typedness.")
 
 
 
@@ -72,16 +73,15 @@ if __name__ == "__main__":
         filename = os.path.join(model_dir,f"dev_well_typedness_k_{beam_size}.txt")
         annotator.annotate_file(model, parse_dev.system_input, filename)
         cumulated_parse_time = 0.0
-        well_typed = 0
-        total = 0
         with open(filename) as f:
-            for am_sentence in parse_amconll(f):
-                well_typed += int(is_welltyped(am_sentence))
-                total += 1
-                cumulated_parse_time += float(am_sentence.attributes["normalized_parsing_time"])
-
-            metrics["time_" + parse_dev.prefix + "k_" + str(beam_size)] = cumulated_parse_time
-            metrics["well_typed_" + parse_dev.prefix + "k_" + str(beam_size)+"_percent"] = (well_typed/total) * 100
+            am_sentences = list(parse_amconll(f))
+        for am_sentence in am_sentences:
+            cumulated_parse_time += float(am_sentence.attributes["normalized_parsing_time"])
+        well_typed = sum(BatchedTypeChecker().are_welltyped(am_sentences, workers=args.workers))
+        total = len(am_sentences)
+
+        metrics["time_" + parse_dev.prefix + "k_" + str(beam_size)] = cumulated_parse_time
+        metrics["well_typed_" + parse_dev.prefix + "k_" + str(beam_size)+"_percent"] = (well_typed/total) * 100
 
     print("Metrics", metrics)
     with open(os.path.join(model_dir, "well_typed_metrics.json"), "w") as f:
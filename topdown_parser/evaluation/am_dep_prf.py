@@ -1,7 +1,13 @@
 import argparse
 
-from collections import namedtuple
+import os
 import sys
+from typing import Dict, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from topdown_parser.dataset_readers.amconll_columns import read_amconll_columns, StringTable
 
 ### usage: python3 am_dep_prf.py filename1 filename2
 ###
@@ -17,75 +23,37 @@ optparser.add_argument("system", type=str)
 
 opts = optparser.parse_args()
 
-fragment_col = 6
-lex_label_col = 7
-type_col = 8
-head_col = 9
-label_col = 10
-
-Entry = namedtuple("Entry",["fragment","lex_label", "type", "head", "label"])
-
-
+def index_by_id(corpus) -> Dict[str, int]:
+    """
+    Maps sentence ids to the position of the sentence in the corpus, sentences without id are numbered from 1.
+    """
+    return {attr.get("id", str(i+1)) : i for i, attr in enumerate(corpus.attributes)}
 
 
-def parse_amconll(fil):
+def aligned_tokens(gold_corpus, gold_ids : Dict[str, int], system_corpus, system_ids : Dict[str, int], ids) -> Tuple[np.array, np.array]:
     """
-    Reads a file and returns a generator over AM sentences.
-    :param fil:
-    :return:
+    Positions of the tokens of the given sentences in the gold and the system corpus,
+    pairing up the tokens of a sentence like zip.
     """
-    expect_header = True
-    new_sentence = True
-    entries = []
-    attributes = dict()
-    counter = 0
-    for line in fil:
-        line = line.rstrip("\n")
-        if line.strip() == "":
-            # sentence finished
-            counter += 1
-            if len(entries) > 0:
-                if "id" not in attributes:
-                    attributes["id"] = str(counter)
-                yield entries, attributes
-            new_sentence = True
-
-        if new_sentence:
-            expect_header = True
-            attributes = dict()
-            entries = []
-            new_sentence = False
-            if line.strip() == "":
-                continue
-
-        if expect_header:
-            if line.startswith("#"):
-                key, val = line[1:].split(":", maxsplit=1)
-                attributes[key] = val
-            else:
-                expect_header = False
-
-        if not expect_header:
-            fields = line.split("\t")
-            entries.append(Entry(fields[fragment_col], fields[lex_label_col], fields[type_col], fields[head_col], fields[label_col]))
-
-
-predicted_content = 0
-gold_content = 0
-
-supertags_correct = 0
-heads_correct = 0
-labels_and_heads_correct = 0
-lex_labels_correct = 0
-content_overlap = 0
-
-lex_types_correct = 0
-
+    gold_positions = [np.zeros(0, dtype=np.int64)]
+    system_positions = [np.zeros(0, dtype=np.int64)]
+    for id in ids:
+        g = gold_corpus.offsets[gold_ids[id]]
+        s = system_corpus.offsets[system_ids[id]]
+        n = min(gold_corpus.offsets[gold_ids[id]+1] - g, system_corpus.offsets[system_ids[id]+1] - s)
+        gold_positions.append(np.arange(g, g+n))
+        system_positions.append(np.arange(s, s+n))
+    return np.concatenate(gold_positions), np.concatenate(system_positions)
+
+
+strings = StringTable() # shared by both corpora, so string ids can be compared.
 with open(opts.gold) as f1:
-    gold = { attr["id"] : s for s, attr in parse_amconll(f1) }
+    gold_corpus = read_amconll_columns(f1, validate=False, strings=strings)
+    gold = index_by_id(gold_corpus)
 
 with open(opts.system) as f1:
-    system = { attr["id"] : s for s, attr in parse_amconll(f1) }
+    system_corpus = read_amconll_columns(f1, validate=False, strings=strings)
+    system = index_by_id(system_corpus)
     
 print("Gold sents", len(gold))
 print("System sents", len(system))
@@ -94,31 +62,36 @@ intersection = set(gold.keys()) & set(system.keys())
 
 print("Intersection size", len(intersection))
 
-for id in intersection:
-    for gold_w, system_w in zip(gold[id], system[id]):
+gold_positions, system_positions = aligned_tokens(gold_corpus, gold, system_corpus, system, intersection)
 
-        if system_w.label != "IGNORE":
-            predicted_content += 1
+def gold_column(name : str) -> np.array:
+    return gold_corpus.column(name)[gold_positions]
 
-        if gold_w.label != "IGNORE":
-            gold_content += 1
+def system_column(name : str) -> np.array:
+    return system_corpus.column(name)[system_positions]
 
-        if system_w.label != "IGNORE" and gold_w.label != "IGNORE":
-            content_overlap += 1
-            if gold_w.fragment == system_w.fragment and gold_w.type == system_w.type:
-                supertags_correct += 1
+IGNORE = strings.get_id("IGNORE")
+UNDERSCORE = strings.get_id("_")
 
-            if gold_w.type == system_w.type:
-                lex_types_correct += 1
+same_fragment = gold_column("fragment") == system_column("fragment")
+same_type = gold_column("typ") == system_column("typ")
+same_head = gold_corpus.heads[gold_positions] == system_corpus.heads[system_positions]
+same_label = gold_column("label") == system_column("label")
+same_lex_label = gold_column("lexlabel") == system_column("lexlabel")
 
-            if gold_w.head == system_w.head:
-                heads_correct += 1
-                if gold_w.label == system_w.label:
-                    labels_and_heads_correct += 1
+system_content = system_column("label") != IGNORE
+gold_content = gold_column("label") != IGNORE
+overlap = system_content & gold_content
 
-            if gold_w.lex_label == system_w.lex_label:
-                lex_labels_correct += 1
+predicted_content = int(np.sum(system_content))
+gold_content = int(np.sum(gold_content))
+content_overlap = int(np.sum(overlap))
 
+supertags_correct = int(np.sum(overlap & same_fragment & same_type))
+lex_types_correct = int(np.sum(overlap & same_type))
+heads_correct = int(np.sum(overlap & same_head))
+labels_and_heads_correct = int(np.sum(overlap & same_head & same_label))
+lex_labels_correct = int(np.sum(overlap & same_lex_label))
 
 
 if len(intersection) > 0:
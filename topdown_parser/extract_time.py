@@ -14,7 +14,7 @@ from allenpipeline.callback import CallbackName
 
 if __name__ == "__main__":
     import_submodules("topdown_parser")
-    from topdown_parser.dataset_readers.amconll_tools import parse_amconll
+    from topdown_parser.dataset_readers.amconll_columns import read_amconll_columns
 
     optparser = argparse.ArgumentParser(add_help=True,
                                         description="Extract parsing time from parsed amconll file.")
@@ -25,8 +25,8 @@ if __name__ == "__main__":
 
     time_dict : Dict[str, List[float]] = dict()
     with open(args.input) as f:
-        for am_sentence in parse_amconll(f, validate=False):
-            for k, v in am_sentence.attributes.items():
+        for attributes in read_amconll_columns(f, validate=False).attributes:
+            for k, v in attributes.items():
                 if "time" in k:
                     try:
                         f = float(v)
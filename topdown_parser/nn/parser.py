@@ -9,21 +9,22 @@ from allennlp.common.checks import ConfigurationError
 from allennlp.data import Vocabulary
 from allennlp.models import Model
 from allennlp.modules import TextFieldEmbedder, Embedding, Seq2SeqEncoder, InputVariationalDropout
-from allennlp.nn.util import get_text_field_mask, get_final_encoder_states, get_range_vector, batch_tensor_dicts, \
+from allennlp.nn.util import get_text_field_mask, get_final_encoder_states, get_range_vector, \
     get_device_of
 
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
-from topdown_parser.am_algebra.tools import get_tree_type
+from topdown_parser.am_algebra.typechecker import BatchedTypeChecker
+from topdown_parser.am_algebra import AMType
 from topdown_parser.losses.losses import EdgeExistenceLoss
 from topdown_parser.nn.context_provider import ContextProvider
 from topdown_parser.nn.decoder_cell import DecoderCell
 from topdown_parser.nn.edge_label_model import EdgeLabelModel
 from topdown_parser.nn.edge_model import EdgeModel
 from topdown_parser.nn.supertagger import Supertagger
-from topdown_parser.nn.utils import get_device_id, index_tensor_dict, batch_and_pad_tensor_dict, expand_tensor_dict
+from topdown_parser.nn.utils import get_device_id, index_tensor_dict, HostTransfer, DecisionMargins, select_sentences
 from topdown_parser.transition_systems.decision import Decision
 from topdown_parser.transition_systems.parsing_state import undo_one_batching, \
-    undo_one_batching_eval, ParsingState
+    ParsingState, ContextBuffer, batch_seen_masks
 from topdown_parser.transition_systems.batched_parsing_state import BatchedParsingState
 
 import heapq
@@ -57,9 +58,35 @@ class TopDownDependencyParser(Model):
                  encoder_output_dropout : float = 0.0,
                  k_best: int = 1,
                  parse_on_gpu: bool = True,
+                 recombine_hypotheses: bool = False,
+                 beam_threshold: Optional[float] = None,
+                 beam_margin_threshold: Optional[float] = None,
+                 beam_score_threshold: Optional[float] = None,
+                 cascade: bool = False,
                  ):
+        """
+        :param recombine_hypotheses: in beam search, keep only the best of the hypotheses whose parsing states
+            allow for the same future decisions (see TransitionSystem.state_signature). This is approximate because the
+            hidden state of the decoder still differs between such hypotheses.
+        :param beam_threshold: in beam search, drop the hypotheses of a sentence whose score is more than beam_threshold
+            below the score of its best hypothesis. The beam of a sentence then holds between 1 and k_best hypotheses.
+        :param beam_margin_threshold: if k_best > 1, parse greedily first and parse a sentence again with beam search only if
+            the log probability of a node that greedy parsing selected was less than this above that of the best other node.
+        :param beam_score_threshold: if k_best > 1, parse greedily first and parse a sentence again with beam search only if
+            the sum of the log probabilities of the nodes that greedy parsing selected is below this.
+        :param cascade: if the transition system guarantees well-typedness, parse greedily with its unconstrained version
+            first (see TransitionSystem.get_unconstrained_version) and parse only the sentences that are not well-typed
+            again with the transition system.
+        """
         super().__init__(vocab)
         self.k_best = k_best
+        self.recombine_hypotheses = recombine_hypotheses
+        self.beam_threshold = beam_threshold
+        self.beam_margin_threshold = beam_margin_threshold
+        self.beam_score_threshold = beam_score_threshold
+        self.cascade = cascade
+        self.unconstrained_version : Optional[Tuple[TransitionSystem, TransitionSystem]] = None
+        self.host_transfer = HostTransfer()
         self.parse_on_gpu = parse_on_gpu
         self.term_type_tagger = term_type_tagger
         self.tagger_context_provider = tagger_context_provider
@@ -115,13 +142,24 @@ class TopDownDependencyParser(Model):
 
         self.heads_correct = 0
         self.heads_predicted = 0
+
+        self.gated_sentences = 0
+        self.reparsed_sentences = 0
+
+        self.cascade_sentences = 0
+        self.fallback_sentences = 0
         self.prepared = False
 
+        self.type_checker = BatchedTypeChecker()
+
         self.transition_system.validate_model(self)
 
         if k_best < 1:
             raise ConfigurationError("k_best must be at least 1.")
 
+        if beam_threshold is not None and beam_threshold < 0:
+            raise ConfigurationError("beam_threshold must not be negative.")
+
         if self.parse_on_gpu and not self.transition_system.is_on_gpu():
             logger.warning("The parsing algorithm is only implemented for CPU, so we parse on the CPU instead of GPU")
 
@@ -168,10 +206,11 @@ class TopDownDependencyParser(Model):
             sentences = [s.strip_annotation() for s in sentences]
             # import cProfile
             # with cProfile.Profile() as pr:
-            if self.k_best == 1:
-                predictions = self.parse_sentences(state, metadata[0]["formalism"], sentences)
+            if self.cascade and self.transition_system.guarantees_well_typedness():
+                predictions, tree_types = self.cascade_parse(state, metadata[0]["formalism"], sentences)
             else:
-                predictions = self.beam_search(state, sentences, self.k_best)
+                predictions = self.decode(state, metadata[0]["formalism"], sentences)
+                tree_types = None
             # print(pr.print_stats())
 
             parsing_time_t1 = time.time()
@@ -189,8 +228,9 @@ class TopDownDependencyParser(Model):
                 self.roots_total += 1
 
             #Compute some well-typedness statistics
-            for p in predictions:
-                ttyp = get_tree_type(p)
+            if tree_types is None:
+                tree_types = self.type_checker.get_tree_types_batch(predictions)
+            for ttyp in tree_types:
                 if ttyp is not None:
                     self.well_typed += 1
                     self.has_empty_tree_type += int(ttyp.is_empty_type())
@@ -550,23 +590,41 @@ class TopDownDependencyParser(Model):
         return current_mask * F.cross_entropy(supertag_scores, current_labels, reduction="none"), supertags_correct, supertag_decisions
 
 
-    def parse_sentences(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence]) -> List[AMSentence]:
+    def decode(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence]) -> List[AMSentence]:
+        """
+        Parses the sentences greedily or with beam search, depending on k_best.
+        :param sentences:
+        :param state:
+        :return:
+        """
+        if self.k_best == 1:
+            return self.parse_sentences(state, formalism, sentences)
+        elif self.beam_margin_threshold is not None or self.beam_score_threshold is not None:
+            return self.gated_beam_search(state, formalism, sentences, self.k_best)
+        else:
+            return self.beam_search(state, sentences, self.k_best)
+
+    def parse_sentences(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence],
+                        margins : Optional[DecisionMargins] = None) -> List[AMSentence]:
         """
         Parses the sentences using TransitionSystem (not GPUTransitionSystem)
         :param sentences:
         :param state:
+        :param margins: if given, records how confident the decisions were
         :return:
         """
         if self.parse_on_gpu and self.transition_system.is_on_gpu():
-            return self.parse_sentences_gpu(state, formalism, sentences)
+            return self.parse_sentences_gpu(state, formalism, sentences, margins)
         else:
-            return self.parse_sentences_cpu(state, formalism, sentences)
+            return self.parse_sentences_cpu(state, formalism, sentences, margins)
 
-    def parse_sentences_cpu(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence]) -> List[AMSentence]:
+    def parse_sentences_cpu(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence],
+                            margins : Optional[DecisionMargins] = None) -> List[AMSentence]:
         """
         Parses the sentences using TransitionSystem (not GPUTransitionSystem)
         :param sentences:
         :param state:
+        :param margins: if given, records how confident the decisions were
         :return:
         """
         self.init_decoder(state)
@@ -586,15 +644,19 @@ class TopDownDependencyParser(Model):
 
         parsing_states = [self.transition_system.initial_state(sentence, None) for sentence in sentences]
 
+        context_buffer = None
+        if self.context_provider:
+            context_buffer = ContextBuffer(batch_size, input_seq_len)
+            for i, parsing_state in enumerate(parsing_states):
+                context_buffer.update(i, parsing_state)
+
         for step in range(output_seq_len):
             encoding_current_node = state["encoded_input"][range_batch_size, next_active_nodes]
             encoding_current_node_tagging = state["encoded_input_for_tagging"][range_batch_size, next_active_nodes]
 
             if self.context_provider:
                 # Generate context snapshot of current time-step.
-                current_context : List[Dict[str, torch.Tensor]] = [parsing_states[i].gather_context(device) for i in range(batch_size)]
-                current_context : Dict[str, torch.Tensor] = batch_and_pad_tensor_dict(current_context)
-                undo_one_batching_eval(current_context)
+                current_context : Dict[str, torch.Tensor] = context_buffer.as_tensors(device)
             else:
                 current_context : Dict[str, torch.Tensor] = dict()
 
@@ -645,7 +707,7 @@ class TopDownDependencyParser(Model):
                 assert lex_label_scores.shape == (batch_size, self.lex_label_tagger.vocab_size)
 
                 #scores["lex_labels_scores"] = F.log_softmax(lex_label_scores,1)
-                scores["lex_labels"] = torch.argmax(lex_label_scores, 1).cpu()
+                scores["lex_labels"] = torch.argmax(lex_label_scores, 1)
 
             if self.term_type_tagger is not None:
                 term_type_scores = self.term_type_tagger.tag_scores(decoder_hidden_tagging, relevant_nodes_for_supertagging)
@@ -653,13 +715,21 @@ class TopDownDependencyParser(Model):
 
                 scores["term_types_scores"] = F.log_softmax(term_type_scores, 1)
 
-            scores = { name : tensor.cpu() for name, tensor in scores.items()}
+            scores = self.host_transfer(scores)
             ### Update current node according to transition system:
+            decisions = self.transition_system.make_decisions(scores, parsing_states)
+            if margins is not None:
+                active = torch.tensor([not parsing_state.is_complete() for parsing_state in parsing_states], dtype=torch.bool)
+                pop_nodes = [0 if self.transition_system.pop_with_0 else parsing_state.active_node for parsing_state in parsing_states]
+                valid_choices = ~torch.from_numpy(batch_seen_masks(parsing_states, pop_nodes, scores["children_scores"].shape[1]))
+                margins.add(scores["children_scores"], valid_choices,
+                            torch.tensor([decision.position for decision in decisions], dtype=torch.long), active)
+            parsing_states = self.transition_system.step_batch(parsing_states, decisions, in_place = True)
             active_nodes = []
             for i, parsing_state in enumerate(parsing_states):
-                decision = self.transition_system.make_decision(index_tensor_dict(scores,i), parsing_state)
-                parsing_states[i] = self.transition_system.step(parsing_state, decision, in_place = True)
-                active_nodes.append(parsing_states[i].active_node)
+                active_nodes.append(parsing_state.active_node)
+                if context_buffer is not None:
+                    context_buffer.update(i, parsing_state)
 
             next_active_nodes = torch.tensor(active_nodes, dtype=torch.long, device=device)
 
@@ -670,11 +740,13 @@ class TopDownDependencyParser(Model):
 
         return [state.extract_tree() for state in parsing_states]
 
-    def parse_sentences_gpu(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence]) -> List[AMSentence]:
+    def parse_sentences_gpu(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence],
+                            margins : Optional[DecisionMargins] = None) -> List[AMSentence]:
         """
         Parses the sentences on the GPU.
         :param sentences:
         :param state:
+        :param margins: if given, records how confident the decisions were
         :return:
         """
         self.init_decoder(state)
@@ -754,6 +826,8 @@ class TopDownDependencyParser(Model):
             #scores = { name : tensor.cpu() for name, tensor in scores.items()}
             ### Update current node according to transition system:
             decision_batch = self.transition_system.gpu_make_decision(scores, parsing_states)
+            if margins is not None:
+                margins.add(scores["children_scores"], decision_batch.valid_choices, decision_batch.push_tokens, ~parsing_states.stack.is_empty())
 
             self.transition_system.gpu_step(parsing_states, decision_batch)
 
@@ -770,6 +844,8 @@ class TopDownDependencyParser(Model):
     def beam_search(self, encoder_state: Dict[str, torch.Tensor], sentences: List[AMSentence], k : int) -> List[AMSentence]:
         """
         Parses the sentences.
+        The beam of a sentence holds at most k hypotheses, fewer if hypotheses are pruned with beam_threshold.
+        Every hypothesis has a row in the batch of the decoder, so the work of a step depends on the number of hypotheses left.
         :param sentences:
         :param encoder_state:
         :return:
@@ -777,34 +853,25 @@ class TopDownDependencyParser(Model):
         batch_size, input_seq_len, encoder_dim = encoder_state["encoded_input"].shape
         device = get_device_id(encoder_state["encoded_input"])
 
-        # Every key in encoder_state has the dimensions (batch_size, ....)
-        # We now replace that by (k*batch_size, ...) where we repeat each batch element k times.
-        #old_dict = dict(encoder_state)
-        encoder_states_list = expand_tensor_dict(encoder_state)
-        k_times = []
-        for s in encoder_states_list:
-            for _ in range(k):
-                k_times.append(s)
-        encoder_state = batch_tensor_dicts(k_times) # shape (k*batch_size, ...)
-
-        #assert all(torch.all(old_dict[k] == encoder_state[k]) for k in old_dict.keys())
-
         self.init_decoder(encoder_state)
-        self.common_setup_decode(encoder_state)
 
         INF = 10e10
-        inverted_input_mask = INF * (1 - encoder_state["input_mask"]) #shape (batch_size, input_seq_len)
 
         output_seq_len = input_seq_len*2 + 1
 
-        next_active_nodes = torch.zeros(k*batch_size, dtype=torch.long, device = device) #start with artificial root.
-
-        range_batch_size = get_range_vector(k*batch_size, device)
-
         parsing_states : List[List[ParsingState]] = []
         decoder_states_full = self.decoder.get_full_states()
         for i, sentence in enumerate(sentences):
-            parsing_states.append([self.transition_system.initial_state(sentence, decoder_states_full[k*i+p]) for p in range(k)])
+            parsing_states.append([self.transition_system.initial_state(sentence, decoder_states_full[i])])
+
+        # The rows of the decoder batch, sentence_of_row[r] is the sentence that the hypothesis in row r belongs to.
+        # row_state is encoder_state with the sentence of every row, it is only rebuilt if the rows change.
+        sentence_of_row = list(range(batch_size))
+        row_state = dict(encoder_state)
+        self.common_setup_decode(row_state)
+        inverted_input_mask = INF * (1 - row_state["input_mask"]) #shape (number of rows, input_seq_len)
+
+        next_active_nodes = torch.zeros(batch_size, dtype=torch.long, device = device) #start with artificial root.
 
         assumes_greedy_ok = self.transition_system.assumes_greedy_ok()
         condition_on = set()
@@ -816,36 +883,49 @@ class TopDownDependencyParser(Model):
         if len(assumes_greedy_ok & condition_on):
             raise ConfigurationError(f"You chose a beam search algorithm that assumes making greedy decisions in terms of {assumes_greedy_ok}"
                                      f"won't impact future decisions but your context provider includes information about {condition_on}")
+        signature_with_context = len(condition_on) > 0
+
+        context_buffer = None
+        if self.context_provider:
+            context_buffer = ContextBuffer(batch_size, input_seq_len)
+            for sentence_id, sentence_states in enumerate(parsing_states):
+                context_buffer.update(sentence_id, sentence_states[0])
 
         for step in range(output_seq_len):
-            encoding_current_node = encoder_state["encoded_input"][range_batch_size, next_active_nodes]
-            encoding_current_node_tagging = encoder_state["encoded_input_for_tagging"][range_batch_size, next_active_nodes]
+            rows = [sentence_id for sentence_id, sentence_states in enumerate(parsing_states) for _ in sentence_states]
+            if rows != sentence_of_row:
+                sentence_of_row = rows
+                row_index = torch.tensor(rows, dtype=torch.long, device=device)
+                row_state = {key: tensor.index_select(0, row_index) for key, tensor in encoder_state.items()}
+                self.common_setup_decode(row_state)
+                inverted_input_mask = INF * (1 - row_state["input_mask"])
+            number_of_rows = len(sentence_of_row)
+            range_batch_size = get_range_vector(number_of_rows, device)
+
+            encoding_current_node = row_state["encoded_input"][range_batch_size, next_active_nodes]
+            encoding_current_node_tagging = row_state["encoded_input_for_tagging"][range_batch_size, next_active_nodes]
 
             if self.context_provider:
                 # Generate context snapshot of current time-step.
-                current_context : List[Dict[str, torch.Tensor]] = []
-                for sentence_states in parsing_states:
-                    current_context.extend([state.gather_context(device) for state in sentence_states])
-                current_context: Dict[str, torch.Tensor] = batch_and_pad_tensor_dict(current_context)
-                undo_one_batching_eval(current_context)
+                current_context: Dict[str, torch.Tensor] = context_buffer.as_tensors(device)
             else:
                 current_context: Dict[str, torch.Tensor] = dict()
 
-            decoder_hidden, decoder_hidden_tagging = self.decoder_step(encoder_state, encoding_current_node, encoding_current_node_tagging, current_context)
+            decoder_hidden, decoder_hidden_tagging = self.decoder_step(row_state, encoding_current_node, encoding_current_node_tagging, current_context)
 
-            assert decoder_hidden.shape == (k*batch_size, self.decoder_output_dim)
+            assert decoder_hidden.shape == (number_of_rows, self.decoder_output_dim)
 
             #####################
             # Predict edges
             edge_scores = self.edge_model.edge_scores(decoder_hidden)
-            assert edge_scores.shape == (k*batch_size, input_seq_len)
+            assert edge_scores.shape == (number_of_rows, input_seq_len)
 
             edge_scores = F.log_softmax(edge_scores,1)
             # Apply filtering of valid choices:
             edge_scores = edge_scores - inverted_input_mask #- INF*(1-valid_choices)
 
             selected_nodes = torch.argmax(edge_scores, dim=1)
-            # assert selected_nodes.shape == (k*batch_size,)
+            # assert selected_nodes.shape == (number_of_rows,)
             # all_selected_nodes.append(selected_nodes)
 
             #####################
@@ -864,53 +944,85 @@ class TopDownDependencyParser(Model):
             #Compute supertags:
             if self.supertagger is not None:
                 supertag_scores = self.supertagger.tag_scores(decoder_hidden_tagging, relevant_nodes_for_supertagging)
-                assert supertag_scores.shape == (k*batch_size, self.supertagger.vocab_size)
+                assert supertag_scores.shape == (number_of_rows, self.supertagger.vocab_size)
 
-                scores["constants_scores"] = F.log_softmax(supertag_scores,1).cpu()
+                scores["constants_scores"] = F.log_softmax(supertag_scores,1)
 
             if self.lex_label_tagger is not None:
                 lex_label_scores = self.lex_label_tagger.tag_scores(decoder_hidden_tagging, relevant_nodes_for_supertagging)
-                assert lex_label_scores.shape == (k*batch_size, self.lex_label_tagger.vocab_size)
+                assert lex_label_scores.shape == (number_of_rows, self.lex_label_tagger.vocab_size)
 
                 #scores["lex_labels_scores"] = F.log_softmax(lex_label_scores,1).cpu()
-                scores["lex_labels"] = torch.argmax(lex_label_scores, 1).cpu()
+                scores["lex_labels"] = torch.argmax(lex_label_scores, 1)
 
             if self.term_type_tagger is not None:
                 term_type_scores = self.term_type_tagger.tag_scores(decoder_hidden_tagging, relevant_nodes_for_supertagging)
-                assert term_type_scores.shape == (k*batch_size, self.term_type_tagger.vocab_size)
+                assert term_type_scores.shape == (number_of_rows, self.term_type_tagger.vocab_size)
 
-                scores["term_types_scores"] = F.log_softmax(term_type_scores, 1).cpu()
+                scores["term_types_scores"] = F.log_softmax(term_type_scores, 1)
 
-            #scores = { name : tensor.cpu() for name, tensor in scores.items()}
+            # The label scores stay on the device, top_k_decision only copies the rows of the children it selects.
+            all_labels_scores = scores.pop("all_labels_scores")
+            scores = self.host_transfer(scores)
+            scores["all_labels_scores"] = all_labels_scores
 
-            encoder_state["decoder_hidden"] = decoder_hidden
+            row_state["decoder_hidden"] = decoder_hidden
             decoder_states_full = self.decoder.get_full_states()
             ### Update current node according to transition system:
             active_nodes = []
+            origins = [] # at which row was the state that a new state is derived from?
+            row = 0
             for sentence_id, sentence in enumerate(parsing_states):
                 all_decisions_for_sentence = []
-                for i, parsing_state in enumerate(sentence):
-                    parsing_state.decoder_state = decoder_states_full[k*sentence_id+i]
-                    top_k : List[Decision] = self.transition_system.top_k_decision(index_tensor_dict(scores,k*sentence_id+i),
+                for parsing_state in sentence:
+                    parsing_state.decoder_state = decoder_states_full[row]
+                    top_k : List[Decision] = self.transition_system.top_k_decision(index_tensor_dict(scores,row),
                                                                                    parsing_state, k)
                     for decision in top_k:
-                        all_decisions_for_sentence.append((decision, parsing_state))
+                        all_decisions_for_sentence.append((decision, parsing_state, row))
+                    row += 1
 
-                    if step == 0:
-                        # in the first step, we always have that parsing_state is the initial state for that sentence
-                        # and the scores are identical.
-                        break
                 # Find top k overall decisions
-                #all_decisions_for_sentence = sorted(all_decisions_for_sentence, reverse=True, key=lambda decision_and_state: decision_and_state[0].score + decision_and_state[1].score)
-                top_k_decisions = heapq.nlargest(k, all_decisions_for_sentence, key=lambda decision_and_state: decision_and_state[0].score + decision_and_state[1].score)
-                for decision_nr, (decision, parsing_state) in enumerate(top_k_decisions):
-                    next_parsing_state = self.transition_system.step(parsing_state, decision, in_place = False)
-                    parsing_states[sentence_id][decision_nr] = next_parsing_state
+                next_states = []
+                if self.recombine_hypotheses:
+                    # go through the decisions from best to worst, skip those that lead to a state that is equivalent to a better one.
+                    signatures = set()
+                    for decision, parsing_state, origin in sorted(all_decisions_for_sentence, reverse=True, key=lambda decision_and_state: decision_and_state[0].score + decision_and_state[1].score):
+                        next_parsing_state = self.transition_system.step(parsing_state, decision, in_place = False)
+                        signature = self.transition_system.state_signature(next_parsing_state, signature_with_context)
+                        if signature is not None:
+                            if signature in signatures:
+                                continue
+                            signatures.add(signature)
+                        next_states.append((next_parsing_state, origin))
+                        if len(next_states) == k:
+                            break
+                else:
+                    top_k_decisions = heapq.nlargest(k, all_decisions_for_sentence, key=lambda decision_and_state: decision_and_state[0].score + decision_and_state[1].score)
+                    for decision, parsing_state, origin in top_k_decisions:
+                        next_states.append((self.transition_system.step(parsing_state, decision, in_place = False), origin))
+
+                if self.beam_threshold is not None and next_states:
+                    # next_states are sorted by score, drop the hypotheses that are too far behind the best one.
+                    lowest_score = next_states[0][0].score - self.beam_threshold
+                    next_states = [(next_parsing_state, origin) for next_parsing_state, origin in next_states if next_parsing_state.score >= lowest_score]
+
+                if not next_states:
+                    # there weren't any decisions, keep the beam as it is.
+                    next_states = [(parsing_state, row - len(sentence) + i) for i, parsing_state in enumerate(sentence)]
+
+                parsing_states[sentence_id] = [next_parsing_state for next_parsing_state, _ in next_states]
+                for next_parsing_state, origin in next_states:
+                    origins.append(origin)
                     active_nodes.append(next_parsing_state.active_node)
 
-                for _ in range(k-len(top_k_decisions)): #there weren't enough decisions, fill with some parsing state
-                    active_nodes.append(0)
-
+            if context_buffer is not None:
+                context_buffer.reorder(origins)
+                row = 0
+                for sentence in parsing_states:
+                    for parsing_state in sentence:
+                        context_buffer.update(row, parsing_state)
+                        row += 1
 
             next_active_nodes = torch.tensor(active_nodes, dtype=torch.long, device=device)
             # Bring decoder network into correct state
@@ -919,8 +1031,9 @@ class TopDownDependencyParser(Model):
                 for parsing_state in sentence:
                     decoder_states_full.append(parsing_state.decoder_state)
             self.decoder.set_with_full_states(decoder_states_full)
-
-            assert next_active_nodes.shape == (k*batch_size,)
+            if self.tagger_decoder is not None:
+                tagger_decoder_states_full = self.tagger_decoder.get_full_states()
+                self.tagger_decoder.set_with_full_states([tagger_decoder_states_full[origin] for origin in origins])
 
             if all(all(s.is_complete() for s in sentennce_states) for sentennce_states in parsing_states):
                 break
@@ -932,6 +1045,68 @@ class TopDownDependencyParser(Model):
 
         return ret
 
+    def gated_beam_search(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence], k : int) -> List[AMSentence]:
+        """
+        Parses the sentences greedily and parses those sentences again with beam search
+        whose greedy decisions were uncertain according to beam_margin_threshold and beam_score_threshold.
+        The encoded input of these sentences is reused.
+        :param sentences:
+        :param state:
+        :return:
+        """
+        margins = DecisionMargins(len(sentences))
+        predictions = self.parse_sentences(state, formalism, sentences, margins)
+        uncertain = margins.uncertain(self.beam_margin_threshold, self.beam_score_threshold)
+
+        self.gated_sentences += len(sentences)
+        self.reparsed_sentences += len(uncertain)
+
+        if uncertain:
+            beam_predictions = self.beam_search(select_sentences(state, uncertain), [sentences[i] for i in uncertain], k)
+            for i, prediction in zip(uncertain, beam_predictions):
+                predictions[i] = prediction
+
+        return predictions
+
+    def get_unconstrained_transition_system(self) -> TransitionSystem:
+        """
+        The unconstrained version of the current transition system, which may have been replaced after construction.
+        """
+        if self.unconstrained_version is None or self.unconstrained_version[0] is not self.transition_system:
+            self.unconstrained_version = (self.transition_system, self.transition_system.get_unconstrained_version())
+        return self.unconstrained_version[1]
+
+    def cascade_parse(self, state: Dict[str, torch.Tensor], formalism : str, sentences: List[AMSentence]) -> Tuple[List[AMSentence], List[Optional[AMType]]]:
+        """
+        Parses the sentences greedily with the unconstrained version of the transition system and parses those sentences again
+        with the transition system (greedily or with beam search, depending on k_best) whose trees are not well-typed or whose
+        root does not have the empty type. The encoded input of these sentences is reused.
+        :param sentences:
+        :param state:
+        :return: the predictions and their tree types (None if a tree is not well-typed)
+        """
+        transition_system = self.transition_system
+        self.transition_system = self.get_unconstrained_transition_system()
+        try:
+            predictions = self.parse_sentences(state, formalism, sentences)
+        finally:
+            self.transition_system = transition_system
+
+        tree_types = self.type_checker.get_tree_types_batch(predictions)
+        ill_typed = [i for i, tree_type in enumerate(tree_types) if tree_type is None or not tree_type.is_empty_type()]
+
+        self.cascade_sentences += len(sentences)
+        self.fallback_sentences += len(ill_typed)
+
+        if ill_typed:
+            typed_predictions = self.decode(select_sentences(state, ill_typed), formalism, [sentences[i] for i in ill_typed])
+            typed_tree_types = self.type_checker.get_tree_types_batch(typed_predictions)
+            for i, prediction, tree_type in zip(ill_typed, typed_predictions, typed_tree_types):
+                predictions[i] = prediction
+                tree_types[i] = tree_type
+
+        return predictions, tree_types
+
     def get_metrics(self, reset: bool = False) -> Dict[str, float]:
         r = dict()
         if self.decisions > 0:
@@ -953,6 +1128,12 @@ class TopDownDependencyParser(Model):
         if self.roots_total > 0:
             r["root_acc"] = self.root_correct / self.roots_total * 100
 
+        if self.gated_sentences > 0:
+            r["beam_reparsed"] = self.reparsed_sentences / self.gated_sentences * 100
+
+        if self.cascade_sentences > 0:
+            r["cascade_fallback"] = self.fallback_sentences / self.cascade_sentences * 100
+
 
         if reset:
             self.head_decisions_correct = 0
@@ -971,6 +1152,12 @@ class TopDownDependencyParser(Model):
             self.has_empty_tree_type = 0
             self.sentences_parsed = 0
 
+            self.gated_sentences = 0
+            self.reparsed_sentences = 0
+
+            self.cascade_sentences = 0
+            self.fallback_sentences = 0
+
 
         return r
 
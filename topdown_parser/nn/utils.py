@@ -56,5 +56,104 @@ def expand_tensor_dict(td : Dict[str, torch.Tensor]) -> List[Dict[str, torch.Ten
     batch_size = next(iter(td.values())).shape[0]
     return [index_tensor_dict(td, i) for i in range(batch_size)]
 
+def select_sentences(state : Dict[str, torch.Tensor], sentence_ids : List[int]) -> Dict[str, torch.Tensor]:
+    """
+    The encoded input (see TopDownDependencyParser.encode) of some of the sentences of a batch, without the padding
+    that only the other sentences needed.
+    """
+    index = torch.tensor(sentence_ids, dtype=torch.long, device=state["input_mask"].device)
+    input_mask = state["input_mask"].index_select(0, index)
+    input_seq_len = int(input_mask.sum(1).max())
+    return {key: tensor.index_select(0, index)[:, :input_seq_len] for key, tensor in state.items()}
+
 def move_tensor_dict(td : Dict[str, torch.Tensor], device : Optional[int]) -> Dict[str, torch.Tensor]:
-    return {k: t.to(device) for k,t in td.items()}
\ No newline at end of file
+    return {k: t.to(device) for k,t in td.items()}
+
+class HostTransfer:
+    """
+    Copies a dictionary of tensors to the CPU with as few transfers as possible: all tensors of the same dtype
+    are packed into one buffer on the device, which is copied asynchronously into a pinned buffer that is reused
+    between calls. The returned tensors are views into the pinned buffer (calling .numpy() on them doesn't copy),
+    they are only valid until the next call. Tensors that are on the CPU already are returned as they are.
+    """
+
+    def __init__(self):
+        self.buffers : Dict[torch.dtype, torch.Tensor] = dict()
+
+    def _buffer(self, dtype : torch.dtype, size : int) -> torch.Tensor:
+        buffer = self.buffers.get(dtype)
+        if buffer is None or buffer.shape[0] < size:
+            buffer = torch.empty(size, dtype=dtype, pin_memory=True)
+            self.buffers[dtype] = buffer
+        return buffer
+
+    def __call__(self, tensors : Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        ret = dict()
+        names_by_dtype : Dict[torch.dtype, List[str]] = dict()
+        for name, tensor in tensors.items():
+            if tensor.is_cuda:
+                names_by_dtype.setdefault(tensor.dtype, []).append(name)
+            else:
+                ret[name] = tensor
+
+        device = None
+        for dtype, names in names_by_dtype.items():
+            packed = torch.cat([tensors[name].detach().reshape(-1) for name in names])
+            device = packed.device
+            buffer = self._buffer(dtype, packed.shape[0])
+            buffer[:packed.shape[0]].copy_(packed, non_blocking=True)
+            offset = 0
+            for name in names:
+                size = tensors[name].numel()
+                ret[name] = buffer[offset:offset+size].view(tensors[name].shape)
+                offset += size
+
+        if device is not None:
+            torch.cuda.current_stream(device).synchronize()
+        return ret
+
+
+class DecisionMargins:
+    """
+    How confident greedy parsing was about the nodes it selected, for every sentence of a batch: the smallest margin
+    between the log probability of a selected node and that of the best other node, and the sum of the log probabilities
+    of the selected nodes. The margin is negative when the transition system selected a node the model didn't prefer.
+    """
+
+    def __init__(self, batch_size : int):
+        self.batch_size = batch_size
+        self.min_margin : Optional[torch.Tensor] = None
+        self.log_prob : Optional[torch.Tensor] = None
+
+    def add(self, children_scores : torch.Tensor, valid_choices : torch.Tensor, selected_nodes : torch.Tensor,
+            active : torch.Tensor) -> None:
+        """
+        Records the decisions of one step. Only the nodes the transition system allowed to select are compared.
+        :param children_scores: shape (batch_size, input_seq_len), very low for padding
+        :param valid_choices: shape (batch_size, input_seq_len), True for the nodes that could be selected
+        :param selected_nodes: shape (batch_size,)
+        :param active: shape (batch_size,), False for sentences that were complete before this step
+        """
+        if self.min_margin is None:
+            self.min_margin = children_scores.new_full((self.batch_size,), float("inf"))
+            self.log_prob = children_scores.new_zeros(self.batch_size)
+        children_scores = children_scores.masked_fill(~valid_choices.to(children_scores.device), -10e10)
+        log_probs = F.log_softmax(children_scores, 1)
+        selected_nodes = selected_nodes.unsqueeze(1)
+        selected_log_probs = log_probs.gather(1, selected_nodes).squeeze(1)
+        best_other = log_probs.scatter(1, selected_nodes, -float("inf")).max(1)[0]
+        self.min_margin = torch.where(active, torch.min(self.min_margin, selected_log_probs - best_other), self.min_margin)
+        self.log_prob = self.log_prob + torch.where(active, selected_log_probs, torch.zeros_like(selected_log_probs))
+
+    def uncertain(self, min_margin : Optional[float], min_log_prob : Optional[float]) -> List[int]:
+        """
+        The sentences whose smallest margin is below min_margin or whose sum of log probabilities is below min_log_prob.
+        """
+        if self.min_margin is None:
+            return []
+        below = torch.zeros(self.batch_size, dtype=torch.bool, device=self.min_margin.device)
+        if min_margin is not None:
+            below |= self.min_margin < min_margin
+        if min_log_prob is not None:
+            below |= self.log_prob < min_log_prob
+        return below.nonzero().squeeze(1).tolist()
@@ -203,4 +203,5 @@ class MaLSTMCell(DecoderCell):
             hidden.append(h)
             context.append(c)
         self.hidden = torch.stack(hidden, dim=0)
-        self.context = torch.stack(context, dim=0)
\ No newline at end of file
+        self.context = torch.stack(context, dim=0)
+        self.batch_size = len(states)
\ No newline at end of file
@@ -15,6 +15,7 @@ from allenpipeline.callback import CallbackName
 if __name__ == "__main__":
     import_submodules("topdown_parser")
     from topdown_parser.dataset_readers.same_formalism_iterator import SameFormalismIterator
+    from topdown_parser.dataset_readers.memory_budget_iterator import MemoryBudgetIterator
     from topdown_parser.callbacks.parse_test import ParseTest
     from topdown_parser.dataset_readers.amconll_tools import parse_amconll
 
@@ -24,8 +25,14 @@ if __name__ == "__main__":
     optparser.add_argument('archive_file', type=str, help='the archived model to make predictions with')
     optparser.add_argument('--cuda-device', type=int, default=0, help='id of GPU to use. Use -1 to compute on CPU.')
     optparser.add_argument('--beams', nargs="*", help='beam sizes to use.')
-    optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size.")
+    optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size. With --memory_budget, this is the maximum batch size.")
+    optparser.add_argument("--memory_budget", type=float, default=None, help="Choose batch sizes such that decoding needs at most roughly this many megabytes.")
     optparser.add_argument("--parse_on_cpu", action="store_true", default=False, help="Enforce parsing on the CPU.")
+    optparser.add_argument("--recombine", action="store_true", default=False, help="Merge beam search hypotheses whose parsing states allow for the same future decisions.")
+    optparser.add_argument("--beam_threshold", type=float, default=None, help="Drop beam search hypotheses whose score is more than this below the best hypothesis of the sentence.")
+    optparser.add_argument("--beam_margin_threshold", type=float, default=None, help="Parse greedily and use beam search only for sentences where a selected node was less than this above the best other node (in log probability).")
+    optparser.add_argument("--beam_score_threshold", type=float, default=None, help="Parse greedily and use beam search only for sentences where the log probability of the selected nodes is below this.")
+    optparser.add_argument("--cascade", action="store_true", default=False, help="Parse with the unconstrained transition system first and only parse sentences that are not well-typed with the transition system.")
 
 
 
@@ -40,9 +47,19 @@ if __name__ == "__main__":
     model = archive.model
     model.eval()
     model.parse_on_gpu = not args.parse_on_cpu
+    model.recombine_hypotheses = args.recombine
+    model.beam_threshold = args.beam_threshold
+    model.beam_margin_threshold = args.beam_margin_threshold
+    model.beam_score_threshold = args.beam_score_threshold
+    model.cascade = args.cascade
     pipelinepieces = PipelineTrainerPieces.from_params(config)
 
-    if args.batch_size is not None and args.batch_size > 0:
+    if args.memory_budget is not None:
+        iterator = pipelinepieces.annotator.data_iterator
+        max_batch_size = args.batch_size if args.batch_size is not None and args.batch_size > 0 else iterator._batch_size
+        pipelinepieces.annotator.data_iterator = MemoryBudgetIterator(iterator.formalisms, args.memory_budget, max_batch_size)
+        pipelinepieces.annotator.data_iterator.set_model(model)
+    elif args.batch_size is not None and args.batch_size > 0:
         assert isinstance(pipelinepieces.annotator.data_iterator, SameFormalismIterator)
         iterator : SameFormalismIterator = pipelinepieces.annotator.data_iterator
         pipelinepieces.annotator.data_iterator = SameFormalismIterator(iterator.formalisms, args.batch_size)
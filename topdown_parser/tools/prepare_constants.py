@@ -4,11 +4,14 @@ import os
 import sys
 from typing import Dict, Set
 
+import numpy as np
+
 sys.path.append(".")
-from topdown_parser.dataset_readers.amconll_tools import parse_amconll, AMSentence
+from topdown_parser.dataset_readers.amconll_tools import AMSentence
+from topdown_parser.dataset_readers.amconll_columns import read_amconll_columns
 from topdown_parser.am_algebra import ReadCache, NonAMTypeException, AMType
 from topdown_parser.am_algebra.tree import Tree
-from topdown_parser.am_algebra.tools import get_term_types, is_welltyped
+from topdown_parser.am_algebra.typechecker import BatchedTypeChecker
 
 optparser = argparse.ArgumentParser(add_help=True,
                                     description="reads amconll file and produces two files with the possible graph constants and with the possible types. Ivents new constants where needed.")
@@ -19,6 +22,8 @@ optparser.add_argument('--corpora',
                        default=[],
                        help='Corpora to read, typically the train.amconll and gold-dev.amconll file')
 
+optparser.add_argument("--workers", type=int, default=1, help="Number of processes for computing term types.")
+
 
 
 def invent_supertag(type : AMType) -> str:
@@ -38,24 +43,35 @@ all_types : Set[AMType] = set()
 
 mod_sources : Set[str] = set()
 
+type_checker = BatchedTypeChecker()
+
 for corpus in args.corpora:
     with open(corpus) as f:
-        trees = parse_amconll(f)
-        for am_sentence in trees:
-            if not is_welltyped(am_sentence):
-                print("Skipping non-well-typed AMDep tree.")
-                continue
-
-            term_types.update(get_term_types(am_sentence))
-            for entry in am_sentence.words:
-                typ = read_cache.parse_str(entry.typ)
-                lexical_types.add(typ)
-                if typ not in supertags:
-                    supertags[typ] = set()
-                supertags[typ].add(entry.fragment + "--TYPE--" + str(typ))
-
-                if entry.label.startswith("MOD_"):
-                    mod_sources.add(entry.label.split("_")[1])
+        columns = read_amconll_columns(f)
+    trees = columns.sentences()
+
+    welltyped = np.zeros(len(columns.heads), dtype=np.bool_) # which tokens belong to well-typed trees?
+    for i, (am_sentence, sentence_term_types) in enumerate(zip(trees, type_checker.get_term_types_batch(trees, workers=args.workers))):
+        root = am_sentence.get_root()
+        if root is None or sentence_term_types[root] is None:
+            print("Skipping non-well-typed AMDep tree.")
+            continue
+
+        term_types.update(sentence_term_types)
+        welltyped[columns.offsets[i]:columns.offsets[i+1]] = True
+
+    # each distinct (fragment, type) and edge label only needs to be looked at once.
+    for fragment, typ in np.unique(np.stack([columns.column("fragment")[welltyped], columns.column("typ")[welltyped]], axis=1), axis=0).tolist():
+        typ = read_cache.parse_str(columns.strings.strings[typ])
+        lexical_types.add(typ)
+        if typ not in supertags:
+            supertags[typ] = set()
+        supertags[typ].add(columns.strings.strings[fragment] + "--TYPE--" + str(typ))
+
+    for label in np.unique(columns.column("label")[welltyped]).tolist():
+        label = columns.strings.strings[label]
+        if label.startswith("MOD_"):
+            mod_sources.add(label.split("_")[1])
 
 all_types = lexical_types | term_types
 invented = 0
@@ -72,17 +72,15 @@ class BatchedParsingState:
         label_tensor = self.edge_labels[:, 1:].cpu().numpy()
         constant_tensor = self.constants[:, 1:].cpu().numpy()
         lex_label_tensor = self.lex_labels[:, 1:].cpu().numpy()
+        bottom = AMSentence.split_supertag(AMSentence.get_bottom_supertag())
         for i in range(len(self.sentences)):
             length = len(self.sentences[i])
-            sentence = self.sentences[i].set_heads([max(0, h) for i, h in enumerate(heads[i]) if i < length]) #negative heads are ignored, so point to 0.
-            edge_labels = [self.lexicon.get_str_repr("edge_labels", id) if id > 0 else "IGNORE" for i, id in enumerate(label_tensor[i]) if i < length]
-            sentence = sentence.set_labels(edge_labels)
-            constants = [AMSentence.split_supertag(self.lexicon.get_str_repr("constants", id)) if id > 0 else AMSentence.split_supertag(AMSentence.get_bottom_supertag())
-                         for i, id in enumerate(constant_tensor[i]) if i < length]
-            sentence = sentence.set_supertag_tuples(constants)
-            lex_labels = [self.lexicon.get_str_repr("lex_labels", id) if id > 0 else "_" for i, id in enumerate(lex_label_tensor[i]) if i < length]
-            sentence = sentence.set_lexlabels(lex_labels)
-            r.append(sentence)
+            sentence_heads = heads[i, :length].tolist() # negative heads were set to 0 by relu
+            edge_labels = [self.lexicon.get_str_repr("edge_labels", id) if id > 0 else "IGNORE" for id in label_tensor[i, :length].tolist()]
+            constants = [AMSentence.split_supertag(self.lexicon.get_str_repr("constants", id)) if id > 0 else bottom
+                         for id in constant_tensor[i, :length].tolist()]
+            lex_labels = [self.lexicon.get_str_repr("lex_labels", id) if id > 0 else "_" for id in lex_label_tensor[i, :length].tolist()]
+            r.append(self.sentences[i].with_annotation(sentence_heads, edge_labels, constants, lex_labels))
         return r
 
     def gather_context(self) -> Dict[str, torch.Tensor]:
@@ -13,16 +13,22 @@ from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 # supertag is a tuple of a graph fragment and its AM type
 # lexlabel is the chosen lexical label (only meaningful if supertag is meaningful)
 # termtype is the term type we select in CHOOSE in LTF, otherwise it's meaningless
+# Transition systems whose parsing states keep ids (LTF, LTL, see AnnotationIds) make decisions with label_id, constant_id,
+# lex_label_id and termtyp_id instead of the strings and the term type; their step accepts both kinds of decisions.
 
 @dataclass(frozen=True)
 class Decision:
     position : int
     pop: bool
-    label : str
-    supertag : Tuple[str, str]
-    lexlabel : str
+    label : str = ""
+    supertag : Tuple[str, str] = ("", "")
+    lexlabel : str = ""
     termtyp : Optional[AMType] = None
     score: float = 0.0
+    label_id : Optional[int] = None
+    constant_id : Optional[int] = None
+    lex_label_id : Optional[int] = None
+    termtyp_id : Optional[int] = None
 
 
 # A decision batch works slightly differently to a Decision.
@@ -30,6 +36,7 @@ class Decision:
 # push_mask[i] tells us if we actually create an edge to the push_tokens[i]
 # pop_mask[i] is true if we Pop/Finish in batch element i
 # constant_mask[i] is true if we actually select a constant for batch element i (would be Select in LTF, and Finish in LTL)
+# valid_choices[i,j] is true if node j could have been selected in batch element i
 @dataclass(frozen=True)
 class DecisionBatch:
     push_tokens: torch.Tensor #shape (batch_size,)
@@ -42,6 +49,7 @@ class DecisionBatch:
     term_types: Optional[torch.Tensor] #shape (batch_size,)
     lex_labels: torch.Tensor
     constant_mask: torch.Tensor
+    valid_choices: Optional[torch.Tensor] = None #shape (batch_size, input_seq_len)
 
     @staticmethod
     def from_decision(decision : Decision, lexicon: AdditionalLexicon) -> "DecisionBatch":
@@ -63,4 +71,5 @@ class DecisionBatch:
                              self.constants.to(device),
                              self.term_types.to(device),
                              self.lex_labels.to(device),
-                             self.constant_mask.to(device))
+                             self.constant_mask.to(device),
+                             self.valid_choices.to(device) if self.valid_choices is not None else None)
@@ -1,16 +1,18 @@
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import List, Iterable, Optional, Tuple, Dict, Any, Set
+from typing import List, Iterable, Optional, Tuple, Dict, Any, Set, Hashable
 
+import numpy as np
 import torch
 
-from topdown_parser.am_algebra.tree import Tree
+from topdown_parser.am_algebra.tree import ArrayTree
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
 from topdown_parser.transition_systems.parsing_state import ParsingState
 from topdown_parser.transition_systems.transition_system import TransitionSystem
 from .decision import Decision
 from topdown_parser.transition_systems.unconstrained_system import UnconstrainedTransitionSystem
+from topdown_parser.transition_systems.utils import ordered_children, gold_context
 
 
 class DFSState(ParsingState):
@@ -37,51 +39,40 @@ class DFS(UnconstrainedTransitionSystem):
 
         self.children_order = children_order
 
-    def _construct_seq(self, tree: Tree, is_first_child : bool, parent_type : Tuple[str, str], parent_lex_label : str) -> List[Decision]:
-        own_position = tree.node[0]
-        to_left = []
-        to_right = []
-        for child in tree.children:
-            if child.node[1].label == "IGNORE":
+    def _construct_seq(self, tree: ArrayTree) -> List[Decision]:
+        ret = []
+        # agenda items: (node, is first child?, parent) for entering a node, (node, None, None) for leaving it.
+        agenda = [(0, False, -1)]
+        while agenda:
+            own_position, is_first_child, parent = agenda.pop()
+            entry = tree.nodes[own_position]
+
+            if is_first_child is None:
+                last_position = 0 if self.pop_with_0 else own_position
+                if tree.arity(own_position) == 0:
+                    #This subtree has no children, thus also no first child at which we would determine the type of the parent
+                    #Let's determine the type now.
+                    ret.append(Decision(last_position, True, "", (entry.fragment, entry.typ), entry.lexlabel))
+                else:
+                    ret.append(Decision(last_position, True, "", ("",""), ""))
                 continue
 
-            if child.node[0] < own_position:
-                to_left.append(child)
+            if is_first_child:
+                parent_entry = tree.nodes[parent]
+                ret.append(Decision(own_position, False, entry.label, (parent_entry.fragment, parent_entry.typ), parent_entry.lexlabel))
             else:
-                to_right.append(child)
+                ret.append(Decision(own_position, False, entry.label, ("", ""), ""))
 
-        if is_first_child:
-            beginning = [Decision(own_position, False, tree.node[1].label, parent_type, parent_lex_label)]
-        else:
-            beginning = [Decision(own_position, False, tree.node[1].label, ("", ""), "")]
+            agenda.append((own_position, None, None))
+            children = ordered_children(tree, own_position, self.children_order)
+            agenda.extend((child, i == 0, own_position) for i, child in reversed(list(enumerate(children))))
 
-        if self.children_order == "LR":
-            children = to_left + to_right
-        elif self.children_order == "IO":
-            children = list(reversed(to_left)) + to_right
-        else:
-            raise ValueError("Unknown children order: " + self.children_order)
-
-        ret = beginning
-        for i, child in enumerate(children):
-            ret.extend(self._construct_seq(child, i == 0, (tree.node[1].fragment, tree.node[1].typ), tree.node[1].lexlabel))
-
-        last_position = 0 if self.pop_with_0 else own_position
-        if len(tree.children) == 0:
-            #This subtree has no children, thus also no first child at which we would determine the type of the parent
-            #Let's determine the type now.
-            last_decision = Decision(last_position, True, "", (tree.node[1].fragment, tree.node[1].typ),
-                                     tree.node[1].lexlabel)
-        else:
-            last_decision = Decision(last_position, True, "", ("",""), "")
-        ret.append(last_decision)
         return ret
 
 
     def get_order(self, sentence: AMSentence) -> Iterable[Decision]:
-        t = Tree.from_am_sentence(sentence)
-        r = self._construct_seq(t, False, ("",""),"")
-        return r
+        t = ArrayTree.from_am_sentence(sentence)
+        return self._construct_seq(t)
 
     def get_unconstrained_version(self) -> TransitionSystem:
         """
@@ -93,11 +84,17 @@ class DFS(UnconstrainedTransitionSystem):
     def guarantees_well_typedness(self) -> bool:
         return False
 
+    def state_signature(self, state : DFSState, with_context : bool) -> Optional[Hashable]:
+        return state.signature(with_context)
+
     def check_correct(self, gold_sentence : AMSentence, predicted : AMSentence) -> bool:
         return all(x.head == y.head for x, y in zip(gold_sentence, predicted)) and \
                all(x.label == y.label for x, y in zip(gold_sentence, predicted)) and \
                all(x.fragment == y.fragment and x.typ == y.typ for x, y in zip(gold_sentence, predicted))
 
+    def gold_context(self, sentence : AMSentence, decisions : List[Decision]) -> Dict[str, np.array]:
+        return gold_context([d.position for d in decisions], len(sentence), self.pop_with_0)
+
     def initial_state(self, sentence : AMSentence, decoder_state : Any) -> ParsingState:
         stack = [0]
         seen = set()
@@ -137,7 +134,7 @@ class DFS(UnconstrainedTransitionSystem):
             if copy.lex_labels is not None and copy.lex_labels[state.active_node-1] == "_" and state.active_node != 0:
                 copy.lex_labels[state.active_node-1] = decision.lexlabel
 
-            copy.seen.add(decision.position)
+            copy.mark_seen(decision.position)
 
             if not copy.stack:
                 copy.active_node = 0
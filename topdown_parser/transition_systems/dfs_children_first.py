@@ -1,10 +1,11 @@
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import List, Iterable, Optional, Tuple, Dict, Any, Set
+from typing import List, Iterable, Optional, Tuple, Dict, Any, Set, Hashable
 
+import numpy as np
 import torch
 
-from topdown_parser.am_algebra.tree import Tree
+from topdown_parser.am_algebra.tree import ArrayTree
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
 from topdown_parser.transition_systems.parsing_state import ParsingState
@@ -12,6 +13,7 @@ from topdown_parser.transition_systems.transition_system import TransitionSystem
 from .decision import Decision
 #from topdown_parser.transition_systems.parsing_state import get_parent, get_siblings
 from topdown_parser.transition_systems.unconstrained_system import UnconstrainedTransitionSystem
+from topdown_parser.transition_systems.utils import ordered_children, gold_context
 
 
 class DFSChildrenFirstState(ParsingState):
@@ -69,55 +71,49 @@ class DFSChildrenFirst(UnconstrainedTransitionSystem):
         """
         return self
 
-    def _construct_seq(self, tree: Tree) -> List[Decision]:
-        own_position = tree.node[0]
-        push_actions = []
-        recursive_actions = []
-
-        if self.children_order == "LR":
-            children = tree.children
-        elif self.children_order == "RL":
-            children = reversed(tree.children)
-        elif self.children_order == "IO":
-            left_part = []
-            right_part = []
-            for child in tree.children:
-                if child.node[0] < own_position:
-                    left_part.append(child)
-                else:
-                    right_part.append(child)
-            children = list(reversed(left_part)) + right_part
-        else:
-            raise ValueError("Unknown children order: "+self.children_order)
+    def _construct_seq(self, tree: ArrayTree) -> List[Decision]:
+        ret = []
+        agenda = [0]
+        while agenda:
+            own_position = agenda.pop()
+            entry = tree.nodes[own_position]
+            children = ordered_children(tree, own_position, self.children_order)
 
-        for child in children:
-            if child.node[1].label == "IGNORE":
-                continue
+            push_actions = [Decision(child, False, tree.nodes[child].label, ("", ""), "") for child in children]
 
-            push_actions.append(Decision(child.node[0], False, child.node[1].label, ("", ""), ""))
-            recursive_actions.extend(self._construct_seq(child))
+            if self.pop_with_0:
+                relevant_position = 0
+            else:
+                relevant_position = own_position
 
-        if self.pop_with_0:
-            relevant_position = 0
-        else:
-            relevant_position = own_position
+            if self.reverse_push_actions:
+                push_actions = list(reversed(push_actions))
 
-        if self.reverse_push_actions:
-            push_actions = list(reversed(push_actions))
+            ret.extend(push_actions)
+            ret.append(Decision(relevant_position, True, "", (entry.fragment, entry.typ), entry.lexlabel))
+            # the children are visited recursively after the pop, in the original order
+            agenda.extend(reversed(children))
 
-        return push_actions + [Decision(relevant_position, True, "", (tree.node[1].fragment, tree.node[1].typ), tree.node[1].lexlabel)] + recursive_actions
+        return ret
 
     def get_order(self, sentence: AMSentence) -> Iterable[Decision]:
-        t = Tree.from_am_sentence(sentence)
-        r = [Decision(t.node[0], False, t.node[1].label, ("", ""), "")] + self._construct_seq(t)
+        t = ArrayTree.from_am_sentence(sentence)
+        r = [Decision(0, False, t.nodes[0].label, ("", ""), "")] + self._construct_seq(t)
         return r
 
+    def state_signature(self, state : DFSChildrenFirstState, with_context : bool) -> Optional[Hashable]:
+        return state.signature(with_context) + (tuple(state.substack), state.step)
+
     def check_correct(self, gold_sentence : AMSentence, predicted : AMSentence) -> bool:
         return all(x.head == y.head for x, y in zip(gold_sentence, predicted)) and \
                all(x.label == y.label for x, y in zip(gold_sentence, predicted)) and \
                all(x.fragment == y.fragment and x.typ == y.typ for x, y in zip(gold_sentence, predicted))
 
 
+    def gold_context(self, sentence : AMSentence, decisions : List[Decision]) -> Dict[str, np.array]:
+        return gold_context([d.position for d in decisions], len(sentence), self.pop_with_0,
+                            children_first=True, reverse_push_actions=self.reverse_push_actions)
+
     def initial_state(self, sentence : AMSentence, decoder_state : Any) -> ParsingState:
         stack = [0]
         seen = set()
@@ -169,7 +165,7 @@ class DFSChildrenFirst(UnconstrainedTransitionSystem):
                 # push onto stack
                 copy.substack.append(position)
 
-            copy.seen.add(position)
+            copy.mark_seen(position)
             if copy.stack:
                 copy.active_node = copy.stack[-1]
             else:
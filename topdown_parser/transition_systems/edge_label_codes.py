@@ -0,0 +1,83 @@
+from typing import List, Dict, Tuple, Iterable
+
+from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
+from .lexicon_ids import LexiconIds, bits
+
+# operations of edge labels
+APP = 0
+MOD = 1
+ROOT = 2
+OTHER = 3
+
+NO_SOURCE = -1
+
+
+def popcount(mask : int) -> int:
+    return bin(mask).count("1")
+
+
+class EdgeLabelCodes:
+    """
+    Integer codes for edge labels and sources, so that transition systems don't have to take edge labels apart
+    with string operations in every step. Edge labels are identified by their ids in labels: the id in the lexicon or,
+    for labels that are not in the lexicon (e.g. APP_x if only MOD_x occurs in the training data), an id of the side table.
+    Sets of sources (e.g. apply sets) are represented as bitmasks, source i is bit 1 << i.
+    Sources that are not part of any edge label of the lexicon get a code when they are first seen.
+    """
+
+    def __init__(self, lexicon : AdditionalLexicon, sources : Iterable[str] = ()):
+        """
+        :param sources: sources that get the first codes, in this order.
+        """
+        self.lexicon = lexicon
+        self.labels = LexiconIds(lexicon, "edge_labels", "IGNORE")
+        self.i2source : List[str] = []
+        self.source2i : Dict[str, int] = dict()
+        self.app_ids : List[int] = [] # id of the scores of the edge label APP_source for every source (UNK id if the lexicon doesn't contain it)
+        self.app_label_ids : List[int] = [] # id of the edge label APP_source for every source
+        self.id2info : Dict[int, Tuple[int, int]] = dict()
+
+        for source in sources:
+            self.source_id(source)
+        for _, i in sorted(lexicon.sublexica["edge_labels"], key=lambda p: p[1]):
+            self.label_info(i)
+
+    def source_id(self, source : str) -> int:
+        i = self.source2i.get(source)
+        if i is None:
+            i = len(self.i2source)
+            self.i2source.append(source)
+            self.source2i[source] = i
+            self.app_label_ids.append(self.labels.id("APP_"+source))
+            self.app_ids.append(self.lexicon.get_id("edge_labels", "APP_"+source))
+        return i
+
+    def label_info(self, label_id : int) -> Tuple[int, int]:
+        """
+        Returns the operation (APP, MOD, ROOT or OTHER) of the edge label and the id of its source (NO_SOURCE if it has none).
+        """
+        info = self.id2info.get(label_id)
+        if info is None:
+            label = self.labels.str(label_id)
+            if label.startswith("APP_"):
+                info = (APP, self.source_id(label.split("_")[1]))
+            elif label.startswith("MOD_"):
+                info = (MOD, self.source_id(label.split("_")[1]))
+            elif label == "ROOT":
+                info = (ROOT, NO_SOURCE)
+            else:
+                info = (OTHER, NO_SOURCE)
+            self.id2info[label_id] = info
+        return info
+
+    def mask(self, sources : Iterable[str]) -> int:
+        m = 0
+        for source in sources:
+            m |= 1 << self.source_id(source)
+        return m
+
+    def source_ids(self, mask : int) -> List[int]:
+        """
+        The ids of the sources in the mask, in ascending order.
+        """
+        return bits(mask)
@@ -79,6 +79,7 @@ class GPUDFSChildrenFirst(DFSChildrenFirst):
 
         mask = mask.long()
         mask *= state.position_mask()  # shape (batch_size, input_seq_len)
+        valid_choices = mask.bool()
 
         mask = (1-mask)*10_000_000
         vals, selected_nodes = torch.max(children_scores - mask, dim=1)
@@ -98,7 +99,7 @@ class GPUDFSChildrenFirst(DFSChildrenFirst):
         constants = torch.argmax(scores["constants_scores"], 1)
         lex_labels = scores["lex_labels"]
 
-        return DecisionBatch(selected_nodes, push_mask, pop_mask, edge_labels, constants, None, lex_labels, pop_mask)
+        return DecisionBatch(selected_nodes, push_mask, pop_mask, edge_labels, constants, None, lex_labels, pop_mask, valid_choices)
 
     def gpu_step(self, state: GPUDFSChildrenFirstState, decision_batch: DecisionBatch) -> None:
         """
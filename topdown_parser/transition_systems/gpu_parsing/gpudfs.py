@@ -66,6 +66,7 @@ class GPUDFS(DFS):
 
         mask = mask.long()
         mask *= state.position_mask()  # shape (batch_size, input_seq_len)
+        valid_choices = mask.bool()
 
         mask = (1-mask)*10_000_000
         vals, selected_nodes = torch.max(children_scores - mask, dim=1)
@@ -88,7 +89,7 @@ class GPUDFS(DFS):
 
         constant_mask = state.constant_mask()[state.stack.batch_range, active_nodes]
         constant_mask *= not_done
-        return DecisionBatch(selected_nodes, push_mask, pop_mask, edge_labels, constants, term_types, lex_labels, constant_mask)
+        return DecisionBatch(selected_nodes, push_mask, pop_mask, edge_labels, constants, term_types, lex_labels, constant_mask, valid_choices)
 
     def gpu_step(self, state: BatchedParsingState, decision_batch: DecisionBatch) -> None:
         """
@@ -4,7 +4,7 @@ import numpy as np
 import torch
 
 from topdown_parser.am_algebra import AMType
-from topdown_parser.am_algebra.new_amtypes import ModCache
+from topdown_parser.am_algebra.new_amtypes import ModCache, CandidateLexTypeIndex
 from topdown_parser.am_algebra.tree import Tree
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
@@ -66,13 +66,14 @@ class GPULTL(LTL):
     def __init__(self, children_order: str, pop_with_0: bool,
                  additional_lexicon: AdditionalLexicon,
                  reverse_push_actions: bool = False,
-                 enable_assert : bool = False):
+                 enable_assert : bool = False,
+                 type_cache_size : Optional[int] = 100_000):
         """
         Select children_order : "LR" (left to right) or "IO" (inside-out, recommended by Ma et al.)
         reverse_push_actions means that the order of push actions is the opposite order in which the children of
         the node are recursively visited.
         """
-        super().__init__(children_order, pop_with_0, additional_lexicon, reverse_push_actions)
+        super().__init__(children_order, pop_with_0, additional_lexicon, reverse_push_actions, type_cache_size)
         self.enable_assert = enable_assert
 
         self.i2source = sorted({label.split("_")[1] for label, _ in self.additional_lexicon.sublexica["edge_labels"] if "_" in label})
@@ -102,18 +103,8 @@ class GPULTL(LTL):
             lexical2constant[self.lextyp2i[lex_type], constant_id] = 1
             constant2lexical[constant_id] = self.lextyp2i[lex_type]
 
-        apply_reachable_from : Dict[AMType, Set[Tuple[AMType, frozenset]]] = dict()
-        for t1 in self.lextyp2i.keys():
-            if t1.is_bot:
-                continue
-            for t2 in self.lextyp2i.keys():
-                if t2.is_bot:
-                    continue
-                applyset = t1.get_apply_set(t2)
-                if applyset is not None:
-                    if t2 not in apply_reachable_from:
-                        apply_reachable_from[t2] = set()
-                    apply_reachable_from[t2].add((t1, frozenset(applyset)))
+        # which (non-bottom) lexical types can reach a term type and with which apply set?
+        apply_reachable_from = CandidateLexTypeIndex([t for t in self.lextyp2i.keys() if not t.is_bot], self.type_cache)
 
         root_id = self.additional_lexicon.get_id("edge_labels", "ROOT")
         for parent_lex_typ, parent_id in self.lextyp2i.items():
@@ -134,7 +125,7 @@ class GPULTL(LTL):
 
                     get_term_types[parent_id, label_id, self.lextyp2i[t]] = True
 
-                    for possible_lexical_type, applyset in apply_reachable_from[t]:
+                    for possible_lexical_type, applyset in apply_reachable_from.get_candidates_with_apply_set(t, set(), len(apply_reachable_from.i2source)):
                         current_typ_id = self.lextyp2i[possible_lexical_type]
 
                         apply_reachable_term_types[self.lextyp2i[t], current_typ_id] = True
@@ -145,12 +136,12 @@ class GPULTL(LTL):
 
             # APP
             for source in parent_lex_typ.nodes():
-                req = parent_lex_typ.get_request(source)
+                req = self.type_cache.get_request(parent_lex_typ, source)
                 label_id = self.additional_lexicon.get_id("edge_labels", "APP_"+source)
 
                 get_term_types[parent_id, label_id, self.lextyp2i[req]] = True
 
-                for possible_lexical_type, applyset in apply_reachable_from[req]:
+                for possible_lexical_type, applyset in apply_reachable_from.get_candidates_with_apply_set(req, set(), len(apply_reachable_from.i2source)):
                     current_typ_id = self.lextyp2i[possible_lexical_type]
 
                     apply_reachable_term_types[self.lextyp2i[req], current_typ_id] = True
@@ -271,13 +262,14 @@ class GPULTL(LTL):
                 push_mask = torch.zeros(batch_size, dtype=torch.bool, device=get_device_id(children_scores))
                 edge_labels = torch.argmax(scores["all_labels_scores"][:, 0], 1) #shape (batch_size,) -- dummy labels
 
+            valid_choices = mask.bool()
             mask = (1-mask.long())*10_000_000
             _, selected_nodes = torch.max(children_scores - mask, dim=1)
 
             constants = torch.zeros_like(edge_labels)
             lex_labels = scores["lex_labels"]
 
-            return DecisionBatch(selected_nodes, push_mask, ~push_mask, edge_labels, constants, None, lex_labels, ~push_mask)
+            return DecisionBatch(selected_nodes, push_mask, ~push_mask, edge_labels, constants, None, lex_labels, ~push_mask, valid_choices)
 
         parents = state.heads[batch_range, active_nodes] #shape (batch_size,); parents[b] = state.heads[b,active_nodes[b]]
         lexical_type_parent = state.lex_types[batch_range, parents] #shape (batch_size, ); lexical_type_parent[b] = state.lex_types[b,parents[b]]
@@ -324,6 +316,7 @@ class GPULTL(LTL):
 
         mask = mask.long()
         mask *= state.position_mask()  # shape (batch_size, input_seq_len)
+        valid_choices = mask.bool()
 
         mask = (1-mask)*10_000_000
         vals, selected_nodes = torch.max(children_scores - mask, dim=1)
@@ -395,7 +388,7 @@ class GPULTL(LTL):
 
         lex_labels = scores["lex_labels"]
 
-        return DecisionBatch(selected_nodes, push_mask, pop_mask, edge_labels, selected_constants, None, lex_labels, pop_mask)
+        return DecisionBatch(selected_nodes, push_mask, pop_mask, edge_labels, selected_constants, None, lex_labels, pop_mask, valid_choices)
 
 
 
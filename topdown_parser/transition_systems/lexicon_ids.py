@@ -0,0 +1,120 @@
+from typing import List, Dict, Iterable, Sequence
+
+from topdown_parser.am_algebra import AMType
+from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
+from topdown_parser.dataset_readers.amconll_tools import AMSentence
+from .decision import Decision
+
+# id of "no value" in the id buffers of parsing states
+NO_ID = -1
+
+
+def bits(mask : int) -> List[int]:
+    """
+    The positions of the bits that are set in the mask, in ascending order.
+    """
+    ids = []
+    i = 0
+    while mask:
+        if mask & 1:
+            ids.append(i)
+        mask >>= 1
+        i += 1
+    return ids
+
+
+class LexiconIds:
+    """
+    Ids of the strings of one namespace of the additional lexicon. Strings that are not in the lexicon
+    (e.g. gold constants that don't occur in the training data) get negative ids from a side table, so they survive the
+    round trip through the id buffers of parsing states. The side table only grows with such strings.
+    """
+
+    def __init__(self, lexicon : AdditionalLexicon, namespace : str, default : str):
+        """
+        :param default: the string of NO_ID
+        """
+        self.lexicon = lexicon
+        self.namespace = namespace
+        self.default = default
+        self.side_table : List[str] = []
+        self.side_ids : Dict[str, int] = dict()
+
+    def id(self, s : str) -> int:
+        # look at the side table first, so a string keeps its id if it is added to the lexicon later.
+        i = self.side_ids.get(s)
+        if i is not None:
+            return i
+        if self.lexicon.contains(self.namespace, s):
+            return self.lexicon.get_id(self.namespace, s)
+        i = NO_ID - 1 - len(self.side_table)
+        self.side_table.append(s)
+        self.side_ids[s] = i
+        return i
+
+    def str(self, i : int) -> str:
+        if i >= 0:
+            return self.lexicon.get_str_repr(self.namespace, i)
+        if i == NO_ID:
+            return self.default
+        return self.side_table[NO_ID - 1 - i]
+
+
+class TypeIds:
+    """
+    Interns AM types: a type gets an id when it is first seen, sets of types are bitsets (type i is bit 1 << i).
+    The table only grows with the types of the lexicon, the types derived from them and the types of gold trees.
+    """
+
+    def __init__(self, types : Iterable[AMType] = ()):
+        """
+        :param types: types that get the first ids, in this order.
+        """
+        self.i2typ : List[AMType] = []
+        self.typ2i : Dict[AMType, int] = dict()
+        for typ in types:
+            self.id(typ)
+
+    def id(self, typ : AMType) -> int:
+        i = self.typ2i.get(typ)
+        if i is None:
+            i = len(self.i2typ)
+            self.i2typ.append(typ)
+            self.typ2i[typ] = i
+        return i
+
+    def mask(self, types : Iterable[AMType]) -> int:
+        m = 0
+        for typ in types:
+            m |= 1 << self.id(typ)
+        return m
+
+
+class AnnotationIds:
+    """
+    The id tables of parsing states that keep edge labels, constants and lexical labels as ids (see LTF and LTL).
+    Decisions of these transition systems carry ids, gold decisions carry strings, which are looked up when the decision is applied.
+    """
+
+    def __init__(self, lexicon : AdditionalLexicon, labels : LexiconIds):
+        self.labels = labels
+        self.constants = LexiconIds(lexicon, "constants", "_--TYPE--_")
+        self.lex_labels = LexiconIds(lexicon, "lex_labels", "_")
+
+    def label_id(self, decision : Decision) -> int:
+        return decision.label_id if decision.label_id is not None else self.labels.id(decision.label)
+
+    def constant_id(self, decision : Decision) -> int:
+        return decision.constant_id if decision.constant_id is not None else self.constants.id("--TYPE--".join(decision.supertag))
+
+    def lex_label_id(self, decision : Decision) -> int:
+        return decision.lex_label_id if decision.lex_label_id is not None else self.lex_labels.id(decision.lexlabel)
+
+    def annotate(self, sentence : AMSentence, heads : List[int], edge_labels : Sequence[int], constants : Sequence[int],
+                 lex_labels : Sequence[int]) -> AMSentence:
+        """
+        The sentence with the annotation given as ids.
+        """
+        return sentence.with_annotation(heads, [self.labels.str(i) for i in edge_labels],
+                                        [AMSentence.split_supertag(self.constants.str(i)) for i in constants],
+                                        [self.lex_labels.str(i) for i in lex_labels])
@@ -2,30 +2,35 @@
 import heapq
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import List, Iterable, Optional, Tuple, Dict, Any, Set
+from typing import List, Iterable, Optional, Tuple, Dict, Any, Set, Hashable
 
 import torch
 from allennlp.common.checks import ConfigurationError
 
 from topdown_parser.am_algebra import AMType, NonAMTypeException, new_amtypes
-from topdown_parser.am_algebra.new_amtypes import CandidateLexType, ModCache, ReadCache
+from topdown_parser.am_algebra.new_amtypes import CandidateLexTypeIndex, ModCache, ReadCache, TypeOperationCache, LRUCache
 from topdown_parser.am_algebra.tools import get_term_types
-from topdown_parser.am_algebra.tree import Tree
+from topdown_parser.am_algebra.tree import ArrayTree
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
 from topdown_parser.nn.edge_label_model import EdgeLabelModel
-from topdown_parser.nn.utils import get_device_id
+from topdown_parser.nn.utils import get_device_id, index_tensor_dict
 from topdown_parser.transition_systems import utils
-from topdown_parser.transition_systems.parsing_state import ParsingState
+from topdown_parser.transition_systems.parsing_state import ParsingState, batch_seen_masks
 from topdown_parser.transition_systems.transition_system import TransitionSystem
 from .decision import Decision
+from .edge_label_codes import EdgeLabelCodes, popcount, APP, MOD, ROOT
+from .lexicon_ids import AnnotationIds, TypeIds, NO_ID, bits
 from topdown_parser.transition_systems.utils import scores_to_selection, get_best_constant, single_score_to_selection, \
-    is_empty, get_top_k_choices, copy_optional_set
+    is_empty, top_k_indices, ordered_children, gold_context
 
 import numpy as np
 
 from .dfs import DFS
 
+# operation of candidate decisions that pop the active node, see LTF.top_k_decision
+_POP = -1
+
 
 def typ2supertag(lexicon : AdditionalLexicon) -> Dict[AMType, Set[int]]:
     _typ2supertag : Dict[AMType, Set[int]] = dict() #which supertags have the given type?
@@ -42,6 +47,40 @@ def typ2supertag(lexicon : AdditionalLexicon) -> Dict[AMType, Set[int]]:
             print("Skipping type", typ)
     return _typ2supertag
 
+class SupertagIndex:
+    """
+    typ2supertag in CSR format: lexical type i has the constants constants[offsets[i]:offsets[i+1]].
+    This allows to find the best constant of every lexical type with one segment-max over the constant scores.
+    """
+
+    def __init__(self, _typ2supertag : Dict[AMType, Set[int]], lex_types : Optional[List[AMType]] = None):
+        """
+        :param lex_types: the lexical types to index, in the order of their ids. Defaults to all types of _typ2supertag.
+        """
+        self.i2typ : List[AMType] = list(_typ2supertag.keys()) if lex_types is None else list(lex_types)
+        self.typ2i : Dict[AMType, int] = {typ : i for i, typ in enumerate(self.i2typ)}
+        self.offsets = np.cumsum([0] + [len(_typ2supertag[typ]) for typ in self.i2typ])
+        self.constants = np.array([c for typ in self.i2typ for c in sorted(_typ2supertag[typ])], dtype=np.int64)
+        self.positions = np.arange(len(self.constants))
+        self.lengths = np.diff(self.offsets)
+
+    def best_constants(self, constant_scores : np.array) -> Tuple[np.array, np.array]:
+        """
+        Returns the id of the best constant and its score for every lexical type.
+        :param constant_scores: shape (constant vocab size) or (batch_size, constant vocab size)
+        :return: two arrays of shape (number of lexical types,) or (batch_size, number of lexical types)
+        """
+        if len(self.i2typ) == 0:
+            shape = constant_scores.shape[:-1] + (0,)
+            return np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=constant_scores.dtype)
+        scores = constant_scores[..., self.constants]
+        maxima = np.maximum.reduceat(scores, self.offsets[:-1], axis=-1)
+        # in case of ties, take the first constant of the segment.
+        is_max = scores == np.repeat(maxima, self.lengths, axis=-1)
+        first_max = np.minimum.reduceat(np.where(is_max, self.positions, len(self.positions)), self.offsets[:-1], axis=-1)
+        return self.constants[first_max], maxima
+
+
 def typ2i(additional_lexicon : AdditionalLexicon) -> Dict[AMType, int]:
     _typ2i :  Dict[AMType, int] = dict()
     for typ, i in additional_lexicon.sublexica["term_types"]:
@@ -58,28 +97,87 @@ def collect_sources(additional_lexicon : AdditionalLexicon) -> Set[str]:
             sources.add(label.split("_")[1])
     return sources
 
+class TypeIdOperations:
+    """
+    The type operations of LTF and LTL on type ids (see TypeIds) and source ids (see EdgeLabelCodes).
+    Each operation has its own LRU table with at most max_size entries (None = unbounded).
+    """
+
+    def __init__(self, types : TypeIds, label_codes : EdgeLabelCodes, ids : AnnotationIds, read_cache : ReadCache,
+                 type_cache : TypeOperationCache, mod_cache : ModCache, max_size : Optional[int]):
+        self.types = types
+        self.label_codes = label_codes
+        self.ids = ids
+        self.read_cache = read_cache
+        self.type_cache = type_cache
+        self.mod_cache = mod_cache
+        self.constant_types = LRUCache(max_size)
+        self.apply_sets = LRUCache(max_size)
+        self.requests = LRUCache(max_size)
+        self.modifiers = LRUCache(max_size)
+
+    def constant_type(self, constant : int) -> int:
+        """
+        The type id of the type of the constant with the given id (see AnnotationIds).
+        """
+        return self.constant_types.get(constant, lambda: self.types.id(self.read_cache.parse_str(AMSentence.split_supertag(self.ids.constants.str(constant))[1])))
+
+    def apply_set(self, lex_type : int, term_type : int) -> Optional[int]:
+        """
+        The apply set from the lexical type to the term type as bitmask of sources, None if there is none.
+        """
+        def compute():
+            apply_set = self.type_cache.get_apply_set(self.types.i2typ[lex_type], self.types.i2typ[term_type])
+            return None if apply_set is None else self.label_codes.mask(apply_set)
+        return self.apply_sets.get((lex_type, term_type), compute)
+
+    def request(self, lex_type : int, source : int) -> int:
+        return self.requests.get((lex_type, source), lambda: self.types.id(self.type_cache.get_request(self.types.i2typ[lex_type], self.label_codes.i2source[source])))
+
+    def modifier_types(self, lex_type : int, source : int) -> int:
+        """
+        The bitset of the types that can modify the lexical type with the source.
+        """
+        return self.modifiers.get((lex_type, source), lambda: self.types.mask(self.mod_cache.get_modifiers_with_source(self.types.i2typ[lex_type], self.label_codes.i2source[source])))
+
+
 class LTFState(ParsingState):
+    """
+    Edge labels, constants and lexical labels are ids (see AnnotationIds, NO_ID if they are not set yet),
+    lexical types are type ids and term types bitsets of type ids (see TypeIds).
+    Apply sets that still have to be filled are bitmasks of sources (see EdgeLabelCodes), None for nodes without a lexical type.
+    sources_left is the total number of sources in them.
+    """
+
+    __slots__ = ["lexical_types", "applysets_todo", "sources_left", "words_left", "root_determined", "term_types", "ids"]
 
     def __init__(self, decoder_state: Any, active_node: int, score: float, sentence: AMSentence,
-                 lexicon: AdditionalLexicon, heads: List[int], children: Dict[int, List[int]], edge_labels: List[str],
-                 constants: List[Tuple[str, str]], lex_labels: List[str], stack: List[int], seen: Set[int],
-                 lexical_types: List[AMType], term_types : List[Set[AMType]], applysets_todo: List[Optional[Set[str]]], words_left : int, root_determined : bool):
+                 lexicon: AdditionalLexicon, heads: List[int], children: Dict[int, List[int]], edge_labels: np.array,
+                 constants: np.array, lex_labels: np.array, stack: List[int], seen: Set[int],
+                 lexical_types: np.array, term_types : List[int], applysets_todo: List[Optional[int]], words_left : int, root_determined : bool,
+                 ids : AnnotationIds, sources_left : int = 0):
         super().__init__(decoder_state, active_node, score, sentence, lexicon, heads, children, edge_labels, constants,
                          lex_labels, stack, seen)
         self.lexical_types = lexical_types
         self.applysets_todo = applysets_todo
+        self.sources_left = sources_left
         self.words_left = words_left
         self.root_determined = root_determined
         self.term_types = term_types
+        self.ids = ids
 
     def copy(self) -> "ParsingState":
         return LTFState(self.decoder_state, self.active_node, self.score, self.sentence,
-                        self.lexicon, list(self.heads), {node: list(children) for node, children in self.children.items()}, list(self.edge_labels),
-                        list(self.constants), list(self.lex_labels), list(self.stack), set(self.seen),
-                        list(self.lexical_types), [set(s) for s in self.term_types], copy_optional_set(self.applysets_todo), self.words_left, self.root_determined)
+                        self.lexicon, list(self.heads), {node: list(children) for node, children in self.children.items()}, self.edge_labels.copy(),
+                        self.constants.copy(), self.lex_labels.copy(), list(self.stack), set(self.seen),
+                        self.lexical_types.copy(), list(self.term_types), list(self.applysets_todo), self.words_left, self.root_determined,
+                        self.ids, self.sources_left)
+
+    def extract_tree(self) -> AMSentence:
+        return self.ids.annotate(self.sentence, self.heads, self.edge_labels, self.constants, self.lex_labels)
 
     def sources_to_be_filled(self) -> int:
-        return sum(len(a) if a is not None else 0 for a in self.applysets_todo)
+        return self.sources_left
 
     def is_complete(self) -> bool:
         complete = self.stack == []
@@ -95,9 +193,10 @@ class LTF(TransitionSystem):
     Lexical type first strategy.
     """
 
-    def __init__(self, children_order: str, pop_with_0: bool, additional_lexicon : AdditionalLexicon):
+    def __init__(self, children_order: str, pop_with_0: bool, additional_lexicon : AdditionalLexicon, type_cache_size : Optional[int] = 100_000):
         """
         Select children_order : "LR" (left to right) or "IO" (inside-out, recommended by Ma et al.)
+        type_cache_size bounds the number of memoised results per type operation and of types read from strings (None = unbounded).
         """
         super().__init__(additional_lexicon)
         self.pop_with_0 = pop_with_0
@@ -109,16 +208,32 @@ class LTF(TransitionSystem):
 
         self.typ2i :  Dict[AMType, int] = typ2i(self.additional_lexicon) # which type has what id?
 
-        self.candidate_lex_types = new_amtypes.CandidateLexType({typ for typ in self.typ2i.keys()})
-
         #self.subtype_cache = SubtypeCache(self.typ2i.keys())
         self.mod_cache = ModCache(self.typ2i.keys())
 
         self.sources: Set[str] = collect_sources(self.additional_lexicon)
         modify_sources = {source for source in self.sources if self.additional_lexicon.contains("edge_labels", "MOD_"+source) }
         self.modify_ids = {self.additional_lexicon.get_id("edge_labels", "MOD_"+source) for source in modify_sources} #ids of modify edges
-
-        self.read_cache = ReadCache()
+        self.modify_id_array = np.array(sorted(self.modify_ids), dtype=np.int64)
+        self.label_codes = EdgeLabelCodes(self.additional_lexicon)
+        self.ids = AnnotationIds(self.additional_lexicon, self.label_codes.labels)
+        self.root_label = self.label_codes.labels.id("ROOT")
+
+        self.read_cache = ReadCache(type_cache_size)
+        self.type_cache = TypeOperationCache(type_cache_size)
+
+        # the term types of the lexicon get the first type ids, term_type_columns[i] is the id of term type i in the lexicon.
+        self.types = TypeIds(self.typ2i.keys())
+        self.term_type_columns = np.array(list(self.typ2i.values()), dtype=np.int64)
+        self.root_type = self.types.id(AMType.parse_str("()"))
+        self.type_ids = TypeIdOperations(self.types, self.label_codes, self.ids, self.read_cache, self.type_cache,
+                                         self.mod_cache, type_cache_size)
+
+        # lexical types that can be selected, both indices share their ids.
+        lex_types = [typ for typ in self.typ2supertag.keys() if typ in self.typ2i]
+        self.supertag_index = SupertagIndex(self.typ2supertag, lex_types)
+        self.candidate_lex_types = CandidateLexTypeIndex(lex_types, self.type_cache)
+        self.candidate_type_ids = np.array([self.types.id(typ) for typ in lex_types], dtype=np.int64)
 
     def predict_supertag_from_tos(self) -> bool:
         return True
@@ -145,67 +260,59 @@ class LTF(TransitionSystem):
             raise ConfigurationError("ltf transition system requires tagger for constants")
 
     def get_order(self, sentence: AMSentence) -> Iterable[Decision]:
-        t = Tree.from_am_sentence(sentence)
-        term_types = get_term_types(sentence)
-
-        def _construct_seq(tree: Tree, is_first_child : bool, parent_type : Tuple[str, str], parent_lex_label : str, parent_term_type : AMType) -> List[Decision]:
-            own_position = tree.node[0]
-            to_left = []
-            to_right = []
-            for child in tree.children:
-                if child.node[1].label == "IGNORE":
-                    continue
-
-                if child.node[0] < own_position:
-                    to_left.append(child)
+        t = ArrayTree.from_am_sentence(sentence)
+        term_types = get_term_types(sentence, self.type_cache)
+
+        ret = []
+        # agenda items: (node, is first child?, parent) for entering a node, (node, None, None) for leaving it.
+        agenda = [(0, False, -1)]
+        while agenda:
+            own_position, is_first_child, parent = agenda.pop()
+            entry = t.nodes[own_position]
+
+            if is_first_child is None:
+                last_position = 0 if self.pop_with_0 else own_position
+                if t.arity(own_position) == 0:
+                    #This subtree has no children, thus also no first child at which we would determine the type of the parent
+                    #Let's determine the type now.
+                    ret.append(Decision(last_position, True, "", (entry.fragment, entry.typ),
+                                        entry.lexlabel, term_types[own_position-1]))
                 else:
-                    to_right.append(child)
+                    ret.append(Decision(last_position, True, "", ("",""), ""))
+                continue
 
             if is_first_child:
-                beginning = [Decision(own_position, False, tree.node[1].label, parent_type, parent_lex_label, parent_term_type)]
+                parent_entry = t.nodes[parent]
+                ret.append(Decision(own_position, False, entry.label, (parent_entry.fragment, parent_entry.typ),
+                                    parent_entry.lexlabel, term_types[parent-1]))
             else:
-                beginning = [Decision(own_position, False, tree.node[1].label, ("", ""), "")]
+                ret.append(Decision(own_position, False, entry.label, ("", ""), ""))
 
-            if self.children_order == "LR":
-                children = to_left + to_right
-            elif self.children_order == "IO":
-                children = list(reversed(to_left)) + to_right
-            else:
-                raise ValueError("Unknown children order: " + self.children_order)
-
-            ret = beginning
-            for i, child in enumerate(children):
-                ret.extend(_construct_seq(child, i == 0, (tree.node[1].fragment, tree.node[1].typ), tree.node[1].lexlabel, term_types[own_position-1]))
-
-            last_position = 0 if self.pop_with_0 else own_position
-            if len(tree.children) == 0:
-                #This subtree has no children, thus also no first child at which we would determine the type of the parent
-                #Let's determine the type now.
-                last_decision = Decision(last_position, True, "", (tree.node[1].fragment, tree.node[1].typ),
-                                         tree.node[1].lexlabel, term_types[own_position-1])
-            else:
-                last_decision = Decision(last_position, True, "", ("",""), "")
-            ret.append(last_decision)
-            return ret
+            agenda.append((own_position, None, None))
+            children = ordered_children(t, own_position, self.children_order)
+            agenda.extend((child, i == 0, own_position) for i, child in reversed(list(enumerate(children))))
 
-        return _construct_seq(t, False, ("",""),"", AMType.parse_str("_"))
+        return ret
+
+    def gold_context(self, sentence : AMSentence, decisions : List[Decision]) -> Dict[str, np.array]:
+        return gold_context([d.position for d in decisions], len(sentence), self.pop_with_0)
 
     def initial_state(self, sentence : AMSentence, decoder_state : Any) -> ParsingState:
         stack = [0]
         seen = set()
         heads = [0 for _ in range(len(sentence))]
         children = {i: [] for i in range(len(sentence) + 1)}
-        labels = ["IGNORE" for _ in range(len(sentence))]
-        lex_labels = ["_" for _ in range(len(sentence))]
-        supertags = [("_","_") for _ in range(len(sentence))]
-        lexical_types = [AMType.parse_str("_") for _ in range(len(sentence))]
-        term_types = [set() for _ in range(len(sentence))]
+        labels = np.full(len(sentence), NO_ID, dtype=np.int64)
+        lex_labels = np.full(len(sentence), NO_ID, dtype=np.int64)
+        supertags = np.full(len(sentence), NO_ID, dtype=np.int64)
+        lexical_types = np.full(len(sentence), NO_ID, dtype=np.int64)
+        term_types = [0 for _ in range(len(sentence))]
         applysets_todo = [None for _ in range(len(sentence))]
 
         return LTFState(decoder_state, 0, 0.0, sentence,
                         self.additional_lexicon, heads, children, labels,
                         supertags, lex_labels, stack, seen,
-                        lexical_types, term_types, applysets_todo, len(sentence), False)
+                        lexical_types, term_types, applysets_todo, len(sentence), False, self.ids)
 
     def step(self, state: LTFState, decision: Decision, in_place: bool = False) -> ParsingState:
         if in_place:
@@ -214,21 +321,24 @@ class LTF(TransitionSystem):
             copy = state.copy()
 
         if state.stack:
-            if copy.constants[state.active_node-1] == ("_","_") and state.active_node != 0:
+            if copy.constants[state.active_node-1] == NO_ID and state.active_node != 0:
                 # first time that state.active_node has become active.
-                copy.constants[state.active_node-1] = decision.supertag
-                copy.lex_labels[state.active_node-1] = decision.lexlabel
+                constant = self.ids.constant_id(decision)
+                copy.constants[state.active_node-1] = constant
+                copy.lex_labels[state.active_node-1] = self.ids.lex_label_id(decision)
 
                 # Determine apply set which we have to fulfill.
-                lex_type = self.read_cache.parse_str(decision.supertag[1])
+                lex_type = self.type_ids.constant_type(constant)
                 copy.lexical_types[state.active_node-1] = lex_type
-                term_type = decision.termtyp
-                applyset = lex_type.get_apply_set(term_type)
-                assert term_type in copy.term_types[state.active_node-1]
+                term_type = decision.termtyp_id if decision.termtyp_id is not None else self.types.id(decision.termtyp)
+                assert copy.term_types[state.active_node-1] >> term_type & 1
+                applyset = self.type_ids.apply_set(lex_type, term_type)
+                assert applyset is not None
 
-                copy.term_types[state.active_node-1] = {term_type}
+                copy.term_types[state.active_node-1] = 1 << term_type
 
                 copy.applysets_todo[state.active_node-1] = applyset
+                copy.sources_left += popcount(applyset)
 
             if decision.position == 0 and self.pop_with_0:
                 copy.stack.pop()
@@ -241,28 +351,32 @@ class LTF(TransitionSystem):
 
                 copy.children[copy.stack[-1]].append(decision.position)  # 1-based
 
-                copy.edge_labels[decision.position - 1] = decision.label
+                label = self.ids.label_id(decision)
+                copy.edge_labels[decision.position - 1] = label
 
-                tos_lexical_type = copy.lexical_types[copy.stack[-1]-1]
-                if decision.label.startswith("APP_"):
-                    source = decision.label.split("_")[1]
-                    copy.applysets_todo[copy.stack[-1]-1].remove(source) #remove obligation to fill source.
+                tos_lexical_type = int(copy.lexical_types[copy.stack[-1]-1])
+                operation, source_id = self.label_codes.label_info(label)
+                if operation == APP:
+                    bit = 1 << source_id
+                    if not copy.applysets_todo[copy.stack[-1]-1] & bit:
+                        raise KeyError(self.label_codes.i2source[source_id])
+                    copy.applysets_todo[copy.stack[-1]-1] &= ~bit #remove obligation to fill source.
+                    copy.sources_left -= 1
 
-                    copy.term_types[decision.position-1] = {tos_lexical_type.get_request(source)}
+                    copy.term_types[decision.position-1] = 1 << self.type_ids.request(tos_lexical_type, source_id)
 
-                elif decision.label.startswith("MOD_"):
-                    source = decision.label.split("_")[1]
-                    copy.term_types[decision.position-1] = set(self.mod_cache.get_modifiers_with_source(tos_lexical_type, source)) #TODO speed improvement?
+                elif operation == MOD:
+                    copy.term_types[decision.position-1] = self.type_ids.modifier_types(tos_lexical_type, source_id)
 
-                elif decision.label == "ROOT" and not copy.root_determined:
-                    copy.term_types[decision.position-1] = {AMType.parse_str("()")}
+                elif operation == ROOT and not copy.root_determined:
+                    copy.term_types[decision.position-1] = 1 << self.root_type
                 else:
-                    raise ValueError("Edge label "+decision.label+" not allowed here.")
+                    raise ValueError("Edge label "+self.label_codes.labels.str(label)+" not allowed here.")
 
                 # push onto stack
                 copy.stack.append(decision.position)
 
-            copy.seen.add(decision.position)
+            copy.mark_seen(decision.position)
 
             if not copy.stack:
                 copy.active_node = 0
@@ -275,79 +389,106 @@ class LTF(TransitionSystem):
         copy.score = copy.score + decision.score
         return copy
 
+    def needs_constant(self, state : LTFState) -> bool:
+        """
+        Does the next decision have to select a constant for the active node?
+        """
+        return state.root_determined and state.active_node != 0 and state.constants[state.active_node-1] == NO_ID
+
     def make_decision(self, scores: Dict[str, torch.Tensor], state : LTFState) -> Decision:
-        # Select node:
-        child_scores = scores["children_scores"].detach().cpu() # shape (input_seq_len)
         #Cannot select nodes that we have visited already.
-        nINF = -10e10
+        child_scores, _ = state.mask_seen(scores["children_scores"].detach().cpu(), 0 if self.pop_with_0 else state.active_node, -10e10)
+        scores = {name: tensor.detach().cpu().numpy() for name, tensor in scores.items()}
+        return self._make_decision(scores, child_scores.numpy(), state)
+
+    def make_decisions(self, scores: Dict[str, torch.Tensor], states : List[LTFState]) -> List[Decision]:
+        scores = {name: tensor.detach().cpu().numpy() for name, tensor in scores.items()}
+        pop_nodes = [0 if self.pop_with_0 else state.active_node for state in states]
+        child_scores = np.where(batch_seen_masks(states, pop_nodes, scores["children_scores"].shape[1]), -10e10, scores["children_scores"])
+
+        # best constant of every lexical type for all parsing states that need a constant.
+        needs_constant = [i for i, state in enumerate(states) if self.needs_constant(state)]
+        best = dict()
+        if needs_constant:
+            best_constants, best_constant_scores = self.supertag_index.best_constants(scores["constants_scores"][needs_constant])
+            best = {i : (best_constants[row], best_constant_scores[row]) for row, i in enumerate(needs_constant)}
 
-        for seen in state.seen:
-            if self.pop_with_0 and seen == 0:
-                pass
-            elif not self.pop_with_0 and seen == state.active_node:
-                pass
-            else:
-                child_scores[seen] = nINF
+        decisions = []
+        for i, state in enumerate(states):
+            decisions.append(self._make_decision(index_tensor_dict(scores, i), child_scores[i], state, best.get(i)))
+        return decisions
+
+    def _make_decision(self, scores: Dict[str, np.array], child_scores : np.array, state : LTFState,
+                       best_constants : Optional[Tuple[np.array, np.array]] = None) -> Decision:
+        """
+        :param scores: scores of this parsing state
+        :param child_scores: shape (input_seq_len), nodes that have been seen already are masked.
+        :param best_constants: result of SupertagIndex.best_constants for the constant scores, if already computed.
+        """
+        nINF = -10e10
+        child_scores = child_scores.copy()
 
         if not state.root_determined: # First decision must choose root.
             child_scores[0] = nINF
-            s, selected_node = torch.max(child_scores, dim=0)
-            return Decision(int(selected_node), False, "ROOT", ("",""), "",termtyp=None, score=float(s))
+            selected_node = np.argmax(child_scores)
+            return Decision(int(selected_node), False, label_id=self.root_label, score=float(child_scores[selected_node]))
 
         if state.active_node == 0:
-            return Decision(0, False, "", ("",""), "", termtyp=None, score=0.0)
+            return Decision(0, False, score=0.0)
 
         score = 0.0
-        constant_scores = scores["constants_scores"].cpu().numpy()
-        term_type_scores = scores["term_types_scores"].cpu().numpy()
+        constant_scores = scores["constants_scores"]
+        term_type_scores = scores["term_types_scores"]
 
-        selected_constant = ("","")
+        selected_constant = None
         selected_term_type = None
-        selected_lex_label = "_"
+        selected_lex_label = None
 
-        lexical_type_of_tos = state.lexical_types[state.active_node-1]
         applyset_todo_tos = state.applysets_todo[state.active_node-1]
 
         sources_to_be_filled = state.sources_to_be_filled()
 
         # Greedily choose best constant, if needed at this point.
-        if state.constants[state.active_node-1] == ("_","_"):
+        if state.constants[state.active_node-1] == NO_ID:
             # active node needs to get a lexical type, choose one.
-            selected_lex_label = self.additional_lexicon.get_str_repr("lex_labels", int(scores["lex_labels"].cpu().numpy()))
+            selected_lex_label = int(scores["lex_labels"])
 
-            possible_term_types = state.term_types[state.active_node-1]
             max_constant_score = -np.inf
-            best_constant = None
+            best_candidate_id = None
             best_term_type = None
 
-            for term_type in possible_term_types:
-                local_term_type_score = term_type_scores[self.typ2i[term_type]]
-                for lex_type in self.candidate_lex_types.get_candidates(term_type, state.words_left - sources_to_be_filled):
-                    best_local_constant, best_local_constant_score = get_best_constant(self.typ2supertag[lex_type], constant_scores)
-                    local_decision_score = best_local_constant_score + local_term_type_score
-
-                    if local_decision_score >= max_constant_score:
-                        max_constant_score = local_decision_score
-                        best_constant = best_local_constant
-                        best_term_type = term_type
-
-            assert best_constant is not None #we have to be able to find something here!
-            selected_constant = AMSentence.split_supertag(self.additional_lexicon.get_str_repr("constants", best_constant))
-            lexical_type_of_tos = self.read_cache.parse_str(selected_constant[1])
+            if best_constants is None:
+                best_constants = self.supertag_index.best_constants(constant_scores)
+            best_constants, best_constant_scores = best_constants
+
+            for term_type in bits(state.term_types[state.active_node-1]):
+                candidates = self.candidate_lex_types.candidate_ids(self.types.i2typ[term_type], state.words_left - sources_to_be_filled)
+                if len(candidates) == 0:
+                    continue
+                local_decision_scores = best_constant_scores[candidates] + term_type_scores[self.term_type_columns[term_type]]
+                best_candidate = np.argmax(local_decision_scores)
+
+                if local_decision_scores[best_candidate] >= max_constant_score:
+                    max_constant_score = local_decision_scores[best_candidate]
+                    best_candidate_id = candidates[best_candidate]
+                    best_term_type = term_type
+
+            assert best_candidate_id is not None #we have to be able to find something here!
+            selected_constant = int(best_constants[best_candidate_id])
             selected_term_type = best_term_type
-            applyset_todo_tos = lexical_type_of_tos.get_apply_set(selected_term_type)
+            applyset_todo_tos = self.type_ids.apply_set(int(self.candidate_type_ids[best_candidate_id]), selected_term_type)
             score += max_constant_score
-            sources_to_be_filled += len(applyset_todo_tos)
+            sources_to_be_filled += popcount(applyset_todo_tos)
 
         assert applyset_todo_tos is not None
 
         #Check if we must not close the current node
-        if applyset_todo_tos is not None and len(applyset_todo_tos) > 0:
+        if applyset_todo_tos is not None and applyset_todo_tos != 0:
             if self.pop_with_0:
                 child_scores[0] = nINF
             else:
                 child_scores[state.active_node] = nINF
-        elif applyset_todo_tos is not None and len(applyset_todo_tos) == 0 and state.words_left - sources_to_be_filled == 0:
+        elif applyset_todo_tos is not None and applyset_todo_tos == 0 and state.words_left - sources_to_be_filled == 0:
             # somewhere in the tree (but not here!) there are sources to fill
             # the number of words left exactly matches that. Since we don't have to fill a source here, we must pop!
             if self.pop_with_0:
@@ -355,22 +496,23 @@ class LTF(TransitionSystem):
             else:
                 child_scores[state.active_node] = 10e10
 
-        s, selected_node = torch.max(child_scores, dim=0)
-        score += s
+        selected_node = np.argmax(child_scores)
+        score += child_scores[selected_node]
 
         if (selected_node == 0 and self.pop_with_0) or (selected_node == state.active_node and not self.pop_with_0):
-            return Decision(int(selected_node), True, "", selected_constant, selected_lex_label, selected_term_type, score=score)
+            return Decision(int(selected_node), True, constant_id=selected_constant, lex_label_id=selected_lex_label,
+                            termtyp_id=selected_term_type, score=score)
 
         words_left_after_this = state.words_left - 1
 
-        label_scores = scores["all_labels_scores"][selected_node].cpu().numpy() #shape (edge vocab size)
+        label_scores = scores["all_labels_scores"][selected_node] #shape (edge vocab size)
 
         #Check if we want to do APP or MOD
         max_apply_score = -np.inf
         best_apply_source = None
 
-        for todo_source in applyset_todo_tos:
-            source_score = label_scores[self.additional_lexicon.get_id("edge_labels", "APP_"+todo_source)]
+        for todo_source in self.label_codes.source_ids(applyset_todo_tos):
+            source_score = label_scores[self.label_codes.app_ids[todo_source]]
             # TODO what if APP_todo_source is not a valid edge label? right now we get the UNK score.
             if source_score >= max_apply_score:
                 best_apply_source = todo_source
@@ -385,33 +527,43 @@ class LTF(TransitionSystem):
             best_modify_edge, max_mod_score = get_best_constant(self.modify_ids, label_scores)
 
         if max_apply_score > max_mod_score:
-            return Decision(int(selected_node), False, "APP_"+best_apply_source, selected_constant, selected_lex_label, selected_term_type, score=score+max_apply_score)
+            return Decision(int(selected_node), False, label_id=self.label_codes.app_label_ids[best_apply_source], constant_id=selected_constant,
+                            lex_label_id=selected_lex_label, termtyp_id=selected_term_type, score=score+max_apply_score)
         elif max_mod_score > -np.inf:
-            return Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels", best_modify_edge), selected_constant, selected_lex_label, selected_term_type, score=score+max_mod_score)
+            return Decision(int(selected_node), False, label_id=int(best_modify_edge), constant_id=selected_constant,
+                            lex_label_id=selected_lex_label, termtyp_id=selected_term_type, score=score+max_mod_score)
         else:
             raise ValueError("Could not perform any action. Bug.")
 
-    def top_k_lexical_types(self, constant_scores : np.array, term_type_scores : np.array, state : LTFState, k : int) -> List[Tuple[AMType, AMType, int, Set[str], float]]:
+    def top_k_lexical_types(self, constant_scores : np.array, term_type_scores : np.array, state : LTFState, k : int) -> List[Tuple[int, int, int, int, float]]:
+        """
+        The k best combinations of lexical type and term type for the active node, if it needs a lexical type.
+        :return: tuples of lexical type, term type (both type ids), best constant, apply set (as bitmask) and score
+        """
         typing_info = []
-        if state.constants[state.active_node-1] == ("_","_") and state.active_node != 0:
+        if state.constants[state.active_node-1] == NO_ID and state.active_node != 0:
             # active node needs to get a lexical type, choose one.
 
-            possible_term_types = state.term_types[state.active_node-1]
+            possible_term_types = bits(state.term_types[state.active_node-1])
             assert len(possible_term_types) > 0
 
             sources_to_be_filled = state.sources_to_be_filled()
 
-            for term_type in possible_term_types:
-                local_term_type_score = term_type_scores[self.typ2i[term_type]]
-                for lex_type in self.candidate_lex_types.get_candidates(term_type, state.words_left - sources_to_be_filled):
-                    best_local_constant, best_local_constant_score = get_best_constant(self.typ2supertag[lex_type], constant_scores)
-                    local_decision_score = best_local_constant_score + local_term_type_score
-                    applyset_todo_tos = lex_type.get_apply_set(term_type)
+            best_constants, best_constant_scores = self.supertag_index.best_constants(constant_scores)
 
-                    typing_info.append((lex_type, term_type, best_local_constant, applyset_todo_tos, local_decision_score))
+            for term_type in possible_term_types:
+                candidates = self.candidate_lex_types.candidate_ids(self.types.i2typ[term_type], state.words_left - sources_to_be_filled)
+                local_decision_scores = best_constant_scores[candidates] + term_type_scores[self.term_type_columns[term_type]]
+                # only the k best candidates per term type can make it into the overall top k.
+                for j in np.argsort(-local_decision_scores, kind="stable")[:k]:
+                    typing_info.append((candidates[j], term_type, local_decision_scores[j]))
             assert len(typing_info) > 0
 
-        return heapq.nlargest(k, typing_info, key=lambda tupl: tupl[-1])
+        ret = []
+        for candidate_id, term_type, local_decision_score in heapq.nlargest(k, typing_info, key=lambda tupl: tupl[-1]):
+            lex_type = int(self.candidate_type_ids[candidate_id])
+            ret.append((lex_type, term_type, int(best_constants[candidate_id]), self.type_ids.apply_set(lex_type, term_type), local_decision_score))
+        return ret
 
     def top_k_decision(self, scores: Dict[str, torch.Tensor], state: LTFState, k : int) -> List[Decision]:
 
@@ -420,7 +572,7 @@ class LTF(TransitionSystem):
                              "necessarily fit to the locally best child")
 
         if state.root_determined and state.active_node == 0:
-            return [Decision(0, False, "", ("",""), "", termtyp=None, score=0.0)]
+            return [Decision(0, False, score=0.0)]
 
 
         # Find best constants, if we have to choose them:
@@ -431,23 +583,17 @@ class LTF(TransitionSystem):
             if not state.root_determined: # fill in dummy values
                 head_types = [(None, None, 0, None, 0.0)]
             else:
-                head_types = [(state.lexical_types[state.active_node-1], None, 0, state.applysets_todo[state.active_node-1], 0.0)]
+                head_types = [(int(state.lexical_types[state.active_node-1]), None, 0, state.applysets_todo[state.active_node-1], 0.0)]
 
         # Select node:
         child_scores = scores["children_scores"] # shape (input_seq_len)
         pop_node = 0 if self.pop_with_0 else state.active_node
         #Cannot select nodes that we have visited already
-        forbidden = 0
         INF = 10e10
-        for seen in state.seen:
-            if seen != pop_node:
-                child_scores[seen] = -INF
-                forbidden += 1
+        child_scores, forbidden = state.mask_seen(child_scores, pop_node, -INF)
 
         at_most_k = min(k, len(state.sentence)+1-forbidden) #don't let beam search explore things that are not well-formed.
-        children_scores, children = torch.sort(child_scores, descending=True)
-        children_scores = children_scores[:at_most_k] #shape (at_most_k)
-        children = children[:at_most_k] #shape (at_most_k)
+        children_scores, children = torch.topk(child_scores, at_most_k)
 
         device = get_device_id(children)
 
@@ -465,83 +611,115 @@ class LTF(TransitionSystem):
         children_scores = children_scores.cpu().numpy()
         label_scores = label_scores.cpu().numpy()
 
-        selected_lex_label = self.additional_lexicon.get_str_repr("lex_labels", int(scores["lex_labels"].cpu().numpy()))
-
-        decisions = []
-
-        for lexical_type_of_tos, term_type_of_tos, best_local_constant, applyset_todo_tos, local_decision_score in head_types:
+        # Candidates for all combinations of head type, child and edge label, as arrays.
+        # Only the k best are turned into decisions because no more than k decisions of a state can survive in the beam.
+        candidate_heads = []
+        candidate_children = []
+        candidate_operations = [] # APP, MOD, ROOT or POP
+        candidate_labels = [] # source id for APP, edge label id for MOD
+        candidate_scores = []
+
+        def add_candidates(head : int, children_here : np.array, operation : int, labels : np.array, scores_here : np.array) -> None:
+            candidate_heads.append(np.full(len(scores_here), head))
+            candidate_children.append(children_here)
+            candidate_operations.append(np.full(len(scores_here), operation))
+            candidate_labels.append(labels)
+            candidate_scores.append(scores_here)
+
+        is_pop_node = children == pop_node
+        for head, (lexical_type_of_tos, term_type_of_tos, best_local_constant, applyset_todo_tos, local_decision_score) in enumerate(head_types):
+
+            if not state.root_determined:
+                # First decision must choose root.
+                not_root = children != 0
+                add_candidates(head, children[not_root], ROOT, np.zeros(np.sum(not_root), dtype=np.int64), children_scores[not_root])
+                continue
 
             sources_to_be_filled = state.sources_to_be_filled()
 
             if determine_head_type:
                 # if we have to decide for a lexical type of our head as well, these go to our todolist as well.
-                sources_to_be_filled += len(applyset_todo_tos)
-
-            for selected_node, node_score, label_scores_this_node in zip(children, children_scores, label_scores):
-
-                if not state.root_determined:
-                    if selected_node != 0: # First decision must choose root.
-                        decisions.append(Decision(int(selected_node),False, "ROOT", ("",""), "",termtyp=None, score=float(node_score)))
-                    continue
+                sources_to_be_filled += popcount(applyset_todo_tos)
 
-                #Check if we must not close the current node
-                if applyset_todo_tos is not None and len(applyset_todo_tos) > 0:
-                    if selected_node == pop_node: # This won't work, skip
-                        continue
-                elif applyset_todo_tos is not None and len(applyset_todo_tos) == 0 and state.words_left - sources_to_be_filled == 0:
-                    # somewhere in the tree (but not here!) there are sources to fill
-                    # the number of words left exactly matches that. Since we don't have to fill a source here, we must pop!
-                    if selected_node != pop_node: # This won't work, skip
-                        continue
-
-                if selected_node == pop_node:
-                    if determine_head_type:
-                        decisions.append(Decision(pop_node, True, "",
-                                                  AMSentence.split_supertag(self.additional_lexicon.get_str_repr("constants", best_local_constant)),
-                                                  selected_lex_label, term_type_of_tos, score=node_score + local_decision_score))
-                    else:
-                        decisions.append(Decision(pop_node, True, "", ("",""), "_", None, score=node_score))
-                    continue
-
-                words_left_after_this = state.words_left - 1
+            #Check if we must not close the current node
+            can_pop = applyset_todo_tos == 0
+            # somewhere in the tree (but not here!) there are sources to fill
+            # the number of words left exactly matches that. Since we don't have to fill a source here, we must pop!
+            must_pop = applyset_todo_tos == 0 and state.words_left - sources_to_be_filled == 0
 
-                # possible_sources = set()
-                source_to_score = dict()
+            if can_pop:
+                pop_scores = children_scores[is_pop_node]
+                if determine_head_type:
+                    pop_scores = pop_scores + local_decision_score
+                add_candidates(head, children[is_pop_node], _POP, np.zeros(len(pop_scores), dtype=np.int64), pop_scores)
 
-                for todo_source in applyset_todo_tos:
-                    source_score = label_scores_this_node[self.additional_lexicon.get_id("edge_labels", "APP_"+todo_source)]
-                    source_to_score[todo_source] = source_score
+            if must_pop:
+                continue
 
-                top_k_mod_choices = get_top_k_choices(self.modify_ids, label_scores_this_node, k)
+            child_scores_here = children_scores[~is_pop_node]
+            if determine_head_type:
+                child_scores_here = child_scores_here + local_decision_score
+            label_scores_here = label_scores[~is_pop_node]
+
+            todo_sources = np.array(self.label_codes.source_ids(applyset_todo_tos), dtype=np.int64)
+            if len(todo_sources) > 0:
+                app_ids = np.array([self.label_codes.app_ids[source] for source in todo_sources], dtype=np.int64)
+                app_scores = child_scores_here[:, np.newaxis] + label_scores_here[:, app_ids]
+                add_candidates(head, np.repeat(children[~is_pop_node], len(todo_sources)), APP,
+                               np.tile(todo_sources, len(child_scores_here)), app_scores.reshape(-1))
+
+            words_left_after_this = state.words_left - 1
+            if words_left_after_this - sources_to_be_filled >= 0 and len(self.modify_id_array) > 0:
+                mod_scores = child_scores_here[:, np.newaxis] + label_scores_here[:, self.modify_id_array]
+                add_candidates(head, np.repeat(children[~is_pop_node], len(self.modify_id_array)), MOD,
+                               np.tile(self.modify_id_array, len(child_scores_here)), mod_scores.reshape(-1))
+
+        candidate_scores = np.concatenate(candidate_scores)
+        assert len(candidate_scores) > 0
+        candidate_heads = np.concatenate(candidate_heads)
+        candidate_children = np.concatenate(candidate_children)
+        candidate_operations = np.concatenate(candidate_operations)
+        candidate_labels = np.concatenate(candidate_labels)
+
+        selected_lex_label = int(scores["lex_labels"].cpu().numpy())
 
-                if determine_head_type:
-                    head_constant = AMSentence.split_supertag(self.additional_lexicon.get_str_repr("constants", best_local_constant))
-                    for source in sorted(applyset_todo_tos, key=lambda source: source_to_score[source], reverse=True)[:k]:
-                        decisions.append(Decision(int(selected_node), False, "APP_"+source, head_constant, selected_lex_label, term_type_of_tos,
-                                                  score=node_score + local_decision_score + source_to_score[source]))
+        decisions = []
+        for i in top_k_indices(candidate_scores, k):
+            lexical_type_of_tos, term_type_of_tos, best_local_constant, applyset_todo_tos, local_decision_score = head_types[candidate_heads[i]]
+            selected_node = int(candidate_children[i])
+            operation = candidate_operations[i]
+            score = candidate_scores[i]
 
-                    if words_left_after_this - sources_to_be_filled >= 0:
-                        for edge_id, modify_score in top_k_mod_choices:
-                            decisions.append(Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels", edge_id), head_constant, selected_lex_label, term_type_of_tos,
-                                                      score=node_score + local_decision_score + modify_score))
+            if operation == ROOT:
+                decisions.append(Decision(selected_node, False, label_id=self.root_label, score=float(score)))
+                continue
 
-                else:
-                    for source in sorted(applyset_todo_tos, key=lambda source: source_to_score[source], reverse=True)[:k]:
-                        decisions.append(Decision(int(selected_node), False, "APP_"+source, ("",""), "_", None,
-                                                  score=node_score + source_to_score[source]))
+            if determine_head_type:
+                head_constant, lex_label = best_local_constant, selected_lex_label
+            else:
+                head_constant, lex_label, term_type_of_tos = None, None, None
 
-                    if words_left_after_this - sources_to_be_filled >= 0:
-                        for edge_id, modify_score in top_k_mod_choices:
-                            decisions.append(Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels", edge_id), ("",""), "_", None,
-                                                      score=node_score + modify_score))
+            if operation == _POP:
+                label = None
+            elif operation == APP:
+                label = self.label_codes.app_label_ids[candidate_labels[i]]
+            else:
+                label = int(candidate_labels[i])
+            decisions.append(Decision(pop_node if operation == _POP else selected_node, operation == _POP, label_id=label,
+                                      constant_id=head_constant, lex_label_id=lex_label, termtyp_id=term_type_of_tos, score=score))
 
-        assert len(decisions) > 0
         return decisions
 
     def assumes_greedy_ok(self) -> Set[str]:
         return set()
 
 
+    def state_signature(self, state : LTFState, with_context : bool) -> Optional[Hashable]:
+        # typing information of the nodes that can become active again
+        typing = tuple((int(state.lexical_types[node-1]), state.term_types[node-1], state.applysets_todo[node-1])
+                       for node in state.stack if node != 0)
+        return state.signature(with_context) + (state.root_determined, typing)
+
     def check_correct(self, gold_sentence : AMSentence, predicted : AMSentence) -> bool:
         return all(x.head == y.head for x, y in zip(gold_sentence, predicted)) and \
                all(x.label == y.label for x, y in zip(gold_sentence, predicted)) and \
@@ -1,21 +1,23 @@
-from copy import deepcopy
 from dataclasses import dataclass
-from typing import List, Iterable, Optional, Tuple, Dict, Any, Set
+from typing import List, Iterable, Optional, Tuple, Dict, Any, Set, Hashable
 
 import torch
 
-from topdown_parser.am_algebra import AMType, new_amtypes
-from topdown_parser.am_algebra.new_amtypes import ByApplySet, ModCache, ReadCache
-from topdown_parser.am_algebra.tree import Tree
+from topdown_parser.am_algebra import AMType
+from topdown_parser.am_algebra.new_amtypes import ModCache, ReadCache, TypeOperationCache, CandidateLexTypeIndex
+from topdown_parser.am_algebra.tree import ArrayTree
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
-from topdown_parser.transition_systems.ltf import typ2supertag, typ2i, collect_sources
-from topdown_parser.transition_systems.parsing_state import ParsingState
+from topdown_parser.nn.utils import index_tensor_dict
+from topdown_parser.transition_systems.ltf import typ2supertag, typ2i, collect_sources, SupertagIndex, TypeIdOperations
+from topdown_parser.transition_systems.parsing_state import ParsingState, batch_seen_masks
 from topdown_parser.transition_systems.transition_system import TransitionSystem
 from .decision import Decision
+from .edge_label_codes import EdgeLabelCodes, popcount, APP, MOD, ROOT
+from .lexicon_ids import AnnotationIds, TypeIds, NO_ID, bits
 
 from topdown_parser.transition_systems.utils import scores_to_selection, get_and_convert_to_numpy, get_best_constant, \
-    single_score_to_selection, get_top_k_choices, copy_optional_set
+    single_score_to_selection, get_top_k_choices, ordered_children, gold_context
 
 import heapq
 
@@ -23,12 +25,20 @@ import numpy as np
 
 
 class LTLState(ParsingState):
+    """
+    Edge labels, constants and lexical labels are ids (see AnnotationIds, NO_ID if they are not set yet),
+    lexical types are type ids and term types bitsets of type ids (see TypeIds), None if they are not known yet.
+    The apply sets collected are bitmasks of sources (see EdgeLabelCodes), None for nodes without a term type.
+    """
+
+    __slots__ = ["substack", "lexical_types", "applysets_collected", "words_left", "root_determined", "term_types",
+                 "sources_still_to_fill", "step", "ids"]
 
     def __init__(self, decoder_state: Any, active_node: int, score: float, sentence: AMSentence,
-                 lexicon: AdditionalLexicon, heads: List[int], children: Dict[int, List[int]], edge_labels: List[str],
-                 constants: List[Tuple[str, str]], lex_labels: List[str], stack: List[int], seen: Set[int], substack: List[int],
-                 lexical_types: List[AMType], term_types : List[Set[AMType]], applysets_collected: List[Optional[Set[str]]], words_left : int, root_determined : bool,
-                 sources_still_to_fill: List[int]):
+                 lexicon: AdditionalLexicon, heads: List[int], children: Dict[int, List[int]], edge_labels: np.array,
+                 constants: np.array, lex_labels: np.array, stack: List[int], seen: Set[int], substack: List[int],
+                 lexical_types: np.array, term_types : List[Optional[int]], applysets_collected: List[Optional[int]], words_left : int, root_determined : bool,
+                 sources_still_to_fill: List[int], ids : AnnotationIds):
         super().__init__(decoder_state, active_node, score, sentence, lexicon, heads, children, edge_labels, constants,
                          lex_labels, stack, seen)
         self.substack = substack
@@ -40,16 +50,20 @@ class LTLState(ParsingState):
 
         self.sources_still_to_fill = sources_still_to_fill
         self.step = 0
+        self.ids = ids
 
     def copy(self) -> "ParsingState":
         copy = LTLState(self.decoder_state, self.active_node, self.score, self.sentence,
-                        self.lexicon, list(self.heads), deepcopy(self.children), list(self.edge_labels),
-                        list(self.constants), list(self.lex_labels), list(self.stack), set(self.seen), list(self.substack),
-                        list(self.lexical_types), copy_optional_set(self.term_types), copy_optional_set(self.applysets_collected), self.words_left, self.root_determined,
-                        list(self.sources_still_to_fill))
+                        self.lexicon, list(self.heads), {node: list(children) for node, children in self.children.items()}, self.edge_labels.copy(),
+                        self.constants.copy(), self.lex_labels.copy(), list(self.stack), set(self.seen), list(self.substack),
+                        self.lexical_types.copy(), list(self.term_types), list(self.applysets_collected), self.words_left, self.root_determined,
+                        list(self.sources_still_to_fill), self.ids)
         copy.step = self.step
         return copy
 
+    def extract_tree(self) -> AMSentence:
+        return self.ids.annotate(self.sentence, self.heads, self.edge_labels, self.constants, self.lex_labels)
+
 
     def is_complete(self) -> bool:
         complete = self.stack == []
@@ -70,11 +84,13 @@ class LTL(TransitionSystem):
 
     def __init__(self, children_order: str, pop_with_0: bool,
                  additional_lexicon: AdditionalLexicon,
-                 reverse_push_actions: bool = False):
+                 reverse_push_actions: bool = False,
+                 type_cache_size : Optional[int] = 100_000):
         """
         Select children_order : "LR" (left to right) or "IO" (inside-out, recommended by Ma et al.)
         reverse_push_actions means that the order of push actions is the opposite order in which the children of
         the node are recursively visited.
+        type_cache_size bounds the number of memoised results per type operation and of types read from strings (None = unbounded).
         """
         super().__init__(additional_lexicon)
         self.pop_with_0 = pop_with_0
@@ -91,8 +107,8 @@ class LTL(TransitionSystem):
                 self.supertag2typ[constant] = typ
 
         self.typ2i :  Dict[AMType, int] = typ2i(self.additional_lexicon) # which type has what id?
+        self.supertag_index = SupertagIndex(self.typ2supertag)
 
-        self.candidate_lex_types = new_amtypes.CandidateLexType({typ for typ in self.typ2i.keys()})
 
         self.sources: Set[str] = collect_sources(self.additional_lexicon)
 
@@ -100,78 +116,91 @@ class LTL(TransitionSystem):
         self.modify_ids = {self.additional_lexicon.get_id("edge_labels", "MOD_"+source) for source in modify_sources} #ids of modify edges
         self.mod_cache = ModCache(self.typ2i.keys())
 
-        self.apply_cache = ByApplySet(self.typ2i.keys())
+        self.read_cache = ReadCache(type_cache_size)
+        self.type_cache = TypeOperationCache(type_cache_size)
+        self.candidate_lex_types = CandidateLexTypeIndex(self.typ2i.keys(), self.type_cache)
+        # id of every lexical type of candidate_lex_types in supertag_index, -1 if it has no constants.
+        self.supertag_ids = np.array([self.supertag_index.typ2i.get(typ, -1) for typ in self.candidate_lex_types.i2typ], dtype=np.int64)
+
+        # the sources of candidate_lex_types get the first codes, so apply sets are bitmasks of both.
+        self.label_codes = EdgeLabelCodes(self.additional_lexicon, self.candidate_lex_types.i2source)
+        self.ids = AnnotationIds(self.additional_lexicon, self.label_codes.labels)
+        self.root_label = self.label_codes.labels.id("ROOT")
 
-        self.read_cache = ReadCache()
+        self.types = TypeIds(self.typ2i.keys())
+        self.root_type = self.types.id(AMType.parse_str("()"))
+        self.type_ids = TypeIdOperations(self.types, self.label_codes, self.ids, self.read_cache, self.type_cache,
+                                         self.mod_cache, type_cache_size)
 
     def predict_supertag_from_tos(self) -> bool:
         return True
 
-    def _construct_seq(self, tree: Tree) -> List[Decision]:
-        own_position = tree.node[0]
-        push_actions = []
-        recursive_actions = []
-
-        if self.children_order == "LR":
-            children = tree.children
-        elif self.children_order == "RL":
-            children = reversed(tree.children)
-        elif self.children_order == "IO":
-            left_part = []
-            right_part = []
-            for child in tree.children:
-                if child.node[0] < own_position:
-                    left_part.append(child)
-                else:
-                    right_part.append(child)
-            children = list(reversed(left_part)) + right_part
-        else:
-            raise ValueError("Unknown children order: "+self.children_order)
+    def _construct_seq(self, tree: ArrayTree) -> List[Decision]:
+        ret = []
+        agenda = [0]
+        while agenda:
+            own_position = agenda.pop()
+            entry = tree.nodes[own_position]
+            children = ordered_children(tree, own_position, self.children_order)
 
-        for child in children:
-            if child.node[1].label == "IGNORE":
-                continue
+            push_actions = [Decision(child, False, tree.nodes[child].label, ("", ""), "") for child in children]
 
-            push_actions.append(Decision(child.node[0], False, child.node[1].label, ("", ""), ""))
-            recursive_actions.extend(self._construct_seq(child))
+            if self.pop_with_0:
+                relevant_position = 0
+            else:
+                relevant_position = own_position
 
-        if self.pop_with_0:
-            relevant_position = 0
-        else:
-            relevant_position = own_position
+            if self.reverse_push_actions:
+                push_actions = list(reversed(push_actions))
 
-        if self.reverse_push_actions:
-            push_actions = list(reversed(push_actions))
+            ret.extend(push_actions)
+            ret.append(Decision(relevant_position, True, "", (entry.fragment, entry.typ), entry.lexlabel))
+            # the children are visited recursively after the pop, in the original order
+            agenda.extend(reversed(children))
 
-        return push_actions + [Decision(relevant_position, True, "", (tree.node[1].fragment, tree.node[1].typ), tree.node[1].lexlabel)] + recursive_actions
+        return ret
 
     def get_order(self, sentence: AMSentence) -> Iterable[Decision]:
-        t = Tree.from_am_sentence(sentence)
-        r = [Decision(t.node[0], False, t.node[1].label, ("", ""), "")] + self._construct_seq(t)
+        t = ArrayTree.from_am_sentence(sentence)
+        r = [Decision(0, False, t.nodes[0].label, ("", ""), "")] + self._construct_seq(t)
         return r
 
+    def state_signature(self, state : LTLState, with_context : bool) -> Optional[Hashable]:
+        # typing information of the nodes that can become active again
+        typing = tuple((int(state.lexical_types[node-1]), state.term_types[node-1],
+                        state.applysets_collected[node-1], state.sources_still_to_fill[node-1])
+                       for node in state.stack + state.substack if node != 0)
+        # the edge labels of the children of the top of the stack determine their term types when it is popped
+        substack_labels = tuple(int(state.edge_labels[child-1]) for child in state.substack)
+        return state.signature(with_context) + (tuple(state.substack), substack_labels, state.step, state.root_determined,
+                                                state.words_left, typing)
+
     def check_correct(self, gold_sentence : AMSentence, predicted : AMSentence) -> bool:
         return all(x.head == y.head for x, y in zip(gold_sentence, predicted)) and \
                all(x.label == y.label for x, y in zip(gold_sentence, predicted)) and \
                all(x.fragment == y.fragment and x.typ == y.typ for x, y in zip(gold_sentence, predicted))
 
+    def gold_context(self, sentence : AMSentence, decisions : List[Decision]) -> Dict[str, np.array]:
+        return gold_context([d.position for d in decisions], len(sentence), self.pop_with_0,
+                            children_first=True, reverse_push_actions=self.reverse_push_actions)
+
     def initial_state(self, sentence : AMSentence, decoder_state : Any) -> ParsingState:
         stack = [0]
         seen = set()
         substack = []
         heads = [0 for _ in range(len(sentence))]
         children = {i: [] for i in range(len(sentence) + 1)}
-        labels = ["IGNORE" for _ in range(len(sentence))]
-        lex_labels = ["_" for _ in range(len(sentence))]
-        constants = [("_","_") for _ in range(len(sentence))]
-        lexical_types = [AMType.parse_str("_") for _ in range(len(sentence))]
+        labels = np.full(len(sentence), NO_ID, dtype=np.int64)
+        lex_labels = np.full(len(sentence), NO_ID, dtype=np.int64)
+        constants = np.full(len(sentence), NO_ID, dtype=np.int64)
+        lexical_types = np.full(len(sentence), NO_ID, dtype=np.int64)
         term_types = [None for _ in range(len(sentence))]
         applysets_collected = [None for _ in range(len(sentence))]
 
         return LTLState(decoder_state, 0, 0.0, sentence,
                  self.additional_lexicon, heads, children, labels,
                  constants, lex_labels, stack, seen, substack,
-                 lexical_types, term_types, applysets_collected, len(sentence), False, [0 for _ in sentence])
+                 lexical_types, term_types, applysets_collected, len(sentence), False, [0 for _ in sentence], self.ids)
 
     def step(self, state: LTLState, decision: Decision, in_place: bool = False) -> ParsingState:
         if in_place:
@@ -191,29 +220,28 @@ class LTL(TransitionSystem):
                     assert tos == position
 
                 if tos != 0:
-                    copy.constants[tos - 1] = decision.supertag
-                    lexical_type_tos = self.read_cache.parse_str(decision.supertag[1])
+                    constant = self.ids.constant_id(decision)
+                    copy.constants[tos - 1] = constant
+                    lexical_type_tos = self.type_ids.constant_type(constant)
                     copy.lexical_types[tos - 1] = lexical_type_tos
-                    copy.lex_labels[tos - 1] = decision.lexlabel
+                    copy.lex_labels[tos - 1] = self.ids.lex_label_id(decision)
 
                     #now determine term types of children
                     for child_id in state.children[tos]: # 1-based children
                         child_id -= 1 # 0-based children
-                        label = copy.edge_labels[child_id]
+                        label = int(copy.edge_labels[child_id])
 
-                        copy.applysets_collected[child_id] = set()
+                        copy.applysets_collected[child_id] = 0
 
-                        if label.startswith("APP_"):
+                        operation, source_id = self.label_codes.label_info(label)
+                        if operation == APP:
                             # get request at source
-                            source = label.split("_")[1]
-                            req = lexical_type_tos.get_request(source)
-                            copy.term_types[child_id] = {req}
+                            copy.term_types[child_id] = 1 << self.type_ids.request(lexical_type_tos, source_id)
 
-                        elif label.startswith("MOD_"):
-                            source = label.split("_")[1]
-                            copy.term_types[child_id] = set(self.mod_cache.get_modifiers_with_source(lexical_type_tos, source))
+                        elif operation == MOD:
+                            copy.term_types[child_id] = self.type_ids.modifier_types(lexical_type_tos, source_id)
                         else:
-                            raise ValueError("Somehow the invalid edge label "+label+" was produced")
+                            raise ValueError("Somehow the invalid edge label "+self.label_codes.labels.str(label)+" was produced")
 
                 if self.reverse_push_actions:
                     copy.stack.extend(copy.substack)
@@ -227,25 +255,25 @@ class LTL(TransitionSystem):
                 assert position <= len(copy.sentence)
                 copy.children[tos].append(position)  # 1-based
 
-                copy.edge_labels[position - 1] = decision.label
+                label = self.ids.label_id(decision)
+                copy.edge_labels[position - 1] = label
 
-                if decision.label.startswith("APP_"):
-                    source = decision.label.split("_")[1]
-                    copy.applysets_collected[copy.active_node-1].add(source)
+                operation, source_id = self.label_codes.label_info(label)
+                if operation == APP:
+                    copy.applysets_collected[copy.active_node-1] |= 1 << source_id
                     smallest_apply_set = np.inf
-                    for term_typ in copy.term_types[tos-1]:
-                        for lexical_type, apply_set in self.candidate_lex_types.get_candidates_with_apply_set(term_typ,
-                                copy.applysets_collected[tos-1], copy.words_left + len(state.applysets_collected[tos-1])):
-
-                            rest_of_apply_set = apply_set - copy.applysets_collected[tos-1]
-                            smallest_apply_set = min(smallest_apply_set, len(rest_of_apply_set))
+                    for term_typ in bits(copy.term_types[tos-1]):
+                        rest = self.candidate_lex_types.smallest_rest_of_apply_set(self.types.i2typ[term_typ], copy.applysets_collected[tos-1],
+                                                                                   copy.words_left + popcount(state.applysets_collected[tos-1]))
+                        if rest is not None:
+                            smallest_apply_set = min(smallest_apply_set, rest)
 
                     assert smallest_apply_set < np.inf
                     copy.sources_still_to_fill[tos-1] = smallest_apply_set
 
-                elif decision.label == "ROOT" and not copy.root_determined:
-                    copy.term_types[position-1] = {AMType.parse_str("()")}
-                    copy.applysets_collected[position-1] = set()
+                elif operation == ROOT and not copy.root_determined:
+                    copy.term_types[position-1] = 1 << self.root_type
+                    copy.applysets_collected[position-1] = 0
                     copy.root_determined = True
 
                 copy.words_left -= 1
@@ -253,7 +281,7 @@ class LTL(TransitionSystem):
                 # push onto stack
                 copy.substack.append(position)
 
-            copy.seen.add(position)
+            copy.mark_seen(position)
             if copy.stack:
                 copy.active_node = copy.stack[-1]
             else:
@@ -265,23 +293,73 @@ class LTL(TransitionSystem):
         return copy
 
     def make_decision(self, scores: Dict[str, torch.Tensor], state : LTLState) -> Decision:
-        # Select node:
-        child_scores = scores["children_scores"].detach().cpu() # shape (input_seq_len)
+        #Cannot select nodes that we have visited already.
+        child_scores, _ = state.mask_seen(scores["children_scores"].detach().cpu(), 0 if self.pop_with_0 else state.active_node, -10e10)
+        scores = {name: tensor.detach().cpu().numpy() for name, tensor in scores.items()}
+        return self._make_decision(scores, child_scores.numpy(), state)
+
+    def may_pop(self, state : LTLState) -> bool:
+        """
+        Can the next decision pop the active node and select a constant for it?
+        """
+        return state.root_determined and state.step != 1 and state.active_node != 0
+
+    def pop_candidates(self, state : LTLState) -> np.array:
+        """
+        Ids (in supertag_index) of the lexical types the active node can get when it is popped:
+        their apply set to one of its term types is the apply set collected.
+        """
+        collected = state.applysets_collected[state.active_node-1]
+        candidates = [self.supertag_ids[self.candidate_lex_types.with_apply_set(self.types.i2typ[term_typ], collected)]
+                      for term_typ in bits(state.term_types[state.active_node-1])]
+        if not candidates:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[candidates >= 0]
+
+    def possible_sources(self, state : LTLState) -> int:
+        """
+        Bitmask of the sources that can be added to the apply set collected of the active node.
+        """
+        apply_of_tos = state.applysets_collected[state.active_node-1]
+        possible_sources = 0
+        for term_typ in bits(state.term_types[state.active_node-1]):
+            # candidates have at most words_left sources left to fill.
+            possible_sources |= self.candidate_lex_types.possible_sources(self.types.i2typ[term_typ], apply_of_tos,
+                                                                          state.words_left + popcount(apply_of_tos))
+        return possible_sources
+
+    def make_decisions(self, scores: Dict[str, torch.Tensor], states : List[LTLState]) -> List[Decision]:
+        scores = {name: tensor.detach().cpu().numpy() for name, tensor in scores.items()}
+        pop_nodes = [0 if self.pop_with_0 else state.active_node for state in states]
+        child_scores = np.where(batch_seen_masks(states, pop_nodes, scores["children_scores"].shape[1]), -10e10, scores["children_scores"])
+
+        # best constant of every lexical type for all parsing states that might pop.
+        may_pop = [i for i, state in enumerate(states) if self.may_pop(state)]
+        best = dict()
+        if may_pop:
+            best_constants, best_constant_scores = self.supertag_index.best_constants(scores["constants_scores"][may_pop])
+            best = {i : (best_constants[row], best_constant_scores[row]) for row, i in enumerate(may_pop)}
+
+        decisions = []
+        for i, state in enumerate(states):
+            decisions.append(self._make_decision(index_tensor_dict(scores, i), child_scores[i], state, best.get(i)))
+        return decisions
+
+    def _make_decision(self, scores: Dict[str, np.array], child_scores : np.array, state : LTLState,
+                       best_constants : Optional[Tuple[np.array, np.array]] = None) -> Decision:
+        """
+        :param scores: scores of this parsing state
+        :param child_scores: shape (input_seq_len), nodes that have been seen already are masked.
+        :param best_constants: result of SupertagIndex.best_constants for the constant scores, if already computed.
+        """
         INF = 10e10
+        child_scores = child_scores.copy()
 
         if not state.root_determined: # First decision must choose root.
             child_scores[0] = -INF
-            s, selected_node = torch.max(child_scores, dim=0)
-            return Decision(int(selected_node), False, "ROOT", ("",""), "",termtyp=None, score=float(s))
-
-        #Cannot select nodes that we have visited already.
-        for seen in state.seen:
-            if self.pop_with_0 and seen == 0:
-                pass
-            elif not self.pop_with_0 and seen == state.active_node:
-                pass
-            else:
-                child_scores[seen] = -INF
+            selected_node = int(np.argmax(child_scores))
+            return Decision(selected_node, False, label_id=self.root_label, score=float(child_scores[selected_node]))
 
         if state.active_node != 0 and state.sources_still_to_fill[state.active_node-1] > 0:
             # Cannot close the current node if the smallest apply set reachable from the active node requires is still do add more APP edges.
@@ -290,52 +368,41 @@ class LTL(TransitionSystem):
             else:
                 child_scores[state.active_node] = -INF
 
-        score = 0.0
-        s, selected_node = torch.max(child_scores, dim=0)
-        score += s
+        selected_node = int(np.argmax(child_scores))
+        s = float(child_scores[selected_node])
+        score = s
 
         if state.step == 1 or state.active_node == 0:
             #we are done (or after first step), do nothing.
-            return Decision(0, False, "", ("",""), "", score=0.0)
+            return Decision(0, False, score=0.0)
 
         if (selected_node in state.seen and not self.pop_with_0) or (selected_node == 0 and self.pop_with_0):
             # pop node, select constant and lexical label.
-            constant_scores = scores["constants_scores"].cpu().numpy()
-            #max_score = -np.inf
-            #best_constant = None
-            possible_constants = set()
-            for term_typ in state.term_types[state.active_node-1]:
-                possible_lex_types = self.apply_cache.by_apply_set(term_typ, frozenset(state.applysets_collected[state.active_node-1]))
-                for lex_type in possible_lex_types:
-                    possible_constants.update(self.typ2supertag[lex_type])
-
-            assert len(possible_constants) > 0
-            best_constant, max_score = get_best_constant(possible_constants, constant_scores)
+            if best_constants is None:
+                best_constants = self.supertag_index.best_constants(scores["constants_scores"])
+            best_constants, best_constant_scores = best_constants
+
+            candidates = self.pop_candidates(state)
+            assert len(candidates) > 0
+            best_candidate = candidates[np.argmax(best_constant_scores[candidates])]
+            best_constant = int(best_constants[best_candidate])
             pop_node = 0 if self.pop_with_0 else state.active_node
-            selected_lex_label = self.additional_lexicon.get_str_repr("lex_labels", int(scores["lex_labels"].cpu().numpy()))
             score += s
-            return Decision(pop_node, True, "", AMSentence.split_supertag(self.additional_lexicon.get_str_repr("constants", best_constant)), selected_lex_label, score=score)
+            return Decision(pop_node, True, constant_id=best_constant, lex_label_id=int(scores["lex_labels"]), score=score)
 
         # APP or MOD?
-        label_scores = scores["all_labels_scores"][selected_node].cpu().numpy() #shape (edge vocab size)
+        label_scores = scores["all_labels_scores"][selected_node] #shape (edge vocab size)
 
         max_apply_score = -np.inf
         #best_apply_source = None
         #best_lex_type = None # for debugging purposes
         smallest_apply_set = state.sources_still_to_fill[state.active_node - 1]
 
-        apply_of_tos = state.applysets_collected[state.active_node-1]
-        possible_sources = set()
-        for term_typ in state.term_types[state.active_node-1]:
-            for lexical_type, apply_set in self.candidate_lex_types.get_candidates_with_apply_set(term_typ, apply_of_tos, state.words_left + len(apply_of_tos)):
-                rest_of_apply_set = apply_set - apply_of_tos
-
-                if len(rest_of_apply_set) <= state.words_left:
-                    possible_sources.update(rest_of_apply_set)
+        possible_sources = self.possible_sources(state)
 
         best_apply_edge_id = None
-        if len(possible_sources) > 0:
-            edge_ids = {self.additional_lexicon.get_id("edge_labels", "APP_"+source) for source in possible_sources}
+        if possible_sources:
+            edge_ids = {self.label_codes.app_ids[source] for source in bits(possible_sources)}
             best_apply_edge_id, max_apply_score = get_best_constant(edge_ids, label_scores)
 
         # Check MODIFY
@@ -347,10 +414,10 @@ class LTL(TransitionSystem):
         # Apply our choice
         if max_modify_score > max_apply_score:
             # MOD
-            return Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels",  best_modify_edge_id), ("",""),"", score=score+max_modify_score)
+            return Decision(int(selected_node), False, label_id=int(best_modify_edge_id), score=score+max_modify_score)
         elif max_apply_score > -np.inf:
             # APP
-            return Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels",  best_apply_edge_id), ("",""),"", score=score+max_apply_score)
+            return Decision(int(selected_node), False, label_id=int(best_apply_edge_id), score=score+max_apply_score)
         else:
             raise ValueError("Could not select action. Bug.")
 
@@ -360,15 +427,7 @@ class LTL(TransitionSystem):
         child_scores = scores["children_scores"].cpu() # shape (input_seq_len)
         #Cannot select nodes that we have visited already (except if not pop with 0 and currently active, then we can close).
         INF = 10e10
-        forbidden = 0
-        for seen in state.seen:
-            if self.pop_with_0 and seen == 0:
-                pass
-            elif not self.pop_with_0 and seen == state.active_node:
-                pass
-            else:
-                child_scores[seen] = -INF
-                forbidden += 1
+        child_scores, forbidden = state.mask_seen(child_scores, 0 if self.pop_with_0 else state.active_node, -INF)
 
         if state.active_node != 0 and state.sources_still_to_fill[state.active_node-1] > 0:
             # Cannot close the current node if the smallest apply set reachable from the active node requires is still do add more APP edges.
@@ -383,9 +442,7 @@ class LTL(TransitionSystem):
             forbidden += 1
 
         at_most_k = min(k, len(state.sentence)+1-forbidden) #don't let beam search explore things that are not well-formed.
-        children_scores, children = torch.sort(child_scores, descending=True)
-        children_scores = children_scores[:at_most_k] #shape (at_most_k)
-        children = children[:at_most_k] #shape (at_most_k)
+        children_scores, children = torch.topk(child_scores, at_most_k) #shape (at_most_k)
         # Now have k best children
 
         label_scores = scores["all_labels_scores"][children] # (at_most_k, label vocab size)
@@ -394,8 +451,9 @@ class LTL(TransitionSystem):
         children_scores = children_scores.cpu().numpy()
         label_scores = label_scores.cpu().numpy()
         constant_scores = scores["constants_scores"].cpu().numpy()
+        best_constants = None
         #lex_label_score, selected_lex_label = single_score_to_selection(scores, self.additional_lexicon, "lex_labels")
-        selected_lex_label = self.additional_lexicon.get_str_repr("lex_labels", int(scores["lex_labels"].cpu().numpy()))
+        selected_lex_label = int(scores["lex_labels"].cpu().numpy())
 
         decisions = []
         for selected_node, node_score, label_scores in zip(children, children_scores, label_scores):
@@ -403,26 +461,25 @@ class LTL(TransitionSystem):
             assert label_scores.shape == (self.additional_lexicon.vocab_size("edge_labels"),)
 
             if not state.root_determined:
-                decisions.append(Decision(int(selected_node), False, "ROOT", ("",""), "",termtyp=None, score=node_score))
+                decisions.append(Decision(int(selected_node), False, label_id=self.root_label, score=node_score))
                 continue
 
             if state.step == 1 or state.active_node == 0:
                 #we are done (or after first step), do nothing.
-                decisions.append(Decision(0, False, "", ("",""), "", score=0.0))
+                decisions.append(Decision(0, False, score=0.0))
                 break
 
             if (selected_node in state.seen and not self.pop_with_0) or (selected_node == 0 and self.pop_with_0):
                 # pop node, select constant and lexical label.
                 pop_node = 0 if self.pop_with_0 else state.active_node
-                possible_lex_types = set()
-                for term_typ in state.term_types[state.active_node-1]:
-                    possible_lex_types.update(self.apply_cache.by_apply_set(term_typ, frozenset(state.applysets_collected[state.active_node-1])))
+                candidates = self.pop_candidates(state)
 
-                assert len(possible_lex_types) > 0
-                for lex_type in possible_lex_types:
-                    constant, constant_score = get_best_constant(self.typ2supertag[lex_type], constant_scores)
-                    decisions.append(Decision(pop_node, True, "", AMSentence.split_supertag(self.additional_lexicon.get_str_repr("constants", constant)),
-                                                   selected_lex_label, score=constant_score + node_score))
+                assert len(candidates) > 0
+                if best_constants is None:
+                    best_constants, best_constant_scores = self.supertag_index.best_constants(constant_scores)
+                for candidate in candidates:
+                    decisions.append(Decision(pop_node, True, constant_id=int(best_constants[candidate]), lex_label_id=selected_lex_label,
+                                              score=best_constant_scores[candidate] + node_score))
 
                 # for term_typ in state.term_types[state.active_node-1]:
                 #     possible_lex_types = self.apply_cache.by_apply_set(term_typ, frozenset(state.applysets_collected[state.active_node-1]))
@@ -435,25 +492,15 @@ class LTL(TransitionSystem):
 
             smallest_apply_set = state.sources_still_to_fill[state.active_node - 1]
 
-            apply_of_tos = state.applysets_collected[state.active_node-1]
-
             # APP
-            possible_sources = set()
-            for term_typ in state.term_types[state.active_node-1]:
-                for lexical_type, apply_set in self.candidate_lex_types.get_candidates_with_apply_set(term_typ, apply_of_tos, state.words_left + len(apply_of_tos)):
-                    rest_of_apply_set = apply_set - apply_of_tos
-
-                    if len(rest_of_apply_set) <= state.words_left:
-                        possible_sources.update(rest_of_apply_set)
-
-            apply_ids = {self.additional_lexicon.get_id("edge_labels", "APP_"+source) for source in possible_sources}
+            apply_ids = {self.label_codes.app_ids[source] for source in bits(self.possible_sources(state))}
             for edge_id, apply_score in get_top_k_choices(apply_ids, label_scores, k):
-                decisions.append(Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels", edge_id), ("",""), "", score = node_score+apply_score))
+                decisions.append(Decision(int(selected_node), False, label_id=int(edge_id), score = node_score+apply_score))
 
             # MOD
             if state.words_left - smallest_apply_set > 0:
                 for edge_id, modify_score in get_top_k_choices(self.modify_ids, label_scores, k):
-                    decisions.append(Decision(int(selected_node), False, self.additional_lexicon.get_str_repr("edge_labels", edge_id), ("",""), "", score = node_score+modify_score))
+                    decisions.append(Decision(int(selected_node), False, label_id=int(edge_id), score = node_score+modify_score))
 
         return decisions
 
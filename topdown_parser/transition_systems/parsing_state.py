@@ -11,6 +11,9 @@ import numpy as np
 
 class ParsingState(ABC):
 
+    __slots__ = ["decoder_state", "active_node", "score", "lexicon", "sentence", "heads", "edge_labels", "constants",
+                 "children", "lex_labels", "seen", "seen_mask", "stack"]
+
     def __init__(self,decoder_state: Any, active_node: int, score: float,
                  sentence : AMSentence, lexicon : AdditionalLexicon,
                  heads: List[int], children: Dict[int, List[int]],
@@ -29,6 +32,8 @@ class ParsingState(ABC):
         self.children = children
         self.lex_labels = lex_labels
         self.seen = seen
+        self.seen_mask = np.zeros(len(sentence)+1, dtype=bool) # same as seen, kept up to date by mark_seen
+        self.seen_mask[list(seen)] = True
         self.stack = stack
 
     def copy(self) -> "ParsingState":
@@ -40,14 +45,40 @@ class ParsingState(ABC):
         """
         raise NotImplementedError()
 
+    def mark_seen(self, node : int) -> None:
+        self.seen.add(node)
+        self.seen_mask[node] = True
+
+    def mask_seen(self, child_scores : torch.Tensor, pop_node : int, value : float) -> Tuple[torch.Tensor, int]:
+        """
+        Sets the scores of the nodes that have been seen already to value, except for pop_node. Doesn't modify child_scores.
+        :param child_scores: shape (input_seq_len,), may be longer than the sentence because of padding
+        :return: the masked scores and the number of nodes that were masked
+        """
+        forbidden = self.seen_mask
+        number_forbidden = len(self.seen)
+        if forbidden[pop_node]:
+            forbidden = forbidden.copy()
+            forbidden[pop_node] = False
+            number_forbidden -= 1
+        masked = child_scores.clone()
+        masked[:len(forbidden)].masked_fill_(torch.from_numpy(forbidden).to(child_scores.device), value)
+        return masked, number_forbidden
+
+    def signature(self, with_context : bool) -> Tuple:
+        """
+        The part of TransitionSystem.state_signature that all parsing states share: the active node, the stack and
+        the nodes seen, and, with_context, the parents and children of the nodes that can become active again.
+        """
+        signature = (self.active_node, tuple(self.stack), self.seen_mask.tobytes())
+        if with_context:
+            nodes = self.stack + [self.active_node]
+            signature += (tuple(get_parent(self.heads, node) for node in nodes),
+                          tuple(tuple(self.children[node]) for node in nodes))
+        return signature
+
     def extract_tree(self) -> AMSentence:
-        sentence = self.sentence.set_heads(self.heads)
-        sentence = sentence.set_labels(self.edge_labels)
-        if self.constants is not None:
-            sentence = sentence.set_supertag_tuples(self.constants)
-        if self.lex_labels is not None:
-            sentence = sentence.set_lexlabels(self.lex_labels)
-        return sentence
+        return self.sentence.with_annotation(self.heads, self.edge_labels, self.constants, self.lex_labels)
 
     def is_complete(self) -> bool:
         raise NotImplementedError()
@@ -98,6 +129,71 @@ class ParsingState(ABC):
 
             return ret
 
+class ContextBuffer:
+    """
+    The context of ParsingState.gather_context for a batch of parsing states, kept in preallocated arrays.
+    After a parsing state has made a step, update brings its row up to date: only the children added since the last
+    update are written, unless the active node has changed.
+    """
+
+    def __init__(self, batch_size : int, max_children : int):
+        """
+        :param max_children: upper bound on the number of children of a node, e.g. the input sequence length
+        """
+        self.parents = np.zeros(batch_size, dtype=np.int64)
+        self.children = np.zeros((batch_size, max(1, max_children)), dtype=np.int64)
+        self.number_of_children = np.zeros(batch_size, dtype=np.int64)
+        self.active_nodes = np.full(batch_size, -1, dtype=np.int64) # -1: row doesn't belong to any node yet
+
+    def update(self, i : int, state : ParsingState) -> None:
+        """
+        Brings row i up to date with state, which must have evolved from the state row i was last updated with.
+        """
+        children = state.children[state.active_node]
+        if self.active_nodes[i] != state.active_node:
+            self.children[i, :self.number_of_children[i]] = 0
+            self.number_of_children[i] = 0
+            self.active_nodes[i] = state.active_node
+        n = self.number_of_children[i]
+        if len(children) > n:
+            self.children[i, n:len(children)] = children[n:]
+            self.number_of_children[i] = len(children)
+        self.parents[i] = get_parent(state.heads, state.active_node)
+
+    def reorder(self, indices : List[int]) -> None:
+        """
+        Row i becomes the former row indices[i], e.g. when a state in a beam was derived from the state at another position.
+        The number of rows becomes len(indices).
+        """
+        self.parents = self.parents[indices]
+        self.children = self.children[indices]
+        self.number_of_children = self.number_of_children[indices]
+        self.active_nodes = self.active_nodes[indices]
+
+    def as_tensors(self, device) -> Dict[str, torch.Tensor]:
+        """
+        The batched context, as batch_and_pad_tensor_dict and undo_one_batching_eval would make it from gather_context.
+        """
+        width = max(1, int(np.max(self.number_of_children)))
+        children = torch.from_numpy(self.children[:, :width].copy()).to(device)
+        return {"parents": torch.from_numpy(self.parents.copy()).to(device),
+                "children": children,
+                "children_mask": children != 0}
+
+
+def batch_seen_masks(states : List[ParsingState], pop_nodes : List[int], input_seq_len : int) -> np.array:
+    """
+    The masks of ParsingState.mask_seen for a batch of parsing states.
+    :param pop_nodes: for every parsing state, the node that can be selected even if it has been seen.
+    :return: boolean array of shape (batch_size, input_seq_len), True for the nodes that cannot be selected
+    """
+    mask = np.zeros((len(states), input_seq_len), dtype=bool)
+    for i, state in enumerate(states):
+        mask[i, :len(state.seen_mask)] = state.seen_mask
+    mask[np.arange(len(states)), pop_nodes] = False
+    return mask
+
+
 def undo_one_batching(context : Dict[str, torch.Tensor]) -> None:
     """
     Undo the effects introduced by gathering context with batch size 1 and batching them up.
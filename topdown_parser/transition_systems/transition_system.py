@@ -1,6 +1,7 @@
 from dataclasses import dataclass
-from typing import List, Iterable, Optional, Tuple, Dict, Any, Set
+from typing import List, Iterable, Optional, Tuple, Dict, Any, Set, Hashable
 
+import numpy as np
 import torch
 from allennlp.common import Registrable
 
@@ -8,7 +9,7 @@ from topdown_parser.am_algebra import AMType
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon, Lexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
 from topdown_parser.nn.edge_label_model import EdgeLabelModel
-from topdown_parser.nn.utils import get_device_id
+from topdown_parser.nn.utils import get_device_id, index_tensor_dict
 from topdown_parser.transition_systems.batched_parsing_state import BatchedParsingState
 from topdown_parser.transition_systems.decision import Decision, DecisionBatch
 from topdown_parser.transition_systems.parsing_state import ParsingState
@@ -55,6 +56,32 @@ class TransitionSystem(Registrable):
         """
         raise NotImplementedError()
 
+    def gold_context(self, sentence : AMSentence, decisions : List[Decision]) -> Dict[str, np.array]:
+        """
+        The context (see ParsingState.gather_context) before every decision of a gold decision sequence except the first.
+        This implementation replays the decisions, transition systems should override it with something faster.
+        :param sentence:
+        :param decisions: as returned by get_order
+        :return: arrays of shape (len(decisions) - 1, ...), padded with 0
+        """
+        state = self.initial_state(sentence.strip_annotation(), None)
+        contexts = dict()
+        for i in range(1, len(decisions)):
+            for k, v in state.gather_context(None).items():
+                if k not in contexts:
+                    contexts[k] = []
+                contexts[k].append(v.cpu().numpy())
+            if i < len(decisions) - 1:
+                state = self.step(state, decisions[i], in_place=True)
+
+        padded = dict()
+        for k, arrays in contexts.items():
+            shape = np.max([a.shape for a in arrays], axis=0)
+            padded[k] = np.zeros((len(arrays),) + tuple(shape), dtype=arrays[0].dtype)
+            for j, a in enumerate(arrays):
+                padded[k][(j,) + tuple(slice(0, d) for d in a.shape)] = a
+        return padded
+
     def check_correct(self, gold_sentence : AMSentence, predicted : AMSentence) -> bool:
         """
         Check if the predicted sentence is exactly the same as the gold sentence.
@@ -88,9 +115,35 @@ class TransitionSystem(Registrable):
         """
         raise NotImplementedError()
 
+    def make_decisions(self, scores: Dict[str, torch.Tensor], states : List[ParsingState]) -> List[Decision]:
+        """
+        make_decision for a batch of parsing states. The scores are moved to the CPU once for the whole batch,
+        transition systems should override this to make (parts of) the decisions with operations on the whole batch.
+        :param scores: like for make_decision but with an additional first dimension for the batch
+        :param states: one parsing state per batch element
+        :return: one decision per parsing state
+        """
+        scores = {name: tensor.detach().cpu() for name, tensor in scores.items()}
+        return [self.make_decision(index_tensor_dict(scores, i), state) for i, state in enumerate(states)]
+
+    def step_batch(self, states : List[ParsingState], decisions : List[Decision], in_place : bool = False) -> List[ParsingState]:
+        """
+        Applies a decision to every parsing state.
+        :return: the new parsing states
+        """
+        return [self.step(state, decision, in_place) for state, decision in zip(states, decisions)]
+
     def top_k_decision(self, scores: Dict[str, torch.Tensor], state: ParsingState, k : int) -> List[Decision]:
         raise NotImplementedError()
 
+    def state_signature(self, state : ParsingState, with_context : bool) -> Optional[Hashable]:
+        """
+        Two parsing states with the same signature allow for the same future decisions, so that beam search
+        only needs to keep the better one of them. None if the transition system doesn't support this.
+        :param with_context: shall the signature include everything that gather_context can return in the future?
+        """
+        return None
+
     def assumes_greedy_ok(self) -> Set[str]:
         """
         The dictionary keys of the context provider which we make greedy decisions on in top_k_decisions
@@ -1,11 +1,12 @@
 from typing import Dict, Union, List, Set
 
 import torch
+import numpy as np
 
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 from topdown_parser.dataset_readers.amconll_tools import AMSentence
 from topdown_parser.nn.edge_label_model import EdgeLabelModel
-from topdown_parser.transition_systems.parsing_state import ParsingState
+from topdown_parser.transition_systems.parsing_state import ParsingState, batch_seen_masks
 from topdown_parser.transition_systems.transition_system import Decision, TransitionSystem
 from topdown_parser.transition_systems.utils import single_score_to_selection
 
@@ -27,14 +28,7 @@ class UnconstrainedTransitionSystem(TransitionSystem):
         # Select node:
         child_scores = scores["children_scores"].detach().cpu() # shape (input_seq_len)
         #Cannot select nodes that we have visited already.
-
-        for seen in state.seen:
-            if self.pop_with_0 and seen == 0:
-                pass
-            elif not self.pop_with_0 and seen == state.active_node:
-                pass
-            else:
-                child_scores[seen] = -10e10
+        child_scores, _ = state.mask_seen(child_scores, 0 if self.pop_with_0 else state.active_node, -10e10)
 
         score = 0.0
         s, selected_node = torch.max(child_scores, dim=0)
@@ -56,24 +50,46 @@ class UnconstrainedTransitionSystem(TransitionSystem):
         pop = (selected_node == 0 and self.pop_with_0) or (selected_node == state.active_node and not self.pop_with_0)
         return Decision(selected_node, pop, selected_label, AMSentence.split_supertag(selected_supertag), selected_lex_label, score=score)
 
+    def make_decisions(self, scores: Dict[str, torch.Tensor], states : List[ParsingState]) -> List[Decision]:
+        scores = {name: tensor.detach().cpu().numpy() for name, tensor in scores.items()}
+        batch_size, input_seq_len = scores["children_scores"].shape
+        batch_range = np.arange(batch_size)
+
+        #Cannot select nodes that we have visited already.
+        pop_nodes = [0 if self.pop_with_0 else state.active_node for state in states]
+        child_scores = np.where(batch_seen_masks(states, pop_nodes, input_seq_len), -10e10, scores["children_scores"])
+
+        selected_nodes = np.argmax(child_scores, axis=1)
+        label_scores = scores["all_labels_scores"][batch_range, selected_nodes] # shape (batch_size, edge label vocab size)
+        selected_labels = np.argmax(label_scores, axis=1)
+        decision_scores = child_scores[batch_range, selected_nodes] + label_scores[batch_range, selected_labels]
+
+        if "constants_scores" in scores:
+            selected_constants = np.argmax(scores["constants_scores"], axis=1)
+            decision_scores = decision_scores + scores["constants_scores"][batch_range, selected_constants]
+        lex_labels = scores["lex_labels"].reshape(batch_size)
+
+        decisions = []
+        for i, state in enumerate(states):
+            if "constants_scores" in scores:
+                selected_supertag = self.additional_lexicon.get_str_repr("constants", int(selected_constants[i]))
+            else:
+                selected_supertag = AMSentence.get_bottom_supertag()
+            selected_node = int(selected_nodes[i])
+            pop = (selected_node == 0 and self.pop_with_0) or (selected_node == state.active_node and not self.pop_with_0)
+            decisions.append(Decision(selected_node, pop, self.additional_lexicon.get_str_repr("edge_labels", int(selected_labels[i])),
+                                      AMSentence.split_supertag(selected_supertag),
+                                      self.additional_lexicon.get_str_repr("lex_labels", int(lex_labels[i])), score=decision_scores[i]))
+        return decisions
+
     def top_k_decision(self, scores: Dict[str, torch.Tensor], state: ParsingState, k : int) -> List[Decision]:
         # Select node:
         child_scores = scores["children_scores"] # shape (input_seq_len)
         #Cannot select nodes that we have visited already (except if not pop with 0 and currently active, then we can close).
-        forbidden = 0
-        for seen in state.seen:
-            if self.pop_with_0 and seen == 0:
-                pass
-            elif not self.pop_with_0 and seen == state.active_node:
-                pass
-            else:
-                child_scores[seen] = -5e10
-                forbidden += 1
+        child_scores, forbidden = state.mask_seen(child_scores, 0 if self.pop_with_0 else state.active_node, -5e10)
 
         at_most_k = min(k, len(state.sentence)+1-forbidden) #don't let beam search explore things that are not well-formed.
-        children_scores, children = torch.sort(child_scores, descending=True)
-        children_scores = children_scores[:at_most_k] #shape (at_most_k)
-        children = children[:at_most_k] #shape (at_most_k)
+        children_scores, children = torch.topk(child_scores, at_most_k) #shape (at_most_k)
         # Now have k best children
 
         label_scores = scores["all_labels_scores"][children] # (at_most_k, label vocab size)
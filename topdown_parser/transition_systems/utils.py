@@ -3,6 +3,7 @@ from typing import List, Optional, Dict, Set, Tuple, Iterable, Any
 import torch
 import torch.nn.functional as F
 
+from topdown_parser.am_algebra.tree import ArrayTree
 from topdown_parser.dataset_readers.additional_lexicon import AdditionalLexicon
 import numpy as np
 
@@ -43,11 +44,28 @@ def get_best_constant(correct_types: Set[int], constant_scores : np.array) -> Tu
     return best_index, best_score
 
 
+def top_k_indices(scores : np.array, k : int) -> np.array:
+    """
+    Indices of the k highest scores (or all, if there are fewer), in descending order of the scores.
+    Ties are broken by index. Only the k best are sorted.
+    :param scores: shape (n,)
+    """
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < len(scores):
+        # argpartition picks arbitrary indices among the ties at the k-th score, take the smallest ones instead.
+        kth = -np.partition(-scores, k-1)[k-1]
+        higher = np.flatnonzero(scores > kth)
+        indices = np.concatenate([higher, np.flatnonzero(scores == kth)[:k-len(higher)]])
+    else:
+        indices = np.arange(len(scores))
+    return indices[np.lexsort((indices, -scores[indices]))]
+
+
 def get_top_k_choices(choices : Set[int], scores : np.array, k : int) -> List[Tuple[int, float]]:
-    ret = []
-    for choice in choices:
-        ret.append((choice, scores[choice]))
-    return sorted(ret, key=lambda p: p[1], reverse=True)[:k]
+    choices = np.fromiter(choices, dtype=np.int64, count=len(choices))
+    choice_scores = scores[choices]
+    return [(int(choices[i]), choice_scores[i]) for i in top_k_indices(choice_scores, k)]
 
 def is_empty(a : Iterable[Any]) -> bool:
     try:
@@ -58,3 +76,87 @@ def is_empty(a : Iterable[Any]) -> bool:
 
 def copy_optional_set(l : List[Optional[Set[Any]]]):
     return [ None if x is None else set(x) for x in l]
+
+
+def ordered_children(tree : ArrayTree, node : int, children_order : str) -> List[int]:
+    """
+    Returns the children of node (without IGNORE children) in the order in which they are visited.
+    children_order : "LR" (left to right), "RL" (right to left) or "IO" (inside-out)
+    """
+    left_part = []
+    right_part = []
+    for child in tree.children_of(node):
+        if tree.nodes[child].label == "IGNORE":
+            continue
+        if child < node:
+            left_part.append(child)
+        else:
+            right_part.append(child)
+
+    if children_order == "LR":
+        return left_part + right_part
+    elif children_order == "RL":
+        return list(reversed(right_part)) + list(reversed(left_part))
+    elif children_order == "IO":
+        return list(reversed(left_part)) + right_part
+    raise ValueError("Unknown children order: "+children_order)
+
+
+def gold_context(positions : List[int], sentence_length : int, pop_with_0 : bool, children_first : bool = False,
+                 reverse_push_actions : bool = False) -> Dict[str, np.array]:
+    """
+    Computes the context that ParsingState.gather_context returns before every decision of a gold decision sequence
+    (except the first), for transition systems that build the tree top-down with a stack.
+    :param positions: positions of all decisions, 1-based
+    :param sentence_length:
+    :param children_first: nodes are pushed to a substack first that is moved to the stack when the active node is popped (LTL, DFSChildrenFirst)
+    :param reverse_push_actions: only with children_first
+    :return: dense arrays "parents" of shape (steps, 1), "children" and "children_mask" of shape (steps, max(1, max. number of children)),
+        where steps = len(positions) - 1. Rows with fewer children are padded with 0.
+    """
+    steps = len(positions) - 1
+    active_nodes = np.zeros(steps, dtype=np.int64)
+    parents = np.zeros((steps, 1), dtype=np.int64)
+    attached_at, attached_to, attached = [], [], []
+
+    heads = [0] * sentence_length
+    stack = [0]
+    substack = []
+    seen = set()
+    for t in range(steps):
+        active_node = stack[-1] if stack else 0
+        active_nodes[t] = active_node
+        parents[t, 0] = heads[active_node - 1] # like get_parent, also for the artificial root
+        if not stack:
+            continue
+        position = positions[t+1]
+        if (position == 0 and pop_with_0) or (not pop_with_0 and position in seen) or (children_first and t == 1):
+            stack.pop()
+            if children_first:
+                stack.extend(substack if reverse_push_actions else reversed(substack))
+                substack = []
+        else:
+            heads[position - 1] = stack[-1]
+            attached_at.append(t)
+            attached_to.append(stack[-1])
+            attached.append(position)
+            if children_first:
+                substack.append(position)
+            else:
+                stack.append(position)
+        seen.add(position)
+
+    # The children of the active node at step t are the nodes attached to it before step t, in the order of attachment.
+    # Sorting the attachments by (parent, time) makes the children of every node a contiguous slice.
+    keys = np.array(attached_to, dtype=np.int64) * (steps + 1) + np.array(attached_at, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    attached = np.array(attached, dtype=np.int64)[order]
+    first_child = np.searchsorted(keys, active_nodes * (steps + 1))
+    number_of_children = np.searchsorted(keys, active_nodes * (steps + 1) + np.arange(steps)) - first_child
+
+    width = max(1, int(number_of_children.max(initial=0)))
+    offsets = np.arange(width)
+    children = np.where(offsets < number_of_children[:, np.newaxis],
+                        np.append(attached, 0)[np.minimum(first_child[:, np.newaxis] + offsets, len(attached))], 0)
+    return {"parents" : parents, "children" : children, "children_mask" : children != 0}
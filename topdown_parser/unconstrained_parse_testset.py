@@ -16,9 +16,10 @@ from allenpipeline.callback import CallbackName
 if __name__ == "__main__":
     import_submodules("topdown_parser")
     from topdown_parser.dataset_readers.same_formalism_iterator import SameFormalismIterator
+    from topdown_parser.dataset_readers.memory_budget_iterator import MemoryBudgetIterator
     from topdown_parser.callbacks.parse_test import ParseTest
     from topdown_parser.dataset_readers.amconll_tools import parse_amconll
-    from topdown_parser.am_algebra.tools import is_welltyped
+    from topdown_parser.am_algebra.typechecker import BatchedTypeChecker
     from topdown_parser.transition_systems.ltl import LTL
     from topdown_parser.transition_systems.ltf import LTF
     from topdown_parser.transition_systems.dfs import DFS
@@ -30,7 +31,9 @@ if __name__ == "__main__":
     optparser.add_argument('archive_file', type=str, help='the archived model to make predictions with')
     optparser.add_argument('--cuda-device', type=int, default=0, help='id of GPU to use. Use -1 to compute on CPU.')
     optparser.add_argument('--beams', nargs="*", help='beam sizes to use.')
-    optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size.")
+    optparser.add_argument("--batch_size", type=int, default=None, help="Overwrite batch size. With --memory_budget, this is the maximum batch size.")
+    optparser.add_argument("--memory_budget", type=float, default=None, help="Choose batch sizes such that decoding needs at most roughly this many megabytes.")
+    optparser.add_argument("--workers", type=int, default=1, help="Number of processes for checking well-typedness.")
 
 
 
@@ -46,7 +49,12 @@ if __name__ == "__main__":
     model.eval()
     pipelinepieces = PipelineTrainerPieces.from_params(config)
 
-    if args.batch_size is not None and args.batch_size > 0:
+    if args.memory_budget is not None:
+        iterator = pipelinepieces.annotator.data_iterator
+        max_batch_size = args.batch_size if args.batch_size is not None and args.batch_size > 0 else iterator._batch_size
+        pipelinepieces.annotator.data_iterator = MemoryBudgetIterator(iterator.formalisms, args.memory_budget, max_batch_size)
+        pipelinepieces.annotator.data_iterator.set_model(model)
+    elif args.batch_size is not None and args.batch_size > 0:
         assert isinstance(pipelinepieces.annotator.data_iterator, SameFormalismIterator)
         iterator : SameFormalismIterator = pipelinepieces.annotator.data_iterator
         pipelinepieces.annotator.data_iterator = SameFormalismIterator(iterator.formalisms, args.batch_size)
@@ -67,13 +75,12 @@ if __name__ == "__main__":
             filename = os.path.join(model_dir, f"unconstrained_test_{parse_test.names[i]}_k_{beam_size}.txt")
             annotator.annotate_file(model, parse_test.system_inputs[i], filename)
             cumulated_parse_time = 0.0
-            well_typed = 0
-            total = 0
             with open(filename) as f:
-                for am_sentence in parse_amconll(f, False):
-                    cumulated_parse_time += float(am_sentence.attributes["normalized_parsing_time"])
-                    well_typed += int(is_welltyped(am_sentence))
-                    total += 1
+                am_sentences = list(parse_amconll(f, False))
+            for am_sentence in am_sentences:
+                cumulated_parse_time += float(am_sentence.attributes["normalized_parsing_time"])
+            well_typed = sum(BatchedTypeChecker().are_welltyped(am_sentences, workers=args.workers))
+            total = len(am_sentences)
 
             results = parse_test.test_commands[i].evaluate(filename)
             metrics.update({"test_"+parse_test.names[i]+"_k_"+str(beam_size)+"_"+name : val for name, val in results.items()})